@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+
+"""
+benchmarks of the hot paths of rmlru, report ops/s, p50/p99 latency and redis commands and round trips per operation
+
+by default they run on fakeredis and mongomock in process, so the numbers are for comparing versions, not deployments
+    python benchmarks/bench.py
+    python benchmarks/bench.py --redis-server `which redis-server` --mongo mongodb://localhost:27017 -n 2000 find_hit evict_batch
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import socket
+import tempfile
+import argparse
+import subprocess
+from timeit import default_timer
+
+import redis
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from rmlru import RedisDelegate, CollectionBase, SetField, ListField, ZsetField, DictField
+
+WIDE_FIELD_NUM = 200
+LARGE_NUM = 10000
+
+class Docs(CollectionBase):
+    _key_name = 'uid'
+    _key_type = int
+    _col_name = 'docs'
+    _none_string_key_name_dict = {_key_name: int, 'age': int}
+    tags = SetField('tags', log_ops=True)
+    log = ListField('log', DictField(), log_ops=True)
+    scores = ZsetField('scores', 'fid', int, 'score', int, log_ops=True)
+
+class Counter(object):
+    """
+    redis commands and round trips sent by one connection
+    """
+    def __init__(self):
+        self.commands = 0
+        self.round_trips = 0
+
+    def add(self, commands):
+        self.commands += commands
+        self.round_trips += 1
+
+def instrument(conn, counter):
+    """
+    count the commands sent by conn and its pipelines into counter
+    """
+    execute_command = conn.execute_command
+    pipeline = conn.pipeline
+
+    def counted_execute_command(*args, **kwargs):
+        counter.add(1)
+        return execute_command(*args, **kwargs)
+
+    def counted_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+        immediate_execute_command = pipe.immediate_execute_command
+
+        def counted_execute(*args, **kwargs):
+            if pipe.command_stack:
+                counter.add(len(pipe.command_stack))
+            return execute(*args, **kwargs)
+
+        def counted_immediate_execute_command(*args, **kwargs):
+            # WATCH and the reads after it
+            counter.add(1)
+            return immediate_execute_command(*args, **kwargs)
+        pipe.execute = counted_execute
+        pipe.immediate_execute_command = counted_immediate_execute_command
+        return pipe
+
+    conn.execute_command = counted_execute_command
+    conn.pipeline = counted_pipeline
+    return conn
+
+class Env(object):
+    """
+    redis and mongo of the benchmarks, the data are removed before every case
+    """
+    def __init__(self, redis_server=None, redis_url=None, mongo_uri=None):
+        self._process = None
+        self._dir = None
+        if redis_server:
+            redis_url = self._start_redis_server(redis_server)
+        if redis_url:
+            self.redis_conn = redis.StrictRedis.from_url(redis_url)
+        else:
+            import fakeredis
+            self.redis_conn = fakeredis.FakeStrictRedis()
+        if mongo_uri:
+            from pymongo import MongoClient
+            self.mongo_client = MongoClient(mongo_uri)
+        else:
+            import mongomock
+            self.mongo_client = mongomock.MongoClient()
+        self.db = self.mongo_client.rmlru_bench
+        self.counter = Counter()
+        instrument(self.redis_conn, self.counter)
+
+    def _start_redis_server(self, redis_server):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        self._dir = tempfile.mkdtemp()
+        self._process = subprocess.Popen([redis_server, '--port', str(port), '--save', '', '--appendonly', 'no', '--dir', self._dir],
+                                         stdout=open(os.devnull, 'w'))
+        url = 'redis://127.0.0.1:%d/0' % port
+        conn = redis.StrictRedis.from_url(url)
+        for i in range(100):
+            try:
+                conn.ping()
+                return url
+            except redis.exceptions.ConnectionError:
+                time.sleep(0.05)
+        raise RuntimeError('redis-server is not started')
+
+    def reset(self, **kwargs):
+        """
+        return a new RedisDelegate with Docs on empty redis and mongo, kwargs are passed to it
+        """
+        self.redis_conn.flushdb()
+        self.mongo_client.drop_database('rmlru_bench')
+        delegate = RedisDelegate(self.redis_conn, self.db, **kwargs)
+        delegate.add_collection(Docs())
+        return delegate
+
+    def close(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.wait()
+            shutil.rmtree(self._dir, ignore_errors=True)
+
+def percentile(sorted_list, ratio):
+    return sorted_list[min(len(sorted_list) - 1, int(len(sorted_list) * ratio))]
+
+def measure(env, name, op, num, ops_per_call=1):
+    """
+    call op(i) for i in [0, num), each call does ops_per_call operations
+    """
+    latency_list = list()
+    commands, round_trips = env.counter.commands, env.counter.round_trips
+    start_time = default_timer()
+    for i in range(num):
+        op_start_time = default_timer()
+        op(i)
+        latency_list.append((default_timer() - op_start_time) / ops_per_call)
+    total_time = default_timer() - start_time
+    latency_list.sort()
+    op_num = float(num * ops_per_call)
+    print('%-22s %10.0f %10.3f %10.3f %10.1f %10.1f' % (name, op_num / total_time, percentile(latency_list, 0.5) * 1000,
+                                                       percentile(latency_list, 0.99) * 1000,
+                                                       (env.counter.commands - commands) / op_num, (env.counter.round_trips - round_trips) / op_num))
+
+def make_doc(uid):
+    return {'uid': uid, 'name': 'doc%d' % uid, 'age': uid, 'tags': ['a', 'b'], 'log': [{'i': 1}], 'scores': [{'fid': 1, 'score': 1}]}
+
+def insert_docs(env, num, make=make_doc):
+    if num:
+        env.db.docs.insert_many([make(_) for _ in range(num)])
+
+def bench_find_hit(env, num):
+    delegate = env.reset()
+    insert_docs(env, num)
+    for i in range(num):
+        delegate.docs(i).find(i)
+    measure(env, 'find_hit', lambda i: delegate.docs(i).find(i), num)
+    measure(env, 'find_fields_hit', lambda i: delegate.docs.find(i, ['name', 'tags']), num)
+
+def bench_find_miss(env, num):
+    delegate = env.reset()
+    insert_docs(env, num)
+    measure(env, 'find_miss', lambda i: delegate.docs(i).find(i), num)
+    delegate = env.reset()
+    insert_docs(env, num)
+    measure(env, 'find_many_miss', lambda i: delegate.docs.find_many(list(range(i * 10, i * 10 + 10)), ['name', 'tags']), num // 10, 10)
+
+def bench_make_data_in_redis(env, num):
+    delegate = env.reset()
+    insert_docs(env, num)
+
+    def load(i):
+        docs = delegate.docs(i)
+        docs.make_data_in_redis()
+    measure(env, 'make_data_in_redis', load, num)
+    measure(env, 'make_data_in_redis_hit', load, num)
+
+def bench_wide_doc(env, num):
+    delegate = env.reset()
+
+    def make_wide_doc(uid):
+        doc = dict(('f%d' % _, 'v%d' % _) for _ in range(WIDE_FIELD_NUM))
+        doc['uid'] = uid
+        return doc
+    insert_docs(env, num, make_wide_doc)
+    measure(env, 'wide_doc_find_miss', lambda i: delegate.docs(i).find(i), num)
+    measure(env, 'wide_doc_find_hit', lambda i: delegate.docs(i).find(i), num)
+    measure(env, 'wide_doc_get_attr', lambda i: getattr(delegate.docs(i), 'f%d' % (i % WIDE_FIELD_NUM)), num)
+
+def bench_large_fields(env, num):
+    delegate = env.reset()
+    env.db.docs.insert_one({'uid': 0, 'log': [{'i': _} for _ in range(LARGE_NUM)],
+                            'scores': [{'fid': _, 'score': _} for _ in range(LARGE_NUM)]})
+    docs = delegate.docs(0)
+    measure(env, 'large_list_load', lambda i: docs.log.lrange(0, -1), 1)
+    measure(env, 'large_list_lrange_10', lambda i: delegate.docs(0).log.lrange(0, 9), num)
+    measure(env, 'large_list_rpush', lambda i: delegate.docs(0).log.rpush({'i': i}), num)
+    measure(env, 'large_zset_zrange_all', lambda i: delegate.docs(0).scores.zrange(0, -1), max(1, num // 100))
+    measure(env, 'large_zset_zadd', lambda i: delegate.docs(0).scores.zadd(i, LARGE_NUM + i), num)
+
+def bench_write_heavy(env, num):
+    def request(i):
+        docs = delegate.docs(i % 100)
+        docs.tags.sadd('t%d' % i)
+        docs.tags.sadd('u%d' % i)
+        docs.scores.zadd(i, i)
+        docs.name = 'name%d' % i
+        docs.age = i
+
+    def batch_request(i):
+        with delegate.batch():
+            request(i)
+
+    for name, kwargs, op in (('write_heavy', {}, request), ('write_heavy_scripts', {'use_scripts': True}, request),
+                             ('write_heavy_batch', {}, batch_request)):
+        delegate = env.reset(**kwargs)
+        insert_docs(env, 100)
+        measure(env, name, op, num, 5)
+
+def bench_evict(env, num):
+    for name, batch_size in (('evict_one_by_one', 0), ('evict_batch', 100)):
+        delegate = env.reset()
+        for i in range(num):
+            delegate.docs(i).update({'name': 'x', 'tags': ['a']})
+        env.redis_conn.delete(*env.redis_conn.keys('lock:*'))
+        key_name_list = delegate.lru_queue.get_oldest(env.redis_conn, 0, num * 2)
+        step = max(batch_size, 1)
+        measure(env, name, lambda i: delegate.write_back_key_names(env.redis_conn, key_name_list[i * step: (i + 1) * step], batch_size),
+                len(key_name_list) // step, step)
+
+BENCH_LIST = [
+    ('find_hit', bench_find_hit),
+    ('find_miss', bench_find_miss),
+    ('make_data_in_redis', bench_make_data_in_redis),
+    ('wide_doc', bench_wide_doc),
+    ('large_fields', bench_large_fields),
+    ('write_heavy', bench_write_heavy),
+    ('evict', bench_evict),
+]
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmarks of rmlru')
+    parser.add_argument('names', nargs='*', help='benchmarks to run, all by default: ' + ', '.join(_ for _, bench in BENCH_LIST))
+    parser.add_argument('-n', '--num', type=int, default=1000, help='operations of each benchmark')
+    parser.add_argument('--redis-server', help='path of redis-server started on a free port for the benchmarks')
+    parser.add_argument('--redis-url', help='redis to use, its db is flushed! fakeredis by default')
+    parser.add_argument('--mongo', help='mongodb uri, the database rmlru_bench is dropped! mongomock by default')
+    args = parser.parse_args()
+
+    env = Env(args.redis_server, args.redis_url, args.mongo)
+    try:
+        print('%-22s %10s %10s %10s %10s %10s' % ('benchmark', 'ops/s', 'p50 ms', 'p99 ms', 'cmds/op', 'trips/op'))
+        for name, bench in BENCH_LIST:
+            if not args.names or name in args.names:
+                bench(env, args.num)
+    finally:
+        env.close()
+
+if __name__ == '__main__':
+    main()
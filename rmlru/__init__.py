@@ -3,7 +3,23 @@
 """
 data structures in redis
 keys_modified: set, key_names have been modified since readed from mongodb to redis
-lru_queue: zset, member: key_name, score: time
+dirty_since: zset, member: key_name in keys_modified, score: time it is modified first since written back, see RedisDelegate.checkpoint
+lru_queue: zset, member: key_name, score: time, see LruQueue
+lru_queue:[shard]: zset, the same as lru_queue for ApproxLruQueue
+lfu_queue: zset, member: key_name, score: decayed access count, see LfuQueue
+lru_hits: zset, member: key_name, score: decayed read count, see SegmentedLruQueue
+lru_protected: zset, member: key_name read often, score: time, see SegmentedLruQueue
+lfu_queue:decay_time, lru_hits:decay_time: string, time the zset is decayed next time
+dirty_fields:[key_name]: hash, common field names modified since readed from mongodb to redis, value: 1 set, 0 deleted
+inc_fields:[key_name]: hash, common field name: delta added by CollectionBase.incr and not written back yet
+op_log:[key_name]: list, operations applied on complex field with log_ops since readed from mongodb to redis
+missing:[key_name]: string with ttl, the document is not in mongodb, see CollectionBase._negative_cache_ttl
+fill:[key_name]: string with ttl, lease of the client loading the document from mongodb, others wait for it
+key_sizes: hash, key_name: bytes measured by MEMORY USAGE, see RedisDelegate.measure_key_sizes
+key_sizes_total: hash, collection name: sum of its bytes in key_sizes
+with RedisDelegate.hash_tag_num for redis cluster, the key names of documents start with a hash tag {[tag]},
+and keys_modified, dirty_since, the lru queues, key_sizes and key_sizes_total are kept for each hash tag with it as the prefix,
+so all keys of one document and its entries in them are in one cluster slot, see make_hash_tag
 
 common field name means field name stored in hash, complex field( subfield) name means field name stored in set, list, or zset.
 
@@ -23,18 +39,101 @@ import redis
 import time
 import uuid
 import json
-from bson import json_util
-from functools import partial
+import zlib
+import threading
+from bson import json_util, BSON
+from functools import partial, wraps
 from copy import deepcopy
+from collections import OrderedDict, deque
+from pymongo import UpdateOne
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    basestring
+except NameError:
+    # python 3, see rmlru.aio
+    basestring = str
+    long = int
+    xrange = range
 
 KEYS_MODIFIED_SET = 'keys_modified'
+DIRTY_SINCE = 'dirty_since'
 LRU_QUEUE = 'lru_queue'
+LFU_QUEUE = 'lfu_queue'
+LRU_HITS = 'lru_hits'
+LRU_PROTECTED = 'lru_protected'
+KEY_SIZES = 'key_sizes'
+KEY_SIZES_TOTAL = 'key_sizes_total'
+# nested values MEMORY USAGE samples, 0 means all
+MEMORY_USAGE_SAMPLES = 5
+# evict until the memory is below this ratio of the budget
+MEMORY_LOW_WATERMARK = 0.9
 EVERY_ZRANGE_NUM = 1000
 LOCK_TIMEOUT = 10
+# times batch_write_back retries when keys in the batch are touched during writing back
+WRITE_BACK_RETRY_NUM = 3
+# write the whole complex field back when there are more operations than it in op log
+OP_LOG_MAX_LEN = 1000
+# members read in one round trip by the iterators of complex fields
+ITER_PAGE_SIZE = 1000
+# milliseconds a client loading one document from mongo holds its lease
+FILL_LEASE_TIMEOUT = 3000
+# seconds between two checks of the clients waiting for the lease holder
+FILL_POLL_INTERVAL = 0.01
+# channel on which the key names modified are published to invalidate local caches
+INVALIDATION_CHANNEL = 'rmlru:invalidation'
+# record the modification of a complex field and apply the command on it, see ComplexField.mutate
+# KEYS: key_name, KEYS_MODIFIED_SET, lru queue name, op log name, missing name of the document, DIRTY_SINCE
+# ARGV: zadd or zincrby, score in lru queue, op in json or '' if not logged, op_log_max_len, '1' if deleting missing name,
+#       channel or '', time, command, args...
+MUTATE_SCRIPT = """
+local unpack = unpack or table.unpack
+redis.call('sadd', KEYS[2], KEYS[1])
+redis.call('zadd', KEYS[6], 'NX', ARGV[7], KEYS[1])
+redis.call(ARGV[1], KEYS[3], ARGV[2], KEYS[1])
+if ARGV[3] ~= '' then
+    redis.call('rpush', KEYS[4], ARGV[3])
+    redis.call('ltrim', KEYS[4], 0, ARGV[4])
+end
+if ARGV[5] == '1' then
+    redis.call('del', KEYS[5])
+end
+if ARGV[6] ~= '' then
+    redis.call('publish', ARGV[6], KEYS[1])
+end
+return redis.call(ARGV[8], KEYS[1], unpack(ARGV, 9))
+"""
 
 def make_lockname(key_name):
     return 'lock:' + key_name
 
+def make_dirty_fields_name(key_name):
+    return 'dirty_fields:' + key_name
+
+def make_inc_fields_name(key_name):
+    return 'inc_fields:' + key_name
+
+def make_op_log_name(key_name):
+    return 'op_log:' + key_name
+
+def make_staged_field_name(field_name):
+    """
+    the field in mongo a complex field is written into page by page before replacing it, see RedisDelegate.stream_write_back
+    """
+    return '_staged_' + field_name
+
+def make_missing_name(key_name):
+    return 'missing:' + key_name
+
+def make_fill_lease_name(key_name):
+    return 'fill:' + key_name
+
+def make_lru_queue_name(shard):
+    return '%s:%d' % (LRU_QUEUE, shard)
+
 def make_key_name(*args):
     return ':'.join(map(str, args))
 
@@ -42,6 +141,54 @@ def make_key_name(*args):
 def make_sub_key_name(*args):
     return '.'.join(map(str, args))
 
+def key_partition(key_name, partition_num):
+    """
+    all key names of one document are in the same partition
+    """
+    doc_key_name = key_name.split('.', 1)[0]
+    if not isinstance(doc_key_name, bytes):
+        doc_key_name = doc_key_name.encode('utf-8')
+    return (zlib.crc32(doc_key_name) & 0xffffffff) % partition_num
+
+def make_hash_tag(key_name, hash_tag_num):
+    """
+    hash tag of the document key_name among hash_tag_num ones, redis cluster hashes only the part in {} of the keys
+    """
+    return '{%d}' % key_partition(key_name, hash_tag_num)
+
+def get_hash_tag(key_name):
+    """
+    return the hash tag key_name starts with, '' if none
+    """
+    if key_name.startswith('{'):
+        return key_name[:key_name.index('}') + 1]
+    return ''
+
+def make_tagged_name(name, key_name):
+    """
+    name of the global structure holding key_name, in the same cluster slot as key_name
+    """
+    return get_hash_tag(key_name) + name
+
+def get_col_name(key_name):
+    return key_name[len(get_hash_tag(key_name)):].split(':', 1)[0]
+
+def record_dirty_since(pipe, key_name, now):
+    """
+    queue the command recording key_name is modified since now into pipe, unless it is modified earlier
+    """
+    pipe.execute_command('ZADD', make_tagged_name(DIRTY_SINCE, key_name), 'NX', now, key_name)
+
+def zadd_scores(pipe, name, *score_members):
+    """
+    ZADD name score1 member1 score2 member2... with pipe,
+    sent as a raw command since redis-py 3 changed the arguments of zadd and zincrby
+    """
+    return pipe.execute_command('ZADD', name, *score_members)
+
+def zincrby_member(pipe, name, member, amount=1):
+    return pipe.execute_command('ZINCRBY', name, amount, member)
+
 def acquire_lock_with_timeout(conn, key_name, lock_timeout=LOCK_TIMEOUT):
     """
     Tell scheduler that I will do sth with this key in LOCK_TIMEOUT seconds, so it can't write it back to mongo
@@ -50,21 +197,731 @@ def acquire_lock_with_timeout(conn, key_name, lock_timeout=LOCK_TIMEOUT):
     lockname = make_lockname(key_name)
     conn.setex(lockname, lock_timeout, identifier)
 
+def release_fill_leases(conn, lease_names, identifier):
+    """
+    delete the leases in lease_names still held with identifier, not the ones taken by others after they expired
+    they should have the same hash tag
+    """
+    if not lease_names:
+        return
+    pipe = conn.pipeline()
+    try:
+        pipe.watch(*lease_names)
+        held_list = [name for name, value in zip(lease_names, pipe.mget(lease_names)) if value == identifier]
+        if held_list:
+            pipe.multi()
+            pipe.delete(*held_list)
+            pipe.execute()
+    except redis.exceptions.WatchError as e:
+        # taken by others meanwhile, the ones still held expire
+        pass
+    finally:
+        pipe.reset()
+
+def merge_queue_replies(reply_lists, start, num):
+    """
+    merge the replies of zrange withscores on several queues, return the member names from start to start + num
+    """
+    member_score_list = sorted((_ for reply_list in reply_lists for _ in reply_list), key=lambda x: x[1])
+    return [member for member, score in member_score_list[start: start + num]]
+
+class QueueMerger(object):
+    """
+    merge the heads of several queues into the member names from the start-th lowest score to start + num,
+    each queue is read page by page from its own offset, only the ones whose last read score is the lowest are read further,
+    so at most about twice start + num members are read in all, not start + num of every queue
+    read the ranges returned by get_reads with zrange withscores and pass the replies to feed, until get_reads returns none
+    """
+    def __init__(self, queue_names, start, num):
+        self.queue_names = queue_names
+        self.start = start
+        self.num = num
+        # (member, score) read from every queue
+        self._read_lists = [list() for _ in queue_names]
+        self._is_ended_list = [False] * len(queue_names)
+
+    def _get_bound(self):
+        """
+        return the lowest last read score of the queues not read to the end, None if all are
+        """
+        last_score_list = [read_list[-1][1] if read_list else float('-inf')
+                           for read_list, is_ended in zip(self._read_lists, self._is_ended_list) if not is_ended]
+        return min(last_score_list) if last_score_list else None
+
+    def _get_merged(self):
+        bound = self._get_bound()
+        return sorted((_ for read_list in self._read_lists for _ in read_list if bound is None or _[1] <= bound), key=lambda x: x[1])
+
+    def get_reads(self):
+        """
+        return [(index of the queue, queue name, start, end)] to read next
+        """
+        bound = self._get_bound()
+        if bound is None:
+            return []
+        need_num = self.start + self.num - len(self._get_merged())
+        if need_num <= 0:
+            return []
+        reads = list()
+        index_list = [i for i, (read_list, is_ended) in enumerate(zip(self._read_lists, self._is_ended_list))
+                      if not is_ended and (read_list[-1][1] if read_list else float('-inf')) == bound]
+        page_size = need_num // len(index_list) + 1
+        for i in index_list:
+            offset = len(self._read_lists[i])
+            reads.append((i, self.queue_names[i], offset, offset + page_size - 1))
+        return reads
+
+    def feed(self, reads, replies):
+        for (i, queue_name, start, end), reply in zip(reads, replies):
+            self._read_lists[i].extend(reply)
+            if len(reply) < end - start + 1:
+                self._is_ended_list[i] = True
+
+    def get_result(self):
+        return [member for member, score in self._get_merged()[self.start: self.start + self.num]]
+
+class LruQueue(object):
+    """
+    eviction policy, the key names are evicted from the head of the queues returned by get_queue_names
+    exact LRU, every access of a key name is recorded in LRU_QUEUE with its time
+    hash_tags: the queues are kept for each of them, set by RedisDelegate, see make_tagged_name
+    """
+    hash_tags = ('', )
+
+    def get_queue_names(self):
+        return [tag + LRU_QUEUE for tag in self.hash_tags]
+
+    def get_queue_name(self, key_name):
+        return make_tagged_name(LRU_QUEUE, key_name)
+
+    def get_score(self, now):
+        return now
+
+    def touch(self, pipe, key_name, now, is_modified=False):
+        """
+        queue the command recording key_name is accessed at now into pipe
+        is_modified: key_name is modified, which is always recorded
+        """
+        zadd_scores(pipe, self.get_queue_name(key_name), self.get_score(now), key_name)
+
+    def get_modify_touch(self, now):
+        """
+        return (zadd or zincrby, score) MUTATE_SCRIPT touches the modified key name with
+        """
+        return 'zadd', self.get_score(now)
+
+    def touch_loaded(self, pipe, key_name, now):
+        """
+        key_name is just loaded from mongo, it has been touched when checking its existence
+        """
+        pass
+
+    def remove(self, pipe, key_name):
+        pipe.zrem(self.get_queue_name(key_name), key_name)
+
+    def maintain(self, conn):
+        """
+        called by every round of check_overload
+        """
+        pass
+
+    def _decay(self, conn, name, factor, interval):
+        """
+        multiply the scores of zset name by factor once every interval seconds among all clients
+        """
+        decay_time_name = name + ':decay_time'
+        now = time.time()
+        decay_time = conn.get(decay_time_name)
+        if decay_time is None:
+            conn.set(decay_time_name, now + interval, nx=True)
+        # only the client getting decay_time decays it
+        elif float(decay_time) <= now and conn.getset(decay_time_name, now + interval) == decay_time:
+            conn.zunionstore(name, {name: factor})
+
+    def count(self, conn):
+        pipe = conn.pipeline(False)
+        for queue_name in self.get_queue_names():
+            pipe.zcard(queue_name)
+        return sum(pipe.execute())
+
+    def get_oldest(self, conn, start, num):
+        """
+        return num key names from the start-th least recently used one
+        """
+        queue_names = self.get_queue_names()
+        if 1 == len(queue_names):
+            return conn.zrange(queue_names[0], start, start + num - 1)
+        merger = QueueMerger(queue_names, start, num)
+        reads = merger.get_reads()
+        while reads:
+            pipe = conn.pipeline(False)
+            for i, queue_name, read_start, read_end in reads:
+                pipe.zrange(queue_name, read_start, read_end, withscores=True)
+            merger.feed(reads, pipe.execute())
+            reads = merger.get_reads()
+        return merger.get_result()
+
+    def get_touched_since(self, conn, since, start, num):
+        """
+        return num key names from the start-th touched since the time since
+        """
+        queue_names = self.get_queue_names()
+        if 1 == len(queue_names):
+            return conn.zrangebyscore(queue_names[0], since, '+inf', start=start, num=num)
+        pipe = conn.pipeline(False)
+        for queue_name in queue_names:
+            pipe.zrangebyscore(queue_name, self.get_score(since), '+inf', start=0, num=start + num, withscores=True)
+        return merge_queue_replies(pipe.execute(), start, num)
+
+class ApproxLruQueue(LruQueue):
+    """
+    approximate LRU with less writes on reads and no single hot zset
+    shard_num: key names are in lru_queue:[0, shard_num), the ones of one document in the same queue, see key_partition
+    touch_interval: seconds the time in queues is rounded down to, this process records reads of one key name once in it
+    max_touched_num: max number of key names this process remembers touching
+    the least recently used are the merged heads of all queues, they are sorted, so no need to sample them,
+    the heads are read page by page by QueueMerger, so deep pages of get_oldest don't read start + num of every queue
+    """
+    def __init__(self, shard_num=16, touch_interval=10, max_touched_num=100000):
+        self.shard_num = shard_num
+        self.touch_interval = touch_interval
+        self.max_touched_num = max_touched_num
+        # key_name -> score touched with
+        self._touched_dict = dict()
+
+    def get_queue_names(self):
+        return [tag + make_lru_queue_name(_) for tag in self.hash_tags for _ in xrange(self.shard_num)]
+
+    def get_queue_name(self, key_name):
+        return make_tagged_name(make_lru_queue_name(key_partition(key_name, self.shard_num)), key_name)
+
+    def get_score(self, now):
+        return int(now // self.touch_interval * self.touch_interval)
+
+    def touch(self, pipe, key_name, now, is_modified=False):
+        score = self.get_score(now)
+        if not is_modified and self._touched_dict.get(key_name) == score:
+            return
+        if len(self._touched_dict) >= self.max_touched_num:
+            self._touched_dict.clear()
+        self._touched_dict[key_name] = score
+        zadd_scores(pipe, self.get_queue_name(key_name), score, key_name)
+
+    def touch_loaded(self, pipe, key_name, now):
+        # the touch when checking its existence may be skipped
+        self.touch(pipe, key_name, now, True)
+
+class LfuQueue(LruQueue):
+    """
+    LFU, every access of a key name adds one to its score in LFU_QUEUE, the scores are decayed
+    init_count: the count of the key names just loaded, so they are not evicted at once
+    decay_factor, decay_interval: the scores are multiplied by decay_factor every decay_interval seconds
+    """
+    def __init__(self, init_count=5, decay_factor=0.5, decay_interval=600):
+        self.init_count = init_count
+        self.decay_factor = decay_factor
+        self.decay_interval = decay_interval
+
+    def get_queue_names(self):
+        return [tag + LFU_QUEUE for tag in self.hash_tags]
+
+    def get_queue_name(self, key_name):
+        return make_tagged_name(LFU_QUEUE, key_name)
+
+    def touch(self, pipe, key_name, now, is_modified=False):
+        zincrby_member(pipe, self.get_queue_name(key_name), key_name)
+
+    def get_modify_touch(self, now):
+        return 'zincrby', 1
+
+    def touch_loaded(self, pipe, key_name, now):
+        zincrby_member(pipe, self.get_queue_name(key_name), key_name, self.init_count - 1)
+
+    def get_touched_since(self, conn, since, start, num):
+        """
+        the time of access is unknown, return all key names
+        """
+        return self.get_oldest(conn, start, num)
+
+    def maintain(self, conn):
+        for queue_name in self.get_queue_names():
+            self._decay(conn, queue_name, self.decay_factor, self.decay_interval)
+
+class SegmentedLruQueue(LruQueue):
+    """
+    segmented LRU, the key names read protected_hits times are protected,
+    and evicted only after all the others, so one scan of many key names doesn't evict the ones read often
+    LRU_QUEUE is the probation segment, the protected key names are moved to LRU_PROTECTED and the read counts are in LRU_HITS
+    the protected key names read again are added to LRU_QUEUE too, and are removed from it when get_oldest meets them
+    protected_ratio: max ratio of the protected key names, the least recently used ones are moved back to LRU_QUEUE
+    decay_factor, decay_interval: the read counts are multiplied by decay_factor every decay_interval seconds
+    the key names are protected by maintain
+    """
+    def __init__(self, protected_hits=2, protected_ratio=0.8, decay_factor=0.5, decay_interval=600):
+        self.protected_hits = protected_hits
+        self.protected_ratio = protected_ratio
+        self.decay_factor = decay_factor
+        self.decay_interval = decay_interval
+
+    def touch(self, pipe, key_name, now, is_modified=False):
+        zadd_scores(pipe, self.get_queue_name(key_name), now, key_name)
+        if not is_modified:
+            zincrby_member(pipe, make_tagged_name(LRU_HITS, key_name), key_name)
+            pipe.execute_command('ZADD', make_tagged_name(LRU_PROTECTED, key_name), 'XX', now, key_name)
+
+    def remove(self, pipe, key_name):
+        pipe.zrem(self.get_queue_name(key_name), key_name)
+        pipe.zrem(make_tagged_name(LRU_HITS, key_name), key_name)
+        pipe.zrem(make_tagged_name(LRU_PROTECTED, key_name), key_name)
+
+    def count(self, conn):
+        """
+        the protected key names read since get_oldest met them last time are counted twice
+        """
+        pipe = conn.pipeline(False)
+        for tag in self.hash_tags:
+            pipe.zcard(tag + LRU_QUEUE)
+            pipe.zcard(tag + LRU_PROTECTED)
+        return sum(pipe.execute())
+
+    def get_oldest(self, conn, start, num):
+        """
+        the key names not protected first, then the protected ones, both from the least recently used
+        """
+        unprotected_list = list()
+        protected_list = list()
+        for tag in self.hash_tags:
+            tag_unprotected_list, tag_protected_list = self._get_oldest_in(conn, tag, start + num)
+            unprotected_list.extend(tag_unprotected_list)
+            protected_list.extend(tag_protected_list)
+        member_score_list = sorted(unprotected_list, key=lambda x: x[1]) + sorted(protected_list, key=lambda x: x[1])
+        return [member for member, score in member_score_list[start: start + num]]
+
+    def _get_oldest_in(self, conn, tag, num):
+        """
+        return ((member, score) not protected, (member, score) protected) of the queues of hash tag tag,
+        at least num not protected from the least recently used, or all of them and the protected ones to make up num
+        only the head of LRU_QUEUE is read, the protected key names met in it are removed from it
+        """
+        queue_name, protected_name = tag + LRU_QUEUE, tag + LRU_PROTECTED
+        key_name_list = list()
+        protected_key_name_list = list()
+        offset = 0
+        while len(key_name_list) < num:
+            queue_list = conn.zrange(queue_name, offset, offset + num - len(key_name_list) - 1, withscores=True)
+            if not queue_list:
+                break
+            offset += len(queue_list)
+            pipe = conn.pipeline(False)
+            for key_name, score in queue_list:
+                pipe.zscore(protected_name, key_name)
+            for (key_name, score), protected in zip(queue_list, pipe.execute()):
+                if protected is None:
+                    key_name_list.append((key_name, score))
+                else:
+                    protected_key_name_list.append(key_name)
+        if protected_key_name_list:
+            conn.zrem(queue_name, *protected_key_name_list)
+        if len(key_name_list) < num:
+            # all left are protected
+            return key_name_list, conn.zrange(protected_name, 0, num - len(key_name_list) - 1, withscores=True)
+        return key_name_list, []
+
+    def maintain(self, conn):
+        for tag in self.hash_tags:
+            self._maintain_in(conn, tag)
+
+    def _maintain_in(self, conn, tag):
+        queue_name, hits_name, protected_name = tag + LRU_QUEUE, tag + LRU_HITS, tag + LRU_PROTECTED
+        hits_list = conn.zrangebyscore(hits_name, self.protected_hits, '+inf')
+        pipe = conn.pipeline(False)
+        for key_name in hits_list:
+            pipe.zscore(queue_name, key_name)
+        score_list = pipe.execute()
+
+        pipe = conn.pipeline(False)
+        protected_list = list()
+        for key_name, score in zip(hits_list, score_list):
+            # not written back yet
+            if score is not None:
+                zadd_scores(pipe, protected_name, score, key_name)
+                protected_list.append(key_name)
+        if protected_list:
+            pipe.zrem(queue_name, *protected_list)
+        if hits_list:
+            pipe.zrem(hits_name, *hits_list)
+        pipe.zcard(queue_name)
+        pipe.zcard(protected_name)
+        queue_num, protected_num = pipe.execute()[-2:]
+        # the least recently used ones are not protected any more
+        extra_num = protected_num - int((queue_num + protected_num) * self.protected_ratio)
+        if extra_num > 0:
+            demoted_list = conn.zrange(protected_name, 0, extra_num - 1, withscores=True)
+            pipe = conn.pipeline(False)
+            for key_name, score in demoted_list:
+                zadd_scores(pipe, queue_name, score, key_name)
+            pipe.zrem(protected_name, *[key_name for key_name, score in demoted_list])
+            pipe.execute()
+        self._decay(conn, hits_name, self.decay_factor, self.decay_interval)
+
+class WriteBackPacer(object):
+    """
+    adaptive rate of writing keys back to mongo, shared by all write back workers of one RedisDelegate
+    the rate starts at max_rate keys/s, it is increased by rate_step for every bulk_write taking at most latency_budget seconds,
+    and multiplied by backoff at most once a second otherwise, but is never below min_rate
+    critical_memory: the keys are written back without waiting while redis uses this many bytes or more, None means never,
+        it is checked once every memory_check_interval seconds
+    """
+    def __init__(self, max_rate=1000, min_rate=10, latency_budget=0.1, rate_step=10, backoff=0.5, critical_memory=None, memory_check_interval=1):
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.latency_budget = latency_budget
+        self.rate_step = rate_step
+        self.backoff = backoff
+        self.critical_memory = critical_memory
+        self.memory_check_interval = memory_check_interval
+        self.rate = float(max_rate)
+        self.is_critical = False
+        # time the next key can be written back
+        self._next_time = 0
+        self._backoff_time = 0
+        self._memory_check_time = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, num):
+        """
+        reserve the time of writing num keys back, return the seconds to wait before it
+        """
+        with self._lock:
+            now = time.time()
+            if self.is_critical:
+                self._next_time = now
+                return 0
+            start_time = max(self._next_time, now)
+            self._next_time = start_time + num / self.rate
+            return start_time - now
+
+    def record(self, latency):
+        """
+        adjust the rate by latency of one bulk_write
+        """
+        with self._lock:
+            now = time.time()
+            if latency <= self.latency_budget:
+                self.rate = min(self.max_rate, self.rate + self.rate_step)
+            elif now >= self._backoff_time:
+                self.rate = max(self.min_rate, self.rate * self.backoff)
+                self._backoff_time = now + 1
+
+    def need_memory_check(self):
+        return self.critical_memory is not None and time.time() >= self._memory_check_time
+
+    def set_used_memory(self, used_memory):
+        self.is_critical = used_memory >= self.critical_memory
+        self._memory_check_time = time.time() + self.memory_check_interval
+
+class Instrumentation(object):
+    """
+    receiver of the metrics of RedisDelegate, the methods do nothing, override them
+    counters:
+        fill.hit.[col_name].[field_name], fill.miss.[col_name].[field_name]: complex fields in redis or not when checked by make_data_in_redis,
+            field_name is _hashes for the common fields
+        write_back.evicted, write_back.deferred: key names written back and removed from redis, or which can't be now
+        write_back.bytes_freed: bytes freed by evict_by_memory
+        check_overload.retried: key names which couldn't be written back retried
+    spans, in seconds:
+        fill: loading from mongo into redis, mongo.find_one, mongo.find, mongo.update, mongo.bulk_write: the mongo calls
+        field.[method]: the operations of complex fields, such as field.sadd
+        write_back: try_write_back or batch_write_back, check_overload.cycle: one round of check_overload without sleeping
+    """
+    def incr(self, name, value=1):
+        pass
+
+    def timing(self, name, seconds):
+        pass
+
+class MetricsAggregator(Instrumentation):
+    """
+    Instrumentation keeping the metrics in memory, thread safe
+    max_samples: the latest samples of every span the percentiles are computed from
+    """
+    def __init__(self, max_samples=10000):
+        self.max_samples = max_samples
+        self._counters = dict()
+        # name -> the latest samples
+        self._samples_dict = dict()
+        # name -> [count, total seconds]
+        self._totals_dict = dict()
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def timing(self, name, seconds):
+        with self._lock:
+            samples = self._samples_dict.get(name)
+            if samples is None:
+                samples = self._samples_dict[name] = deque(maxlen=self.max_samples)
+                self._totals_dict[name] = [0, 0.0]
+            samples.append(seconds)
+            totals = self._totals_dict[name]
+            totals[0] += 1
+            totals[1] += seconds
+
+    def report(self, percentiles=(50, 90, 99)):
+        """
+        return {'counters': {name: value}, 'spans': {name: {'count': n, 'total': seconds, 'max': seconds, 'p50': seconds...}}}
+        """
+        with self._lock:
+            spans = dict()
+            for name, samples in self._samples_dict.items():
+                sorted_samples = sorted(samples)
+                count, total = self._totals_dict[name]
+                span = {'count': count, 'total': total, 'max': sorted_samples[-1]}
+                for percentile in percentiles:
+                    span['p%s' % percentile] = sorted_samples[min(len(sorted_samples) - 1, int(len(sorted_samples) * percentile / 100.0))]
+                spans[name] = span
+            return {'counters': dict(self._counters), 'spans': spans}
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._samples_dict.clear()
+            self._totals_dict.clear()
+
+def incr_fill_counters(instrumentation, col_name, field_names, exists_list):
+    """
+    field_names: the complex field names checked, followed by _hashes if the common fields are
+    """
+    for field_name, exists in zip(field_names, exists_list):
+        instrumentation.incr('fill.%s.%s.%s' % ('hit' if exists else 'miss', col_name, field_name))
+
+def instrumented(method):
+    """
+    emit the span field.[method name] of the complex field operation to the instrumentation of its RedisDelegate
+    """
+    span_name = 'field.' + method.__name__
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        instrumentation = self.col.redis_delegate.instrumentation
+        if instrumentation is None:
+            return method(self, *args, **kwargs)
+        start_time = time.time()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            instrumentation.timing(span_name, time.time() - start_time)
+    return wrapper
+
+def estimate_size(val):
+    """
+    rough size of val in bytes
+    """
+    if isinstance(val, basestring):
+        return len(val) + 40
+    elif isinstance(val, dict):
+        return sum(estimate_size(k) + estimate_size(v) for k, v in val.items()) + 100
+    elif isinstance(val, (list, tuple, set)):
+        return sum(estimate_size(_) for _ in val) + 60
+    return 24
+
+class LocalCache(object):
+    """
+    bounded in-process LRU cache in front of redis, thread safe
+    entries are keyed by (key_name, field_name), field_name None means the whole value of key_name
+    max_entries: max number of entries
+    max_bytes: max bytes of the values estimated by estimate_size, None means no limit
+    ttl: seconds an entry lives, None means until invalidated
+    the values read from redis are set with the generation got before reading them,
+    they are not cached if their documents are invalidated meanwhile, see get_generation
+    NOTE: values got are shared, never modify them
+    """
+    def __init__(self, max_entries=10000, max_bytes=None, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        # (key_name, field_name) -> (value, size, expire time)
+        self._entries = OrderedDict()
+        # key_name -> set of field_name cached
+        self._field_names_dict = dict()
+        # number of invalidations so far
+        self._generation = 0
+        # document key name -> generation it is invalidated at, at most max_entries of them
+        self._invalidated_dict = dict()
+        # the values read before it are never cached, the documents invalidated before it are forgotten
+        self._min_generation = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 'bytes': self.bytes}
+
+    def get(self, key_name, field_name=None, default=None):
+        with self._lock:
+            entry = self._entries.get((key_name, field_name))
+            if entry is None or (entry[2] is not None and entry[2] < time.time()):
+                if entry is not None:
+                    self._remove((key_name, field_name))
+                self.misses += 1
+                return default
+            # the most recently used is the last
+            del self._entries[(key_name, field_name)]
+            self._entries[(key_name, field_name)] = entry
+            self.hits += 1
+            return entry[0]
+
+    def get_generation(self):
+        """
+        return the generation to pass to set, get it before reading the value from redis
+        """
+        with self._lock:
+            return self._generation
+
+    def set(self, key_name, field_name, val, generation=None):
+        """
+        generation: see get_generation, val is not cached if the document of key_name is invalidated since then
+        """
+        size = estimate_size(val)
+        expire_time = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            if generation is not None and (generation < self._min_generation or
+                    self._invalidated_dict.get(key_name.split('.', 1)[0], -1) > generation):
+                return
+            self._remove((key_name, field_name))
+            self._entries[(key_name, field_name)] = (val, size, expire_time)
+            self._field_names_dict.setdefault(key_name, set()).add(field_name)
+            self.bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or
+                    (self.max_bytes is not None and self.bytes > self.max_bytes)):
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, key_name):
+        """
+        remove all entries of key_name, and the whole document if key_name is a complex field
+        """
+        with self._lock:
+            for field_name in list(self._field_names_dict.get(key_name, ())):
+                self._remove((key_name, field_name))
+            doc_key_name = key_name.split('.', 1)[0]
+            if doc_key_name != key_name:
+                self._remove((doc_key_name, None))
+            self._generation += 1
+            if len(self._invalidated_dict) >= self.max_entries:
+                self._invalidated_dict.clear()
+                self._min_generation = self._generation
+            self._invalidated_dict[doc_key_name] = self._generation
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._field_names_dict.clear()
+            self.bytes = 0
+            self._generation += 1
+            self._invalidated_dict.clear()
+            self._min_generation = self._generation
+
+    def _remove(self, entry_key):
+        entry = self._entries.pop(entry_key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+            key_name, field_name = entry_key
+            field_names = self._field_names_dict[key_name]
+            field_names.discard(field_name)
+            if not field_names:
+                del self._field_names_dict[key_name]
+
+# returned by LocalCache.get when missing
+_MISSING = object()
+
 class IndirectField(object):
     def set(self, val) :
         raise NotImplementedError()
     def get(self, val):
         raise NotImplementedError() 
 
+class Codec(object):
+    """
+    marker: the first byte of the data encoded, data without marker is decoded by JsonCodec
+    """
+    marker = ''
+    def encode(self, val):
+        raise NotImplementedError()
+    def decode(self, data):
+        raise NotImplementedError()
+
+class JsonCodec(Codec):
+    """
+    no marker, so the data encoded before codecs can still be decoded
+    """
+    def encode(self, val):
+        return json.dumps(val, default=json_util.default)
+    def decode(self, data):
+        return json.loads(data, object_hook=json_util.object_hook)
+
+class MsgpackCodec(Codec):
+    """
+    msgpack is needed
+    the values msgpack can't pack, such as datetime and ObjectId of mongo documents, are packed as BSON in ext type BSON_EXT_TYPE
+    """
+    marker = '\x01'
+    BSON_EXT_TYPE = 1
+    def encode(self, val):
+        return self.marker + msgpack.packb(val, use_bin_type=True, default=self._pack_bson)
+    def decode(self, data):
+        return msgpack.unpackb(data[1:], raw=False, ext_hook=self._unpack_bson)
+    def _pack_bson(self, obj):
+        return msgpack.ExtType(self.BSON_EXT_TYPE, BSON.encode({'v': obj}))
+    def _unpack_bson(self, code, data):
+        if self.BSON_EXT_TYPE != code:
+            return msgpack.ExtType(code, data)
+        return BSON(data).decode()['v']
+
+class BsonCodec(Codec):
+    marker = '\x02'
+    def encode(self, val):
+        return self.marker + BSON.encode({'v': val})
+    def decode(self, data):
+        return BSON(data[1:]).decode()['v']
+
+# marker of the data compressed by zlib, the data decompressed has its own marker
+ZLIB_MARKER = '\x03'
+CODEC_DICT = dict((_.marker, _) for _ in (JsonCodec(), MsgpackCodec(), BsonCodec()))
+
+def decode_data(data):
+    """
+    decode data encoded by any codec according to its marker
+    """
+    marker = data[:1]
+    if ZLIB_MARKER == marker:
+        return decode_data(zlib.decompress(data[1:]))
+    return CODEC_DICT.get(marker, CODEC_DICT['']).decode(data)
+
 class DictField(IndirectField):
+    """
+    codec: Codec encoding the val, JsonCodec by default, all of them encode datetime and ObjectId of mongo documents too
+    compress_threshold: compress the data encoded with zlib when it is longer than it, None means never
+    """
+    def __init__(self, codec=None, compress_threshold=None):
+        self.codec = codec or CODEC_DICT['']
+        self.compress_threshold = compress_threshold
     def set(self, val) :
         if not isinstance(val, str):
-            return json.dumps(val, default=json_util.default)
+            data = self.codec.encode(val)
+            if self.compress_threshold is not None and len(data) > self.compress_threshold:
+                data = ZLIB_MARKER + zlib.compress(data)
+            return data
         else:
             return val
     def get(self, val):
         if isinstance(val, str):
-            return json.loads(val, object_hook=json_util.object_hook)
+            return decode_data(val)
         else:
             return val
 
@@ -84,10 +941,22 @@ class ComplexField(object):
     field_type: IndirectField or None (for string)
     field_name: field_name in mongo
     key_name: [collection name]:[key in mongo].[field_name in mongo]
+    log_ops: record operations in op log, and replay them on mongo when writing back instead of writing the whole field
+    op_log_max_len: write the whole field back when there are more operations than it
+    write_back_page_size: write the whole field back write_back_page_size members at a time if not 0, for large fields,
+        see RedisDelegate.stream_write_back
     """
-    def __init__(self, field_name, field_type=None):
+    # operations whose args are merged when they are next to each other in op log
+    _mergeable_op_names = ()
+    # mongo update operator appending one page to the staged field, see RedisDelegate.stream_write_back
+    _page_update_op = '$push'
+
+    def __init__(self, field_name, field_type=None, log_ops=False, op_log_max_len=OP_LOG_MAX_LEN, write_back_page_size=0):
         self.field_name = field_name
         self.field_type = field_type
+        self.log_ops = log_ops
+        self.op_log_max_len = op_log_max_len
+        self.write_back_page_size = write_back_page_size
 
     def __get__(self, obj, objtype):
         self.conn = obj.redis_delegate.conn
@@ -100,8 +969,131 @@ class ComplexField(object):
         """
         only for non-transitional command using =
         """
+        self.key_name = make_sub_key_name(obj._key, self.field_name)
+        batch = obj.redis_delegate.get_batch()
+        self.conn = obj.redis_delegate.conn.pipeline() if batch is None else batch.pipe
+        self.col = obj
+
+        if obj.need_record_modify():
+            self.record_modify()
+
+        self.fill(self.conn, self.key_name, val)
+        if batch is None:
+            self.conn.execute()
+
+        # change back to non-transactional mode
+        self.conn = obj.redis_delegate.conn
+
+    def fill(self, pipe, key_name, val):
+        """
+        queue the commands replacing the content of key_name with val into pipe
+        """
+        raise NotImplementedError()
+
+    def read(self, pipe, key_name):
+        """
+        queue the command reading the whole content of key_name into pipe, the reply is decoded by parse
+        """
+        raise NotImplementedError()
+
+    def parse(self, raw):
+        return raw
+
+    def iter_pages(self, conn, key_name, page_size):
+        """
+        yield the content of key_name in replies of page_size members at most, each is decoded by parse
+        """
         raise NotImplementedError()
 
+    def _iter_parsed(self, conn, key_name, page_size):
+        for raw in self.iter_pages(conn, key_name, page_size):
+            for v in self.parse(raw):
+                yield v
+
+    def _iter(self, page_size):
+        res = self.col.get_from_just_loaded(self.field_name)
+        if res:
+            return iter(res)
+        # the field is shared by all documents, so what the generator reads is bound now
+        return self._iter_parsed(self.conn, self.key_name, page_size)
+
+    def to_mongo(self, val):
+        """
+        convert the value returned by parse to the one stored in mongo
+        """
+        return val
+
+    def make_op_args(self, op_name, *args):
+        """
+        convert the args of operation op_name to the ones make_delta_updates replays on mongo
+        """
+        return list(args)
+
+    def make_delta_updates(self, op_list):
+        """
+        op_list: list of [op_name, args] in op log
+        return the list of mongo update documents replaying op_list in order, or None if it can't be replayed
+        """
+        return None
+
+    def _merge_ops(self, op_list):
+        merged_op_list = list()
+        for op_name, args in op_list:
+            if merged_op_list and op_name == merged_op_list[-1][0] and op_name in self._mergeable_op_names:
+                merged_op_list[-1][1].extend(args)
+            else:
+                merged_op_list.append([op_name, list(args)])
+        return merged_op_list
+
+    def _to_mongo_members(self, values):
+        """
+        the members as they are stored in mongo after being written back
+        """
+        if isinstance(self.field_type, IndirectField):
+            return [self.field_type.get(self.field_type.set(v)) for v in values]
+        return [v if isinstance(v, basestring) else str(v) for v in values]
+
+    def read_for_write_back(self, pipe, key_name):
+        """
+        queue the command reading what write back needs into pipe, the reply is handled by make_write_back_updates
+        return the number of commands queued
+        """
+        if self.log_ops:
+            pipe.lrange(make_op_log_name(key_name), 0, self.op_log_max_len)
+        elif self.write_back_page_size:
+            # the whole field, not read at once
+            return 0
+        else:
+            self.read(pipe, key_name)
+        return 1
+
+    def read_whole_for_write_back(self, pipe, key_name):
+        """
+        queue the commands reading the whole field and the length of its op log into pipe, pipe should be transactional
+        """
+        pipe.llen(make_op_log_name(key_name))
+        self.read(pipe, key_name)
+
+    def make_write_back_updates(self, raw_list, is_whole=False):
+        """
+        raw_list: the replies of the commands queued by read_for_write_back, or read_whole_for_write_back if is_whole
+        return (list of mongo update documents, number of operations in op log replayed by them)
+            the list is None if the whole field is needed
+        """
+        if is_whole:
+            op_num, raw = raw_list
+            return [{"$set": {self.field_name: self.to_mongo(self.parse(raw))}}], op_num
+        if not self.log_ops:
+            if not raw_list:
+                return None, 0
+            return [{"$set": {self.field_name: self.to_mongo(self.parse(raw_list[0]))}}], 0
+        op_log = raw_list[0]
+        if op_log and len(op_log) <= self.op_log_max_len:
+            update_list = self.make_delta_updates([json.loads(_, object_hook=json_util.object_hook) for _ in op_log])
+            if update_list is not None:
+                return update_list, len(op_log)
+        return None, 0
+
     def get(self):
         raise NotImplementedError()
 
@@ -130,16 +1122,77 @@ class ComplexField(object):
         else:
             return val
 
-    def record_modify(self):
-        self.conn.sadd(KEYS_MODIFIED_SET, self.key_name)
-        self.conn.zadd(LRU_QUEUE, time.time(), self.key_name)
+    def record_modify(self, op_name='set', *args):
+        """
+        op_name: the operation applied with args, 'set' means the field may be changed in any way
+        """
+        self._record_modify(self.conn, op_name, *args)
+
+    def _record_modify(self, conn, op_name, *args):
+        batch = self.col.redis_delegate.get_batch()
+        if batch is not None:
+            batch.record_modify(self.key_name, self.col._key, self.col._negative_cache_ttl)
+        else:
+            now = time.time()
+            conn.sadd(make_tagged_name(KEYS_MODIFIED_SET, self.key_name), self.key_name)
+            record_dirty_since(conn, self.key_name, now)
+            self.col.redis_delegate.lru_queue.touch(conn, self.key_name, now, True)
+            self.col.redis_delegate.record_invalidation(conn, self.key_name)
+            if self.col._negative_cache_ttl:
+                conn.delete(make_missing_name(self.col._key))
+        if self.log_ops:
+            self.record_op(conn, self.key_name, op_name, *args)
+
+    def record_op(self, conn, key_name, op_name, *args):
+        """
+        append the operation to the op log of key_name with conn
+        """
+        op_log_name = make_op_log_name(key_name)
+        conn.rpush(op_log_name, self.dump_op(op_name, *args))
+        # enough to know the whole field will be written back
+        conn.ltrim(op_log_name, 0, self.op_log_max_len)
+
+    def dump_op(self, op_name, *args):
+        return json.dumps([op_name, self.make_op_args(op_name, *args)], default=json_util.default)
+
+    def mutate(self, op, command, *args):
+        """
+        record the modification and apply command with args on the field atomically in one round trip,
+        with MUTATE_SCRIPT if the redis delegate uses scripts, otherwise in a transaction
+        command is sent as a raw redis command, so args are in the order of redis, not of the redis-py method
+        in RedisDelegate.batch, it is queued into the batch and None is returned
+        op: (op_name, args of the operation...), see record_modify
+        """
+        op_name, op_args = op[0], op[1:]
+        delegate = self.col.redis_delegate
+        batch = delegate.get_batch()
+        if batch is not None:
+            self._record_modify(batch.pipe, op_name, *op_args)
+            batch.pipe.execute_command(command.upper(), self.key_name, *args)
+            return None
+        if not delegate.use_scripts:
+            pipe = self.conn.pipeline()
+            self._record_modify(pipe, op_name, *op_args)
+            pipe.execute_command(command.upper(), self.key_name, *args)
+            return pipe.execute()[-1]
+
+        delegate.invalidate_local_cache(self.key_name)
+        lru_queue = delegate.lru_queue
+        keys = [self.key_name, make_tagged_name(KEYS_MODIFIED_SET, self.key_name), lru_queue.get_queue_name(self.key_name), make_op_log_name(self.key_name),
+                make_missing_name(self.col._key), make_tagged_name(DIRTY_SINCE, self.key_name)]
+        now = time.time()
+        argv = list(lru_queue.get_modify_touch(now)) + [self.dump_op(op_name, *op_args) if self.log_ops else '', self.op_log_max_len,
+                '1' if self.col._negative_cache_ttl else '', delegate.invalidation_channel or '', now, command]
+        return delegate.mutate_script(keys=keys, args=argv + list(args), client=self.conn)
 
 class ZsetField(ComplexField):
     """
     docstring for ZsetField
     """
-    def __init__(self, field_name, member_name, member_type, score_name, score_type):
-        super(ZsetField, self).__init__(field_name)
+    _mergeable_op_names = ('zadd', 'zrem')
+
+    def __init__(self, field_name, member_name, member_type, score_name, score_type, **kwargs):
+        super(ZsetField, self).__init__(field_name, **kwargs)
         self.member_name = member_name
         self.member_type = member_type
         self.score_name = score_name
@@ -156,14 +1209,8 @@ class ZsetField(ComplexField):
         else:
             return member_score_list
 
-    def __set__(self, obj, val):
-        self.key_name = make_sub_key_name(obj._key, self.field_name)
-        self.conn = obj.redis_delegate.conn.pipeline()
-
-        if obj.need_record_modify():
-            self.record_modify()
-
-        self.conn.delete(self.key_name)
+    def fill(self, pipe, key_name, val):
+        pipe.delete(key_name)
         if val:
             member_score_list = list()
             for v in val:
@@ -171,18 +1218,57 @@ class ZsetField(ComplexField):
                     member_score_list.append(v[self.score_name])
                     member_score_list.append(v[self.member_name])
                 else :
-                    print "Error: %s miss %s or %s" % (str(v), self.member_name, self.score_name)
+                    print("Error: %s miss %s or %s" % (str(v), self.member_name, self.score_name))
             if member_score_list:
                 self._handle_members_list(member_score_list)
-                self.conn.zadd(self.key_name, *member_score_list)
-        self.conn.execute()
+                zadd_scores(pipe, key_name, *member_score_list)
 
-        # change back to non-transactional mode
-        self.conn = obj.redis_delegate.conn
+    def read(self, pipe, key_name):
+        pipe.zrange(key_name, 0, -1, withscores=True, score_cast_func=self.score_type)
+
+    def iter_pages(self, conn, key_name, page_size):
+        start = 0
+        while True:
+            raw = conn.zrange(key_name, start, start + page_size - 1, withscores=True, score_cast_func=self.score_type)
+            if raw:
+                yield raw
+            if len(raw) < page_size:
+                return
+            start += page_size
+
+    def parse(self, raw):
+        res = list()
+        for v in raw:
+            res.append({self.member_name: self.member_type(v[0]), self.score_name: v[1]})
+        return res
+
+    def make_op_args(self, op_name, *args):
+        if 'zadd' == op_name:
+            values, kwargs = args
+            member_score_list = [[values[i + 1], values[i]] for i in xrange(0, len(values) - 1, 2)] + [[k, v] for k, v in kwargs.items()]
+            return [[self.member_type(member), self.score_type(score)] for member, score in member_score_list]
+        elif 'zrem' == op_name:
+            return [self.member_type(_) for _ in args[0]]
+        return list(args)
+
+    def make_delta_updates(self, op_list):
+        update_list = list()
+        for op_name, args in self._merge_ops(op_list):
+            if 'zadd' == op_name:
+                member_score_dict = OrderedDict(args)
+                update_list.append({"$pull": {self.field_name: {self.member_name: {"$in": list(member_score_dict)}}}})
+                member_list = [{self.member_name: k, self.score_name: v} for k, v in member_score_dict.items()]
+                update_list.append({"$push": {self.field_name: {"$each": member_list, "$sort": {self.score_name: 1}}}})
+            elif 'zrem' == op_name:
+                update_list.append({"$pull": {self.field_name: {self.member_name: {"$in": args}}}})
+            else:
+                return None
+        return update_list
 
     def __getattr__(self, attr):
-        raise AttributeError, attr + ' not allowed currently'
+        raise AttributeError(attr + ' not allowed currently')
 
+    @instrumented
     def zcard(self):
         res = self.col.get_from_just_loaded(self.field_name)
         if res:
@@ -190,11 +1276,15 @@ class ZsetField(ComplexField):
         else :
             return self.conn.zcard(self.key_name)
 
+    @instrumented
     def zadd(self, *values, **kwargs):
-        self.record_modify()
-        values = self._handle_members_list(values)
-        return self.conn.zadd(self.key_name, *values, **kwargs)
+        op = ('zadd', values, kwargs)
+        values = list(self._handle_members_list(values))
+        for member, score in kwargs.items():
+            values.extend([score, member])
+        return self.mutate(op, 'zadd', *values)
 
+    @instrumented
     def zscore(self, member):
         """
         ignore _document_just_loaded_from_mongo, because zscore is more direct and easy
@@ -204,11 +1294,11 @@ class ZsetField(ComplexField):
             score = self.score_type(score)
         return score
 
+    @instrumented
     def zrem(self, *values):
-        self.record_modify()
-        values = self._handle_members_list(values)
-        return self.conn.zrem(self.key_name, *values)
+        return self.mutate(('zrem', values), 'zrem', *self._handle_members_list(values))
 
+    @instrumented
     def zrange(self, start, end):
         res = self.col.get_from_just_loaded(self.field_name)
         if res:
@@ -218,34 +1308,67 @@ class ZsetField(ComplexField):
                 return res[start:]
         else:
             values = self.conn.zrange(self.key_name, start, end, withscores=True, score_cast_func=self.score_type)
-            res = list()
-            for v in values:
-                res.append({self.member_name: self.member_type(v[0]), self.score_name: v[1]})
-            return res
+            return self.parse(values)
+
+    def iter_zrange(self, page_size=ITER_PAGE_SIZE):
+        """
+        iterate the whole zset like zrange(0, -1), page_size members are read in one round trip,
+        the members added or removed meanwhile may be missed or met twice
+        """
+        return self._iter(page_size)
 
     def get(self):
         return self.zrange(0, -1)
 
 class SetField(ComplexField):
-    def __set__(self, obj, val):
-        self.key_name = make_sub_key_name(obj._key, self.field_name)
-        self.conn = obj.redis_delegate.conn.pipeline()
-
-        if obj.need_record_modify():
-            self.record_modify()
+    _mergeable_op_names = ('sadd', 'srem')
+    # SSCAN may return one member more than once
+    _page_update_op = '$addToSet'
 
-        self.conn.delete(self.key_name)
+    def fill(self, pipe, key_name, val):
+        pipe.delete(key_name)
         if val:
             val = self._handle_members_list(val)
-            self.conn.sadd(self.key_name, *val)
-        self.conn.execute()
+            pipe.sadd(key_name, *val)
 
-        # change to not transaction
-        self.conn = obj.redis_delegate.conn
+    def read(self, pipe, key_name):
+        pipe.smembers(key_name)
+
+    def iter_pages(self, conn, key_name, page_size):
+        cursor = 0
+        while True:
+            cursor, raw = conn.sscan(key_name, cursor, count=page_size)
+            if raw:
+                yield raw
+            if not cursor:
+                return
+
+    def parse(self, raw):
+        return set(raw)
+
+    def to_mongo(self, val):
+        return list(val)
+
+    def make_op_args(self, op_name, *args):
+        if op_name in ('sadd', 'srem'):
+            return self._to_mongo_members(args[0])
+        return list(args)
+
+    def make_delta_updates(self, op_list):
+        update_list = list()
+        for op_name, args in self._merge_ops(op_list):
+            if 'sadd' == op_name:
+                update_list.append({"$addToSet": {self.field_name: {"$each": args}}})
+            elif 'srem' == op_name:
+                update_list.append({"$pull": {self.field_name: {"$in": args}}})
+            else:
+                return None
+        return update_list
 
     def __getattr__(self, attr):
-        raise AttributeError, attr + ' not allowed currently'
+        raise AttributeError(attr + ' not allowed currently')
 
+    @instrumented
     def scard(self):
         res = self.col.get_from_just_loaded(self.field_name)
         if res:
@@ -253,11 +1376,11 @@ class SetField(ComplexField):
         else :
             return self.conn.scard(self.key_name)
 
+    @instrumented
     def sadd(self, *values):
-        self.record_modify()
-        values = self._handle_members_list(values)
-        return self.conn.sadd(self.key_name, *values)
+        return self.mutate(('sadd', values), 'sadd', *self._handle_members_list(values))
 
+    @instrumented
     def sismember(self, val):
         res = self.col.get_from_just_loaded(self.field_name)
         if res:
@@ -266,6 +1389,7 @@ class SetField(ComplexField):
             val = self._handle_one_member(val)
             return self.conn.sismember(self.key_name, val)
 
+    @instrumented
     def smembers(self):
         val = self.col.get_from_just_loaded(self.field_name)
         if not val:
@@ -274,40 +1398,80 @@ class SetField(ComplexField):
 
     get = smembers
 
-    def srem(self, *values):
-        self.record_modify()
+    def iter_members(self, page_size=ITER_PAGE_SIZE):
+        """
+        iterate the whole set with SSCAN, page_size is its COUNT hint,
+        one member may be met more than once, and the members added or removed meanwhile may be missed
+        """
+        return self._iter(page_size)
 
-        values = self._handle_members_list(values)
-        return self.conn.srem(self.key_name, *values)
+    @instrumented
+    def srem(self, *values):
+        return self.mutate(('srem', values), 'srem', *self._handle_members_list(values))
 
 class ListField(ComplexField):
-    def __set__(self, obj, val):
-        self.key_name = make_sub_key_name(obj._key, self.field_name)
-        self.conn = obj.redis_delegate.conn.pipeline()
-        if obj.need_record_modify():
-            self.record_modify()
+    _mergeable_op_names = ('rpush', )
 
-        self.conn.delete(self.key_name)
+    def fill(self, pipe, key_name, val):
+        pipe.delete(key_name)
         if val:
             val = self._handle_members_list(val)
-            self.conn.rpush(self.key_name, *val)
-        self.conn.execute()
+            pipe.rpush(key_name, *val)
 
-        self.conn = obj.redis_delegate.conn
+    def read(self, pipe, key_name):
+        pipe.lrange(key_name, 0, -1)
 
-    def lrem(self, count, val):
-        self.record_modify()
+    def iter_pages(self, conn, key_name, page_size):
+        start = 0
+        while True:
+            raw = conn.lrange(key_name, start, start + page_size - 1)
+            if raw:
+                yield raw
+            if len(raw) < page_size:
+                return
+            start += page_size
+
+    def parse(self, raw):
+        return self._handle_members_list(raw, False)
+
+    def make_op_args(self, op_name, *args):
+        if 'rpush' == op_name:
+            return self._to_mongo_members(args[0])
+        return list(args)
+
+    def make_delta_updates(self, op_list):
+        update_list = list()
+        for op_name, args in self._merge_ops(op_list):
+            if 'rpush' == op_name:
+                update_list.append({"$push": {self.field_name: {"$each": args}}})
+            elif 'lpop' == op_name:
+                update_list.append({"$pop": {self.field_name: -1}})
+            elif 'ltrim' == op_name:
+                start, end = args
+                if 0 == start and -1 == end:
+                    continue
+                elif 0 == start and end >= 0:
+                    slice_num = end + 1
+                elif start < 0 and -1 == end:
+                    slice_num = start
+                else:
+                    return None
+                update_list.append({"$push": {self.field_name: {"$each": [], "$slice": slice_num}}})
+            else:
+                return None
+        return update_list
 
-        val = self._handle_one_member(val)
-        val = self.conn.lrem(self.key_name, count, val)
-        return val
+    @instrumented
+    def lrem(self, count, val):
+        return self.mutate(('set', ), 'lrem', count, self._handle_one_member(val))
 
+    @instrumented
     def ltrim(self, start, end):
-        self.record_modify()
-
-        val = self.conn.ltrim(self.key_name, start, end)
-        return val
+        res = self.mutate(('ltrim', start, end), 'ltrim', start, end)
+        # None in RedisDelegate.batch, the script returns the status 'OK'
+        return None if res is None else bool(res)
 
+    @instrumented
     def llen(self):
         res = self.col.get_from_just_loaded(self.field_name)
         if res:
@@ -315,6 +1479,7 @@ class ListField(ComplexField):
         else:
             return self.conn.llen(self.key_name)
 
+    @instrumented
     def lindex(self, index):
         res = self.col.get_from_just_loaded(self.field_name)
         if res:
@@ -327,19 +1492,16 @@ class ListField(ComplexField):
             val = self._handle_one_member(val, False)
             return val
 
+    @instrumented
     def lpop(self):
-        self.record_modify()
-
-        val = self.conn.lpop(self.key_name)
-        return val
+        return self.mutate(('lpop', ), 'lpop')
 
+    @instrumented
     def rpush(self, *values):
-        self.record_modify()
-
         if values:
-            values = self._handle_members_list(values)
-            return self.conn.rpush(self.key_name, *values)
+            return self.mutate(('rpush', values), 'rpush', *self._handle_members_list(values))
 
+    @instrumented
     def lrange(self, start, end):
         res = self.col.get_from_just_loaded(self.field_name)
         if res:
@@ -349,8 +1511,14 @@ class ListField(ComplexField):
                 return res[start:]
         else:
             values = self.conn.lrange(self.key_name, start, end)
-            values = self._handle_members_list(values, False)
-            return values
+            return self.parse(values)
+
+    def iter_lrange(self, page_size=ITER_PAGE_SIZE):
+        """
+        iterate the whole list like lrange(0, -1), page_size members are read in one round trip,
+        the members pushed or removed meanwhile may be missed or met twice
+        """
+        return self._iter(page_size)
 
     def get(self):
         return self.lrange(0, -1)
@@ -358,7 +1526,7 @@ class ListField(ComplexField):
 class CollectionMetaclass(type):
     def __new__(cls, name, bases, attrs):
         subfield_names = list()
-        for k, v in attrs.iteritems():
+        for k, v in attrs.items():
             if not k.startswith('_'):
                 if isinstance(v, ComplexField):
                     subfield_names.append(k)
@@ -373,7 +1541,7 @@ class CollectionMetaclass(type):
         return type.__new__(cls, name, bases, attrs)
 
 
-class CollectionBase(object):
+class CollectionBase(CollectionMetaclass('CollectionMetaBase', (object, ), {'_key_name': ''})):
     """
     Don't define vars not starting with '_' by yourself
     _key:  The key name of collection in redis
@@ -382,8 +1550,8 @@ class CollectionBase(object):
     _col_name: Collection name
     _none_string_key_name_dict: dict maping the name to type of field whose type is not str, list, set and zset
     _ignore_field_names: the list of fields which we never need to load into redis
+    _negative_cache_ttl: seconds to remember the document is not in mongo, 0 means never
     """
-    __metaclass__ = CollectionMetaclass
     _mongo_key = None
     _key = None
     _key_name = ""
@@ -398,6 +1566,11 @@ class CollectionBase(object):
     _need_record_modify = True
     _need_lock = True
     _ignore_field_names = list()
+    # LocalCache, see enable_local_cache
+    _local_cache = None
+    _negative_cache_ttl = 0
+    # times mongo is not queried thanks to negative cache
+    _negative_cache_hits = 0
 
     redis_delegate = None
 
@@ -405,13 +1578,44 @@ class CollectionBase(object):
         if key_name:
             self._key_name = key_name
 
-    def record_modify(self):
+    def record_modify(self, field_names=(), deleted_field_names=(), conn=None):
+        """
+        field_names: common field names set
+        deleted_field_names: common field names deleted
+        """
         if self.need_record_modify():
-            self.redis_delegate.conn.sadd(KEYS_MODIFIED_SET, self._key)
-            self.redis_delegate.conn.zadd(LRU_QUEUE, time.time(), self._key)
+            batch = self.redis_delegate.get_batch()
+            if batch is not None:
+                batch.record_modify(self._key, self._key, self._negative_cache_ttl, field_names, deleted_field_names)
+                return
+            conn = conn or self.redis_delegate.conn
+            now = time.time()
+            conn.sadd(make_tagged_name(KEYS_MODIFIED_SET, self._key), self._key)
+            record_dirty_since(conn, self._key, now)
+            self.redis_delegate.lru_queue.touch(conn, self._key, now, True)
+            dirty_fields = dict.fromkeys(field_names, 1)
+            dirty_fields.update(dict.fromkeys(deleted_field_names, 0))
+            if dirty_fields:
+                conn.hmset(make_dirty_fields_name(self._key), dirty_fields)
+            if self._negative_cache_ttl:
+                conn.delete(make_missing_name(self._key))
+            self.redis_delegate.record_invalidation(conn, self._key)
+
+    def get_negative_cache_hits(self):
+        return self._negative_cache_hits
+
+    def enable_local_cache(self, max_entries=10000, max_bytes=None, ttl=None):
+        """
+        cache what find and common fields got in process, see LocalCache
+        entries modified on other nodes are invalidated by RedisDelegate.start_invalidation_listener
+        """
+        self._local_cache = LocalCache(max_entries, max_bytes, ttl)
+
+    def disable_local_cache(self):
+        self._local_cache = None
 
     def get_hashes_by_dict(self, hashes_dict):
-        for k, v in self._none_string_key_name_dict.iteritems():
+        for k, v in self._none_string_key_name_dict.items():
             if k in hashes_dict:
                 hashes_dict[k] = v(hashes_dict[k])
         return hashes_dict
@@ -436,7 +1640,7 @@ class CollectionBase(object):
 
     def get_all_key_names(self):
         field_names = self.get_all_class_var_names()
-        sub_key_names =  map(partial(make_sub_key_name, self._key), field_names)
+        sub_key_names = [make_sub_key_name(self._key, _) for _ in field_names]
         return sub_key_names, field_names
 
     def get_from_just_loaded(self, key_name):
@@ -448,9 +1652,12 @@ class CollectionBase(object):
     def set_redis_delegate(self, redis_delegate):
         self.redis_delegate = redis_delegate
 
+    def make_doc_key_name(self, key):
+        return self.redis_delegate.make_doc_key_name(self._col_name, key)
+
     def __call__(self, key):
         self._mongo_key = key
-        self._key = make_key_name(self._col_name, key)
+        self._key = self.make_doc_key_name(key)
         return self
 
     def __setattr__(self, attr, value):
@@ -462,26 +1669,75 @@ class CollectionBase(object):
             if attr in cls.__dict__:
                 return object.__setattr__(self, attr, value)
         # self.make_data_in_redis(need_hash=True)
+        batch = self.redis_delegate.get_batch()
+        pipe = self.redis_delegate.conn.pipeline() if batch is None else batch.pipe
         if value is None:
-            mongo_col = getattr(self.redis_delegate.mongo_conn, self._col_name)
-            mongo_key = self._mongo_key
-            self.redis_delegate.conn.hdel(self._key, attr)
-            mongo_col.update({self._key_name: mongo_key}, {"$set": {attr: None}}, True)
+            pipe.hdel(self._key, attr)
+            pipe.hdel(make_dirty_fields_name(self._key), attr)
+            if self._negative_cache_ttl:
+                pipe.delete(make_missing_name(self._key))
+            self.redis_delegate.record_invalidation(pipe, self._key)
+            if batch is None:
+                pipe.execute()
+                self._set_none_in_mongo(self._mongo_key, attr)
+            else:
+                # sent with the hdel, or discarded with it
+                batch.add_mongo_write(partial(self._set_none_in_mongo, self._mongo_key, attr))
         else:
-            self.redis_delegate.conn.hset(self._key, attr, value)
-            self.record_modify()
+            pipe.hset(self._key, attr, value)
+            self.record_modify([attr], conn=pipe)
+            if batch is None:
+                pipe.execute()
+
+    def _set_none_in_mongo(self, mongo_key, attr):
+        mongo_col = getattr(self.redis_delegate.mongo_conn, self._col_name)
+        start_time = time.time()
+        mongo_col.update({self._key_name: mongo_key}, {"$set": {attr: None}}, True)
+        if self.redis_delegate.instrumentation is not None:
+            self.redis_delegate.instrumentation.timing('mongo.update', time.time() - start_time)
 
     def __getattr__(self, attr):
+        local_cache = self._local_cache
+        if local_cache is not None:
+            res = local_cache.get(self._key, attr, _MISSING)
+            if res is not _MISSING:
+                return res
+            generation = local_cache.get_generation()
+
         self.make_data_in_redis(need_hash=True)
         res = self.get_from_just_loaded(attr)
-        if res:
-            return res
-        else : # not likely!
+        if not res: # not likely!
             res = self.redis_delegate.conn.hget(self._key, attr)
             if attr in self._none_string_key_name_dict:
-                return self._none_string_key_name_dict[attr](res)
-            else:
-                return res
+                res = self._none_string_key_name_dict[attr](res)
+        if local_cache is not None:
+            local_cache.set(self._key, attr, res, generation)
+        return res
+
+    def touch_key_names(self, key_names, missing_key_names=()):
+        """
+        lock, touch in the lru queue and check existence of key_names in one round trip
+        missing_key_names: document key names whose negative cache is checked too
+        return a list of bool in the same order as key_names, followed by the ones of missing_key_names
+        """
+        if not key_names and not missing_key_names:
+            return []
+        pipe = self.redis_delegate.conn.pipeline(False)
+        now = time.time()
+        for key_name in key_names:
+            if self._need_lock:
+                acquire_lock_with_timeout(pipe, key_name)
+            pipe.exists(key_name)
+        for key_name in missing_key_names:
+            pipe.exists(make_missing_name(key_name))
+        # the lru queue may skip touches
+        for key_name in key_names:
+            self.redis_delegate.lru_queue.touch(pipe, key_name, now)
+        step = 2 if self._need_lock else 1
+        res = pipe.execute()
+        missing_res = res[len(key_names) * step: len(key_names) * step + len(missing_key_names)]
+        res = res[:len(key_names) * step]
+        return [bool(v) for v in res[step - 1::step]] + [bool(v) for v in missing_res]
 
     def make_data_in_redis(self, field_names=(), need_hash=False):
         '''
@@ -492,7 +1748,12 @@ class CollectionBase(object):
             return
 
         self.turn_off_record_modify()
+        try:
+            self._make_data_in_redis(field_names, need_hash)
+        finally:
+            self.turn_on_record_modify()
 
+    def _make_data_in_redis(self, field_names, need_hash):
         conn = self.redis_delegate.conn
         mongo_col = getattr(self.redis_delegate.mongo_conn, self._col_name)
         key_name = self._key_name
@@ -506,58 +1767,143 @@ class CollectionBase(object):
             sub_key_names, field_names = all_sub_key_names, all_field_names
             need_hash = True
         else:
-            sub_key_names = map(partial(make_sub_key_name, self._key), field_names)
+            sub_key_names = [make_sub_key_name(self._key, _) for _ in field_names]
 
-        for sub_key_name, field_name in zip(sub_key_names, field_names):
-            if self._need_lock:
-                acquire_lock_with_timeout(conn, sub_key_name)
-            self.redis_delegate.conn.zadd(LRU_QUEUE, time.time(), sub_key_name)
-            if not conn.exists(sub_key_name):
-                ##print "try_fetch:", sub_key_name
+        check_key_names = list(sub_key_names)
+        if need_hash:
+            check_key_names.append(self._key)
+        batch = self.redis_delegate.get_batch()
+        if batch is not None:
+            # checked, and loaded if needed, in the batch already
+            if batch.is_checked(check_key_names):
+                return
+            batch.add_checked(check_key_names)
+        missing_key_names = [self._key] if self._negative_cache_ttl else []
+        exists_list = self.touch_key_names(check_key_names, missing_key_names)
+        is_missing = bool(missing_key_names) and exists_list.pop()
+        instrumentation = self.redis_delegate.instrumentation
+        if instrumentation is not None:
+            incr_fill_counters(instrumentation, self._col_name, list(field_names) + ['_hashes'], exists_list)
+
+        for field_name, exists in zip(field_names, exists_list):
+            if not exists:
+                ##print "try_fetch:", field_name
                 field_name_not_in_redis_list.append(field_name)
 
+        if need_hash and exists_list[-1]:
+            need_hash = False
+
+        if (field_name_not_in_redis_list or need_hash) and is_missing:
+            self._negative_cache_hits += 1
+        elif field_name_not_in_redis_list or need_hash:
+            # only one client loads the document, the others wait for it
+            lease_name = make_fill_lease_name(self._key)
+            identifier = str(uuid.uuid4())
+            is_leased = conn.set(lease_name, identifier, px=FILL_LEASE_TIMEOUT, nx=True)
+            if not is_leased:
+                waiting_key_names = [make_sub_key_name(self._key, _) for _ in field_name_not_in_redis_list]
+                if need_hash:
+                    waiting_key_names.append(self._key)
+                if self._wait_for_fill(lease_name, waiting_key_names):
+                    return
+
+            try:
+                mongo_key = self._mongo_key
+                projection = self._make_projection(field_name_not_in_redis_list, need_hash)
+                start_time = time.time()
+                res = mongo_col.find_one({key_name: mongo_key}, projection)
+                if instrumentation is not None:
+                    instrumentation.timing('mongo.find_one', time.time() - start_time)
+                pipe = conn.pipeline()
+                loaded = None
+                if res:
+                    loaded = self._fill_from_document(pipe, self._key, res, field_name_not_in_redis_list, need_hash,
+                                                      self.redis_delegate.lru_queue)
+                elif res is None and self._negative_cache_ttl:
+                    pipe.setex(make_missing_name(self._key), self._negative_cache_ttl, 1)
+                pipe.execute()
+                if instrumentation is not None:
+                    instrumentation.timing('fill', time.time() - start_time)
+                if loaded:
+                    self._document_just_loaded_from_mongo.update(loaded)
+            finally:
+                # a waiter timed out doesn't hold the lease
+                if is_leased:
+                    release_fill_leases(conn, [lease_name], identifier)
+
+    def _make_projection(self, field_names, need_hash):
+        """
+        only fetch the complex fields in field_names, and the common fields if need_hash
+        """
         if need_hash:
-            if self._need_lock:
-                acquire_lock_with_timeout(conn, self._key)
-            self.redis_delegate.conn.zadd(LRU_QUEUE, time.time(), self._key)
-
-            if conn.exists(self._key):
-                need_hash = False
-            ##else:
-            ##    print "try_fetch:", self._key
-
-        if field_name_not_in_redis_list or need_hash:
-            mongo_key = self._mongo_key
-            res = mongo_col.find_one({key_name: mongo_key}, self._ignore_field_names)
-            if not res:
-                self.turn_on_record_modify()
-                return
-            
-            for field_name in all_field_names:
-                if field_name in res:
-                    val = res.pop(field_name)
-                    if field_name in field_name_not_in_redis_list:
-                        self.turn_on_already_in_redis()
-                        getattr(self, field_name).__set__(self, val)
-                        self.turn_off_already_in_redis()
-                        self._document_just_loaded_from_mongo[field_name] = val
+            projection = dict(self._ignore_field_names)
+            projection.update((_, 0) for _ in self.get_all_class_var_names() if _ not in field_names)
+            # being written back by stream_write_back, not a common field
+            projection.update((make_staged_field_name(_), 0) for _ in self.get_all_class_var_names())
+        else:
+            projection = dict.fromkeys(field_names, 1)
+            projection['_id'] = 0
+        return projection
 
-            if need_hash:
-                self._document_just_loaded_from_mongo.update(res)
-                # rm empty val
-                to_be_pop_list = list()
-                for k, v in res.iteritems():
-                    if not v:
-                        to_be_pop_list.append(k)
-                for k in to_be_pop_list:
-                        res.pop(k)
+    def _wait_for_fill(self, lease_name, key_names):
+        """
+        wait until the client holding lease_name releases it or FILL_LEASE_TIMEOUT
+        return True if all key_names are in redis
+        """
+        conn = self.redis_delegate.conn
+        deadline = time.time() + FILL_LEASE_TIMEOUT / 1000.0
+        while True:
+            pipe = conn.pipeline(False)
+            pipe.exists(lease_name)
+            for key_name in key_names:
+                pipe.exists(key_name)
+            res = pipe.execute()
+            if all(res[1:]):
+                return True
+            if not res[0] or time.time() > deadline:
+                return False
+            time.sleep(FILL_POLL_INTERVAL)
+
+    def _get_field(self, field_name):
+        return self.__class__.__dict__[field_name]
 
-                conn.hmset(self._key, res)
+    def _fill_from_document(self, pipe, doc_key_name, doc, field_names, need_hash, lru_queue=None):
+        """
+        queue the commands filling redis with doc just loaded from mongo into pipe
+        field_names: complex field names to be filled
+        lru_queue: LruQueue the key names filled are touched in
+        return the parts of doc filled, the key and its value are not in it!
+        """
+        loaded = dict()
+        now = time.time()
+        for field_name in self.get_all_class_var_names():
+            if field_name in doc:
+                val = doc.pop(field_name)
+                if field_name in field_names:
+                    field = self._get_field(field_name)
+                    sub_key_name = make_sub_key_name(doc_key_name, field_name)
+                    field.fill(pipe, sub_key_name, val)
+                    if field.log_ops:
+                        pipe.delete(make_op_log_name(sub_key_name))
+                    if lru_queue is not None:
+                        lru_queue.touch_loaded(pipe, sub_key_name, now)
+                    loaded[field_name] = val
 
-        self.turn_on_record_modify()
+        if need_hash:
+            # in case the projection doesn't exclude them, see _make_projection
+            for field_name in self.get_all_class_var_names():
+                doc.pop(make_staged_field_name(field_name), None)
+            loaded.update(doc)
+            # rm empty val
+            hashes = dict((k, v) for k, v in doc.items() if v)
+            if hashes:
+                pipe.hmset(doc_key_name, hashes)
+                if lru_queue is not None:
+                    lru_queue.touch_loaded(pipe, doc_key_name, now)
+        return loaded
 
     def _get_all_hashes(self, key):
-        res = self.redis_delegate.conn.hgetall(make_key_name(self._col_name, key))
+        res = self.redis_delegate.conn.hgetall(self.make_doc_key_name(key))
         return self.get_hashes_by_dict(res)
 
     def update(self, doc_dict):
@@ -568,15 +1914,93 @@ class CollectionBase(object):
                 getattr(self, field_name).__set__(self, doc_dict.pop(field_name))
 
         if doc_dict:
-            for k, v in doc_dict.items():
-                if v is None:
-                    doc_dict.pop(k)
-                    self.redis_delegate.conn.hdel(self._key, k)
+            batch = self.redis_delegate.get_batch()
+            pipe = self.redis_delegate.conn.pipeline() if batch is None else batch.pipe
+            deleted_field_names = [k for k, v in doc_dict.items() if v is None]
+            for k in deleted_field_names:
+                doc_dict.pop(k)
+            if deleted_field_names:
+                pipe.hdel(self._key, *deleted_field_names)
             if doc_dict:
-                self.redis_delegate.conn.hmset(self._key, doc_dict)
-            self.record_modify()
+                pipe.hmset(self._key, doc_dict)
+            self.record_modify(doc_dict.keys(), deleted_field_names, pipe)
+            if batch is None:
+                pipe.execute()
+
+    def incr(self, field_name, amount=1):
+        """
+        add amount to one common field atomically, return the new value, or None in RedisDelegate.batch
+        the deltas are written back with $inc, so the increments of other nodes and writers of mongo are kept
+        """
+        return self._incr('hincrby', field_name, amount)
+
+    def incrbyfloat(self, field_name, amount=1.0):
+        """
+        see incr
+        """
+        return self._incr('hincrbyfloat', field_name, amount)
+
+    def _incr(self, command, field_name, amount):
+        self.make_data_in_redis(need_hash=True)
+        batch = self.redis_delegate.get_batch()
+        pipe = self.redis_delegate.conn.pipeline() if batch is None else batch.pipe
+        getattr(pipe, command)(self._key, field_name, amount)
+        getattr(pipe, command)(make_inc_fields_name(self._key), field_name, amount)
+        self.record_modify(conn=pipe)
+        if batch is None:
+            return pipe.execute()[0]
 
     def find(self, key, field_name_list=None):
+        if self._local_cache is None:
+            return self._find(key, field_name_list)
+
+        if field_name_list is not None:
+            self(key)
+        res = self._find_in_local_cache(key, field_name_list)
+        if res is None:
+            generation = self._local_cache.get_generation()
+            res = self._find(key, field_name_list)
+            self._set_in_local_cache(key, field_name_list, res, generation)
+        return res
+
+    def _find_in_local_cache(self, key, field_name_list):
+        """
+        return None if not all fields are in local cache
+        """
+        doc_key_name = self.make_doc_key_name(key)
+        if field_name_list is None:
+            res = self._local_cache.get(doc_key_name, None, _MISSING)
+            return None if res is _MISSING else dict(res)
+
+        res = dict()
+        all_complex_field_name = self.get_all_class_var_names()
+        for field_name in field_name_list:
+            if field_name in all_complex_field_name:
+                val = self._local_cache.get(make_sub_key_name(doc_key_name, field_name), None, _MISSING)
+            else:
+                val = self._local_cache.get(doc_key_name, field_name, _MISSING)
+            if val is _MISSING:
+                return None
+            res[field_name] = val
+        return res
+
+    def _set_in_local_cache(self, key, field_name_list, res, generation):
+        """
+        generation: got before reading res, see LocalCache.get_generation
+        """
+        doc_key_name = self.make_doc_key_name(key)
+        if field_name_list is None:
+            self._local_cache.set(doc_key_name, None, dict(res), generation)
+            return
+
+        all_complex_field_name = self.get_all_class_var_names()
+        for field_name in field_name_list:
+            if field_name in all_complex_field_name:
+                self._local_cache.set(make_sub_key_name(doc_key_name, field_name), None, res[field_name], generation)
+            else:
+                self._local_cache.set(doc_key_name, field_name, res[field_name], generation)
+
+    def _find(self, key, field_name_list=None):
         res = dict()
         if field_name_list is None:
             self.make_data_in_redis()
@@ -584,13 +2008,18 @@ class CollectionBase(object):
                 return self._document_just_loaded_from_mongo
             else:
                 res = self._get_all_hashes(key)
-                for field_name in self.get_all_class_var_names():
-                    res[field_name] = getattr(self, field_name).get()
+                # touched once by make_data_in_redis, not again by every field
+                self.turn_on_already_in_redis()
+                try:
+                    for field_name in self.get_all_class_var_names():
+                        res[field_name] = getattr(self, field_name).get()
+                finally:
+                    self.turn_off_already_in_redis()
             return res
         else:
             common_field_name_list = list()
             complex_field_name_list = list()
-            self._key = make_key_name(self._col_name, key)
+            self._key = self.make_doc_key_name(key)
             self._mongo_key = key
 
             if field_name_list:
@@ -618,25 +2047,485 @@ class CollectionBase(object):
             self.turn_off_already_in_redis()
         return res
 
-    def write_back(self, key, field_name=None):
+    def find_many(self, keys, field_name_list=None):
+        """
+        batch version of find, return a list of documents in the same order as keys
+        all hits are read in one pipeline, all misses are loaded by one mongo query and filled in one pipeline
+        """
+        if self._local_cache is None:
+            return self._find_many(keys, field_name_list)
+
+        res_list = [self._find_in_local_cache(key, field_name_list) for key in keys]
+        index_list = [i for i, res in enumerate(res_list) if res is None]
+        if index_list:
+            key_list = [keys[i] for i in index_list]
+            generation = self._local_cache.get_generation()
+            for i, key, res in zip(index_list, key_list, self._find_many(key_list, field_name_list)):
+                self._set_in_local_cache(key, field_name_list, res, generation)
+                res_list[i] = res
+        return res_list
+
+    def _find_many(self, keys, field_name_list=None):
+        conn = self.redis_delegate.conn
+        all_complex_field_name = self.get_all_class_var_names()
+        if field_name_list is None:
+            complex_field_name_list = all_complex_field_name
+            common_field_name_list = None
+            need_hash = True
+        else:
+            complex_field_name_list = [_ for _ in field_name_list if _ in all_complex_field_name]
+            common_field_name_list = [_ for _ in field_name_list if _ not in all_complex_field_name]
+            need_hash = bool(common_field_name_list)
+
+        doc_key_names = [self.make_doc_key_name(key) for key in keys]
+        check_key_names = list()
+        for doc_key_name in doc_key_names:
+            check_key_names.extend(make_sub_key_name(doc_key_name, _) for _ in complex_field_name_list)
+            if need_hash:
+                check_key_names.append(doc_key_name)
+        missing_key_names = doc_key_names if self._negative_cache_ttl else []
+        exists_list = self.touch_key_names(check_key_names, missing_key_names)
+        is_missing_list = exists_list[len(check_key_names):] or [False] * len(keys)
+
+        # key -> (complex field names not in redis, whether hash not in redis)
+        missing_dict = dict()
+        per_key_num = len(complex_field_name_list) + int(need_hash)
+        instrumentation = self.redis_delegate.instrumentation
+        for i, key in enumerate(keys):
+            exists = exists_list[i * per_key_num: (i + 1) * per_key_num]
+            if instrumentation is not None:
+                incr_fill_counters(instrumentation, self._col_name, complex_field_name_list + ['_hashes'], exists)
+            field_name_not_in_redis_list = [f for f, e in zip(complex_field_name_list, exists) if not e]
+            hash_not_in_redis = need_hash and not exists[-1]
+            if not field_name_not_in_redis_list and not hash_not_in_redis:
+                continue
+            if is_missing_list[i]:
+                self._negative_cache_hits += 1
+            else:
+                missing_dict[key] = (field_name_not_in_redis_list, hash_not_in_redis)
+
+        # key -> parts of document just loaded from mongo
+        loaded_dict = dict()
+        if missing_dict:
+            mongo_col = getattr(self.redis_delegate.mongo_conn, self._col_name)
+            field_name_set = set()
+            for field_names, _ in missing_dict.values():
+                field_name_set.update(field_names)
+            projection = self._make_projection(field_name_set, any(h for _, h in missing_dict.values()))
+            if self._key_name in projection:
+                projection.pop(self._key_name)
+            else:
+                projection[self._key_name] = 1
+            start_time = time.time()
+            doc_list = list(mongo_col.find({self._key_name: {'$in': list(missing_dict)}}, projection))
+            if instrumentation is not None:
+                instrumentation.timing('mongo.find', time.time() - start_time)
+            # one transaction can't cross the slots of redis cluster
+            pipe = conn.pipeline(not self.redis_delegate.hash_tag_num)
+            for doc in doc_list:
+                key = doc.pop(self._key_name)
+                field_names, hash_not_in_redis = missing_dict[key]
+                loaded_dict[key] = self._fill_from_document(pipe, self.make_doc_key_name(key), doc, field_names, hash_not_in_redis,
+                                                            self.redis_delegate.lru_queue)
+            if self._negative_cache_ttl:
+                for key in missing_dict:
+                    if key not in loaded_dict:
+                        pipe.setex(make_missing_name(self.make_doc_key_name(key)), self._negative_cache_ttl, 1)
+            pipe.execute()
+            if instrumentation is not None:
+                instrumentation.timing('fill', time.time() - start_time)
+
+        res_list = list()
+        # (res, field_name or None for hashes, parse function)
+        to_be_read_list = list()
+        pipe = conn.pipeline(False)
+        for key, doc_key_name in zip(keys, doc_key_names):
+            res = dict()
+            res_list.append(res)
+            loaded = loaded_dict.get(key)
+            if loaded is not None and key in missing_dict and missing_dict[key][1]:
+                if common_field_name_list is None:
+                    res.update((k, v) for k, v in loaded.items() if k not in all_complex_field_name)
+                else:
+                    for field_name in common_field_name_list:
+                        res[field_name] = loaded.get(field_name)
+            elif need_hash:
+                if common_field_name_list is None:
+                    pipe.hgetall(doc_key_name)
+                    to_be_read_list.append((res, None, self.get_hashes_by_dict))
+                else:
+                    pipe.hmget(doc_key_name, common_field_name_list)
+                    to_be_read_list.append((res, None, partial(self._get_hashes_by_list, common_field_name_list)))
+
+            for field_name in complex_field_name_list:
+                if loaded is not None and field_name in loaded:
+                    res[field_name] = loaded[field_name]
+                else:
+                    field = self._get_field(field_name)
+                    field.read(pipe, make_sub_key_name(doc_key_name, field_name))
+                    to_be_read_list.append((res, field_name, field.parse))
+
+        if to_be_read_list:
+            for (res, field_name, parse), raw in zip(to_be_read_list, pipe.execute()):
+                if field_name is None:
+                    res.update(parse(raw))
+                else:
+                    res[field_name] = parse(raw)
+        return res_list
+
+    def warm_up(self, spec=None, sort=None, limit=0, batch_size=1000, max_memory=None):
+        """
+        load the documents matching spec from mongo into redis, e.g. after redis restarts, return the number of documents loaded
+        sort: pymongo sort list, e.g. [('views', -1)] loads the hottest documents first
+        limit: at most limit documents are read from mongo, 0 means no limit
+        batch_size: the documents are read and filled batch_size at a time, with one pipeline per batch
+        max_memory: stop when redis uses max_memory bytes, see RedisDelegate.get_used_memory
+        what is in redis already, may be modified, is kept, and nothing loaded is marked modified
+        """
+        conn = self.redis_delegate.conn
         mongo_col = getattr(self.redis_delegate.mongo_conn, self._col_name)
-        #conn = self.redis_delegate.conn
+        field_names = self.get_all_class_var_names()
+        projection = self._make_projection(field_names, True)
+        projection.pop(self._key_name, None)
+        cursor = mongo_col.find(spec or {}, projection).batch_size(batch_size)
+        if sort:
+            cursor = cursor.sort(sort)
+        if limit:
+            cursor = cursor.limit(limit)
+
+        num = 0
+        doc_list = list()
+        for doc in cursor:
+            doc_list.append(doc)
+            if len(doc_list) < batch_size:
+                continue
+            num += self._warm_up_docs(conn, doc_list, field_names)
+            doc_list = list()
+            if max_memory and self.redis_delegate.get_used_memory(conn) >= max_memory:
+                return num
+        if doc_list:
+            num += self._warm_up_docs(conn, doc_list, field_names)
+        return num
+
+    def _warm_up_docs(self, conn, doc_list, field_names):
+        """
+        fill the key names of doc_list not in redis, the documents being loaded by others are skipped
+        return the number of documents filled
+        """
+        doc_key_name_list = [self.make_doc_key_name(_.pop(self._key_name)) for _ in doc_list]
+        identifier = str(uuid.uuid4())
+        pipe = conn.pipeline(False)
+        for doc_key_name in doc_key_name_list:
+            # the lease first, then no one else fills it before it is checked
+            pipe.set(make_fill_lease_name(doc_key_name), identifier, px=FILL_LEASE_TIMEOUT, nx=True)
+            for field_name in field_names:
+                pipe.exists(make_sub_key_name(doc_key_name, field_name))
+            pipe.exists(doc_key_name)
+        res = pipe.execute()
+
+        num = 0
+        now = time.time()
+        lru_queue = self.redis_delegate.lru_queue
+        per_key_num = len(field_names) + 2
+        # hash tag -> lease names held
+        tag_lease_names_dict = dict()
+        try:
+            # one transaction can't cross the slots of redis cluster
+            pipe = conn.pipeline(not self.redis_delegate.hash_tag_num)
+            for i, (doc_key_name, doc) in enumerate(zip(doc_key_name_list, doc_list)):
+                replies = res[i * per_key_num: (i + 1) * per_key_num]
+                if not replies[0]:
+                    continue
+                tag_lease_names_dict.setdefault(get_hash_tag(doc_key_name), list()).append(make_fill_lease_name(doc_key_name))
+                field_name_not_in_redis_list = [f for f, e in zip(field_names, replies[1:-1]) if not e]
+                if field_name_not_in_redis_list or not replies[-1]:
+                    # not touched by touch_key_names like make_data_in_redis, so touched here to be evicted later
+                    for field_name in field_name_not_in_redis_list:
+                        lru_queue.touch(pipe, make_sub_key_name(doc_key_name, field_name), now)
+                    if not replies[-1]:
+                        lru_queue.touch(pipe, doc_key_name, now)
+                    self._fill_from_document(pipe, doc_key_name, doc, field_name_not_in_redis_list, not replies[-1], lru_queue)
+                    num += 1
+            pipe.execute()
+        finally:
+            for lease_name_list in tag_lease_names_dict.values():
+                release_fill_leases(conn, lease_name_list, identifier)
+        return num
+
+    def _get_hashes_by_list(self, common_field_name_list, values):
+        """
+        values: the reply of hmget on common_field_name_list
+        """
+        res = dict()
+        for field_name, v in zip(common_field_name_list, values):
+            if v is not None and field_name in self._none_string_key_name_dict:
+                v = self._none_string_key_name_dict[field_name](v)
+            res[field_name] = v
+        return res
+
+    def read_for_write_back(self, pipe, doc_key_name, field_name=None):
+        """
+        queue the commands reading what write_back needs into pipe, the replies are handled by make_write_back_updates
+        return the number of commands queued
+        """
         if field_name:
-            res_list = getattr(self(key), field_name).get()
-            mongo_col.update({self._key_name: key}, {"$set": {field_name: res_list}}, True)
+            return self._get_field(field_name).read_for_write_back(pipe, make_sub_key_name(doc_key_name, field_name))
         else:
-            res_dict = self._get_all_hashes(key)
-            mongo_col.update({self._key_name: key}, {"$set": res_dict}, True)
+            pipe.hgetall(doc_key_name)
+            pipe.hgetall(make_dirty_fields_name(doc_key_name))
+            pipe.hgetall(make_inc_fields_name(doc_key_name))
+            return 3
+
+    def read_whole_for_write_back(self, pipe, doc_key_name, field_name):
+        """
+        queue the commands reading the whole complex field into pipe, pipe should be transactional
+        return the number of commands queued
+        """
+        self._get_field(field_name).read_whole_for_write_back(pipe, make_sub_key_name(doc_key_name, field_name))
+        return 2
+
+    def make_write_back_updates(self, field_name, raw_list, is_whole=False):
+        """
+        raw_list: the replies of the commands queued by read_for_write_back, or read_whole_for_write_back if is_whole
+        return (list of mongo update documents, number of operations in op log replayed by them)
+            the list is None if the whole complex field is needed
+        """
+        if field_name:
+            return self._get_field(field_name).make_write_back_updates(raw_list, is_whole)
+        update = self._make_hashes_update(*raw_list)
+        return [update] if update else [], 0
+
+    def _make_hashes_update(self, hashes, dirty_fields, inc_fields):
+        """
+        return the mongo update document, or None if nothing needs to be written
+        """
+        if not dirty_fields and not inc_fields:
+            # modified before fields were recorded, write all back
+            res_dict = self.get_hashes_by_dict(hashes)
+            if res_dict:
+                return {"$set": res_dict}
+            return None
+
+        update = dict()
+        # a field deleted and then increased is in hashes too, its value is the delta
+        set_dict = dict((k, hashes[k]) for k in dirty_fields if k in hashes)
+        if set_dict:
+            update["$set"] = self.get_hashes_by_dict(set_dict)
+        unset_dict = dict((k, "") for k in dirty_fields if k not in hashes)
+        if unset_dict:
+            update["$unset"] = unset_dict
+        inc_dict = dict((k, v) for k, v in self.parse_increments(inc_fields).items() if v and k not in dirty_fields)
+        if inc_dict:
+            update["$inc"] = inc_dict
+        return update or None
+
+    def parse_increments(self, inc_fields):
+        """
+        inc_fields: the hash in redis recording the deltas of incr
+        """
+        res = dict()
+        for k, v in inc_fields.items():
+            field_type = self._none_string_key_name_dict.get(k)
+            if field_type is None:
+                field_type = int if v.lstrip('-').isdigit() else float
+            res[k] = field_type(v)
+        return res
+
+    def forget_increments(self, pipe, doc_key_name, inc_fields, current_inc_fields=None):
+        """
+        queue the commands subtracting the deltas in inc_fields written back into pipe, the increments since then are kept
+        current_inc_fields: the inc fields read in the transaction of pipe watching them,
+            the ones not increased since being written back are deleted, so hincrbyfloat never leaves a residue like 1e-16
+        """
+        inc_fields_name = make_inc_fields_name(doc_key_name)
+        current_inc_fields = current_inc_fields or dict()
+        for k, v in self.parse_increments(inc_fields).items():
+            if current_inc_fields.get(k) == inc_fields[k]:
+                pipe.hdel(inc_fields_name, k)
+            elif isinstance(v, float):
+                pipe.hincrbyfloat(inc_fields_name, k, -v)
+            elif v:
+                pipe.hincrby(inc_fields_name, k, -v)
+
+    def write_back(self, key, field_name=None):
+        key_name = self.make_doc_key_name(key)
+        if field_name:
+            key_name = make_sub_key_name(key_name, field_name)
+        self.redis_delegate.write_back_to_mongo(self.redis_delegate.conn, [key_name])
+
+def _split_replies(reply_list, reply_num_list):
+    """
+    split the replies of a pipeline by the number of commands queued for each item
+    """
+    res = list()
+    offset = 0
+    for reply_num in reply_num_list:
+        res.append(reply_list[offset: offset + reply_num])
+        offset += reply_num
+    return res
+
+class BatchConn(object):
+    """
+    redis connection used in a Batch, the modifications pending are flushed before any command, so reads see them
+    """
+    def __init__(self, batch, conn):
+        self._batch = batch
+        self._conn = conn
+
+    def __getattr__(self, attr):
+        self._batch.flush()
+        return getattr(self._conn, attr)
+
+class Batch(object):
+    """
+    unit of work of RedisDelegate.batch in one thread
+    the modifications are queued into pipe, and the marks of the key names modified are recorded once per key name,
+    they are flushed in one transaction, which is not one with hash tags for redis cluster, when the batch exits
+    or any command is sent by the collections, the mongo writes are deferred and sent after the transaction
+    if the block raises, only the modifications since the last flush are discarded
+    """
+    def __init__(self, delegate, conn):
+        self.delegate = delegate
+        self.pipe = conn.pipeline(not delegate.hash_tag_num)
+        self.conn = BatchConn(self, conn)
+        # key name modified -> (document key name, negative cache ttl)
+        self._modified_dict = OrderedDict()
+        # document key name -> {common field name: 1 set, 0 deleted}
+        self._dirty_fields_dict = dict()
+        # key names checked by make_data_in_redis in the batch
+        self._checked_key_names = set()
+        # functions writing mongo, called after the transaction
+        self._mongo_writes = list()
+        # number of with blocks entered
+        self._depth = 0
+
+    def __enter__(self):
+        self._depth += 1
+        self.delegate._local.batch = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._depth -= 1
+        if self._depth:
+            return False
+        self.delegate._local.batch = None
+        # the modifications before the last read are flushed already, the others are discarded if the block raises
+        if exc_type is None:
+            self.flush()
+        else:
+            self.pipe.reset()
+            del self._mongo_writes[:]
+        return False
+
+    def record_modify(self, key_name, doc_key_name, negative_cache_ttl, field_names=(), deleted_field_names=()):
+        """
+        see CollectionBase.record_modify
+        """
+        self.delegate.invalidate_local_cache(key_name)
+        self._modified_dict[key_name] = (doc_key_name, negative_cache_ttl)
+        if field_names or deleted_field_names:
+            dirty_fields = self._dirty_fields_dict.setdefault(doc_key_name, dict())
+            dirty_fields.update(dict.fromkeys(field_names, 1))
+            dirty_fields.update(dict.fromkeys(deleted_field_names, 0))
+
+    def is_checked(self, key_names):
+        return all(_ in self._checked_key_names for _ in key_names)
+
+    def add_checked(self, key_names):
+        self._checked_key_names.update(key_names)
+
+    def add_mongo_write(self, func):
+        """
+        call func after the modifications before it are flushed
+        """
+        self._mongo_writes.append(func)
+
+    def flush(self):
+        if not len(self.pipe) and not self._modified_dict and not self._mongo_writes:
+            return
+        pipe = self.pipe
+        delegate = self.delegate
+        now = time.time()
+        tag_key_names_dict = dict()
+        for key_name, (doc_key_name, negative_cache_ttl) in self._modified_dict.items():
+            tag_key_names_dict.setdefault(get_hash_tag(key_name), list()).append(key_name)
+            record_dirty_since(pipe, key_name, now)
+            delegate.lru_queue.touch(pipe, key_name, now, True)
+            if delegate.invalidation_channel:
+                pipe.publish(delegate.invalidation_channel, key_name)
+        for tag, key_name_list in tag_key_names_dict.items():
+            pipe.sadd(tag + KEYS_MODIFIED_SET, *key_name_list)
+        for doc_key_name in set(doc_key_name for doc_key_name, negative_cache_ttl in self._modified_dict.values() if negative_cache_ttl):
+            pipe.delete(make_missing_name(doc_key_name))
+        for doc_key_name, dirty_fields in self._dirty_fields_dict.items():
+            pipe.hmset(make_dirty_fields_name(doc_key_name), dirty_fields)
+        self._modified_dict.clear()
+        self._dirty_fields_dict.clear()
+        pipe.execute()
+        mongo_writes, self._mongo_writes = self._mongo_writes, list()
+        for func in mongo_writes:
+            func()
 
 class RedisDelegate(object):
-    """docstring for RedisDelegate"""
-    def __init__(self, redis_conn, sync_db):
-        self.conn = redis_conn
+    """
+    invalidation_channel: publish the key names modified on it for the local caches on other nodes, None means never
+    use_scripts: modify complex fields with MUTATE_SCRIPT, which is loaded once and run by EVALSHA
+    lru_queue: LruQueue recording the access of key names, LruQueue() by default, the same one should be used by all clients
+    write_back_pacer: WriteBackPacer limiting the rate of write_back_key_names, None means as fast as possible
+    instrumentation: Instrumentation receiving the metrics, None means no metrics at all
+    hash_tag_num: spread the documents over hash_tag_num hash tags for redis cluster, 0 means no hash tags,
+        the keys of one batch_write_back should have the same hash tag, use_scripts is needed for atomic modifications
+        with cluster clients whose pipelines aren't transactions, see make_hash_tag
+    """
+    def __init__(self, redis_conn, sync_db, invalidation_channel=None, use_scripts=False, lru_queue=None, hash_tag_num=0, write_back_pacer=None,
+                 instrumentation=None):
+        self._conn = redis_conn
+        # the Batch of each thread
+        self._local = threading.local()
         self.mongo_conn = sync_db
         self.col_name_list = list()
+        self.invalidation_channel = invalidation_channel
+        self.use_scripts = use_scripts
+        self.lru_queue = lru_queue or LruQueue()
+        self.hash_tag_num = hash_tag_num
+        self.hash_tags = ['{%d}' % _ for _ in xrange(hash_tag_num)] if hash_tag_num else ['']
+        self.lru_queue.hash_tags = self.hash_tags
+        self.write_back_pacer = write_back_pacer
+        self.instrumentation = instrumentation
+        self.mutate_script = redis_conn.register_script(MUTATE_SCRIPT)
+
+    def make_doc_key_name(self, col_name, key):
+        key_name = make_key_name(col_name, key)
+        if self.hash_tag_num:
+            return make_hash_tag(key_name, self.hash_tag_num) + key_name
+        return key_name
+
+    @property
+    def conn(self):
+        batch = self.get_batch()
+        return self._conn if batch is None else batch.conn
 
     def set_redis_conn(self, redis_conn):
-        self.conn = redis_conn
+        self._conn = redis_conn
+
+    def get_batch(self):
+        return getattr(self._local, 'batch', None)
+
+    def batch(self):
+        """
+        unit of work, the modifications in the with block are sent in one pipeline when it exits,
+        if it raises, the ones since the last read are discarded, the ones before it are flushed by the read already
+            with delegate.batch():
+                doc = delegate.feeds.find(1)
+                delegate.feeds(1).tags.sadd('a')
+                delegate.feeds(1).name = 'x'
+        the modifications return None, the key names checked and modified are touched once,
+        reads see the modifications by flushing them first, a batch in a batch is the outer one
+        """
+        batch = self.get_batch()
+        if batch is None:
+            batch = self._local.batch = Batch(self, self._conn)
+        return batch
 
     def set_mongo(self, sync_db):
         self.mongo_conn = sync_db
@@ -648,14 +2537,50 @@ class RedisDelegate(object):
             col_name = collection._col_name or collection.__class__.__name__
 
         if hasattr(self, col_name):
-            raise AttributeError, col_name + 'already exists'
+            raise AttributeError(col_name + 'already exists')
 
         collection.set_redis_delegate(self)
         self.__dict__[col_name] = collection
         self.col_name_list.append(col_name)
 
+    def invalidate_local_cache(self, key_name):
+        col = self.__dict__.get(get_col_name(key_name))
+        if isinstance(col, CollectionBase) and col._local_cache is not None:
+            col._local_cache.invalidate(key_name)
+
+    def record_invalidation(self, conn, key_name):
+        """
+        invalidate key_name in local cache, and publish it with conn
+        """
+        self.invalidate_local_cache(key_name)
+        if self.invalidation_channel:
+            conn.publish(self.invalidation_channel, key_name)
+
+    def start_invalidation_listener(self, channel=INVALIDATION_CHANNEL):
+        """
+        invalidate the local caches with the key names published on channel in a thread, and publish on it too
+        return the thread started
+        """
+        self.invalidation_channel = channel
+        pubsub = self.conn.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(channel)
+        # the messages before subscribing are lost
+        for col_name in self.col_name_list:
+            col = getattr(self, col_name)
+            if col._local_cache is not None:
+                col._local_cache.clear()
+
+        def listen():
+            for message in pubsub.listen():
+                if 'message' == message['type']:
+                    self.invalidate_local_cache(message['data'])
+        thread = threading.Thread(target=listen, name='rmlru-invalidation')
+        thread.daemon = True
+        thread.start()
+        return thread
+
     def parse_sub_key_name(self, sub_key_name):
-        col_name, others = sub_key_name.split(':', 2)
+        col_name, others = sub_key_name[len(get_hash_tag(sub_key_name)):].split(':', 1)
         others = others.split('.', 2)
         if 2 == len(others):
             key, field_name = others
@@ -673,7 +2598,8 @@ class RedisDelegate(object):
             try:
                 pipe.watch(lockname)
                 pre_identifier = pipe.get(lockname)
-                ismember = pipe.sismember(KEYS_MODIFIED_SET, key_name)
+                ismember = pipe.sismember(make_tagged_name(KEYS_MODIFIED_SET, key_name), key_name)
+                size = pipe.hget(make_tagged_name(KEY_SIZES, key_name), key_name)
 
                 # the lock isn't modified by other clients, otherwise just ignore it
                 if pre_identifier != identifier:
@@ -682,28 +2608,479 @@ class RedisDelegate(object):
                 else:
                     if ismember:
                         col_name, key, field_name = self.parse_sub_key_name(key_name)
-                        col = getattr(self, col_name)
-                        col._need_lock = False
-                        col.write_back(key, field_name)
-                        col._need_lock = True
+                        getattr(self, col_name).write_back(key, field_name)
                         ##print "write_back", key_name
 
                     pipe.multi()
-                    pipe.delete(key_name)
+                    pipe.delete(key_name, make_dirty_fields_name(key_name), make_inc_fields_name(key_name), make_op_log_name(key_name))
                     if ismember:
-                        pipe.srem(KEYS_MODIFIED_SET, key_name)
-                    pipe.zrem(LRU_QUEUE, key_name)
+                        pipe.srem(make_tagged_name(KEYS_MODIFIED_SET, key_name), key_name)
+                        pipe.zrem(make_tagged_name(DIRTY_SINCE, key_name), key_name)
+                    self.lru_queue.remove(pipe, key_name)
                     pipe.delete(lockname)
+                    if size:
+                        self.forget_key_size(pipe, key_name, size)
                     res = pipe.execute()
                     return True
-            except redis.exceptions.WatchError, e:
+            except redis.exceptions.WatchError as e:
                 return False
 
-    def check_overload(self, interval=5, lru_queue_num_min=10000, lru_queue_num_max=15000, scheduler_dict=None):
+    def memory_usage(self, pipe, key_name):
+        """
+        queue the command measuring the bytes of key_name into pipe
+        """
+        pipe.execute_command('MEMORY', 'USAGE', key_name, 'SAMPLES', MEMORY_USAGE_SAMPLES)
+
+    def get_used_memory(self, conn):
+        return int(conn.info('memory')['used_memory'])
+
+    def measure_key_sizes(self, conn, key_name_list):
+        """
+        measure key_name_list, and keep them in KEY_SIZES and their sum by collection in KEY_SIZES_TOTAL of their hash tags
+        return the list of bytes in the same order as key_name_list, 0 for the keys not in redis
+        """
+        if not key_name_list:
+            return []
+        pipe = conn.pipeline(False)
+        for key_name in key_name_list:
+            self.memory_usage(pipe, key_name)
+            pipe.hget(make_tagged_name(KEY_SIZES, key_name), key_name)
+        res = pipe.execute()
+        size_list = [int(_ or 0) for _ in res[::2]]
+
+        pipe = conn.pipeline(False)
+        for key_name, size, old_size in zip(key_name_list, size_list, res[1::2]):
+            if size:
+                pipe.hset(make_tagged_name(KEY_SIZES, key_name), key_name, size)
+            else:
+                pipe.hdel(make_tagged_name(KEY_SIZES, key_name), key_name)
+            delta = size - int(old_size or 0)
+            if delta:
+                pipe.hincrby(make_tagged_name(KEY_SIZES_TOTAL, key_name), get_col_name(key_name), delta)
+        pipe.execute()
+        return size_list
+
+    def forget_key_size(self, pipe, key_name, size):
+        """
+        queue the commands removing key_name of size bytes from KEY_SIZES into pipe
+        """
+        pipe.hdel(make_tagged_name(KEY_SIZES, key_name), key_name)
+        pipe.hincrby(make_tagged_name(KEY_SIZES_TOTAL, key_name), get_col_name(key_name), -int(size))
+
+    def get_collection_sizes(self, conn):
+        """
+        return {col_name: bytes} of the keys measured
+        """
+        pipe = conn.pipeline(False)
+        for tag in self.hash_tags:
+            pipe.hgetall(tag + KEY_SIZES_TOTAL)
+        col_size_dict = dict()
+        for size_dict in pipe.execute():
+            for k, v in size_dict.items():
+                col_size_dict[k] = col_size_dict.get(k, 0) + int(v)
+        return col_size_dict
+
+    def evict_by_memory(self, conn, bytes_to_free, col_name=None, batch_size=0, is_mine=None):
+        """
+        write the least recently used keys back, only the ones of col_name if given, until bytes_to_free bytes are freed
+        is_mine: only evict the key names it returns True for
+        return the bytes freed
+        """
+        freed = 0
+        start = 0
+        while freed < bytes_to_free:
+            key_name_list = self.lru_queue.get_oldest(conn, start, EVERY_ZRANGE_NUM)
+            if not key_name_list:
+                break
+            start += len(key_name_list)
+            key_name_list = [_ for _ in key_name_list if (col_name is None or get_col_name(_) == col_name) and (is_mine is None or is_mine(_))]
+            size_dict = dict()
+            for key_name, size in zip(key_name_list, self.measure_key_sizes(conn, key_name_list)):
+                if freed >= bytes_to_free:
+                    break
+                size_dict[key_name] = size
+                freed += size
+            left_key_list = self.write_back_key_names(conn, list(size_dict), batch_size)
+            freed -= sum(size_dict[_] for _ in left_key_list)
+            # the keys written back are not in the lru queue any more
+            start -= len(size_dict) - len(left_key_list)
+        if self.instrumentation is not None:
+            self.instrumentation.incr('write_back.bytes_freed', freed)
+        return freed
+
+    def write_back_to_mongo(self, conn, key_name_list):
+        """
+        write key_name_list back to mongo without removing them from redis
+        the updates are sent in rounds, the n-th round has the n-th mongo update document of every key
+        with one unordered bulk_write per collection, so the updates of one key are applied in order
+        """
+        if not key_name_list:
+            return
+        parsed_list = [self.parse_sub_key_name(_) for _ in key_name_list]
+        pipe = conn.pipeline(False)
+        doc_key_name_list = [_.split('.', 1)[0] for _ in key_name_list]
+        reply_num_list = [getattr(self, col_name).read_for_write_back(pipe, doc_key_name, field_name)
+                          for doc_key_name, (col_name, key, field_name) in zip(doc_key_name_list, parsed_list)]
+        raw_lists = _split_replies(pipe.execute(), reply_num_list)
+
+        # (list of mongo update documents, number of operations in op log replayed) of each key
+        result_list = list()
+        whole_index_list = list()
+        for i, ((col_name, key, field_name), raw_list) in enumerate(zip(parsed_list, raw_lists)):
+            result = getattr(self, col_name).make_write_back_updates(field_name, raw_list)
+            if result[0] is None:
+                whole_index_list.append(i)
+            result_list.append(result)
+
+        # large fields are streamed, the others are read at once
+        for i in list(whole_index_list):
+            col_name, key, field_name = parsed_list[i]
+            if getattr(self, col_name)._get_field(field_name).write_back_page_size:
+                op_num = self.stream_write_back(conn, key_name_list[i], col_name, key, field_name)
+                if op_num is not None:
+                    whole_index_list.remove(i)
+                    result_list[i] = ([], op_num)
+        if whole_index_list:
+            pipe = conn.pipeline()
+            reply_num_list = list()
+            for i in whole_index_list:
+                col_name, key, field_name = parsed_list[i]
+                reply_num_list.append(getattr(self, col_name).read_whole_for_write_back(pipe, doc_key_name_list[i], field_name))
+            for i, raw_list in zip(whole_index_list, _split_replies(pipe.execute(), reply_num_list)):
+                col_name, key, field_name = parsed_list[i]
+                result_list[i] = getattr(self, col_name).make_write_back_updates(field_name, raw_list, True)
+
+        round_num = max(len(update_list) for update_list, op_num in result_list)
+        for i in xrange(round_num):
+            # col_name -> list of UpdateOne
+            request_dict = dict()
+            for (col_name, key, field_name), (update_list, op_num) in zip(parsed_list, result_list):
+                if i < len(update_list):
+                    key_filter = {getattr(self, col_name)._key_name: key}
+                    request_dict.setdefault(col_name, list()).append(UpdateOne(key_filter, update_list[i], upsert=True))
+            for col_name, request_list in request_dict.items():
+                start_time = time.time()
+                getattr(self.mongo_conn, col_name).bulk_write(request_list, ordered=False)
+                latency = time.time() - start_time
+                if self.write_back_pacer is not None:
+                    self.write_back_pacer.record(latency)
+                if self.instrumentation is not None:
+                    self.instrumentation.timing('mongo.bulk_write', latency)
+
+        # the operations replayed and the deltas increased never be written again
+        pipe = conn.pipeline(False)
+        forget_list = list()
+        for key_name, (col_name, key, field_name), raw_list, (update_list, op_num) in zip(key_name_list, parsed_list, raw_lists, result_list):
+            if op_num:
+                pipe.ltrim(make_op_log_name(key_name), op_num, -1)
+            if not field_name and raw_list[2]:
+                forget_list.append((col_name, key_name, raw_list[2]))
+        pipe.execute()
+        if forget_list:
+            self.forget_increments(conn, forget_list)
+
+    def forget_increments(self, conn, forget_list):
+        """
+        forget_list: [(col_name, doc key name, inc fields written back)], they should have the same hash tag
+        forget the increments written back in a transaction watching the inc fields, see CollectionBase.forget_increments,
+        they are subtracted without watching if the inc fields keep being increased meanwhile
+        """
+        inc_fields_names = [make_inc_fields_name(key_name) for col_name, key_name, inc_fields in forget_list]
+        pipe = conn.pipeline()
+        try:
+            for i in xrange(WRITE_BACK_RETRY_NUM):
+                try:
+                    pipe.watch(*inc_fields_names)
+                    read_pipe = conn.pipeline(False)
+                    for inc_fields_name in inc_fields_names:
+                        read_pipe.hgetall(inc_fields_name)
+                    current_list = read_pipe.execute()
+                    pipe.multi()
+                    for (col_name, key_name, inc_fields), current_inc_fields in zip(forget_list, current_list):
+                        getattr(self, col_name).forget_increments(pipe, key_name, inc_fields, current_inc_fields)
+                    pipe.execute()
+                    return
+                except redis.exceptions.WatchError:
+                    continue
+        finally:
+            pipe.reset()
+        pipe = conn.pipeline(False)
+        for col_name, key_name, inc_fields in forget_list:
+            getattr(self, col_name).forget_increments(pipe, key_name, inc_fields)
+        pipe.execute()
+
+    def stream_write_back(self, conn, key_name, col_name, key, field_name):
+        """
+        write the whole complex field key_name back page by page into its staged field of the document, see make_staged_field_name,
+        then rename the staged field to it, so the whole field is never in one reply or here, and mongo never has a part of it
+        return the number of operations in its op log written back,
+            or None if it is modified while being read every time, then it should be read at once
+        """
+        collection = getattr(self, col_name)
+        field = collection._get_field(field_name)
+        mongo_col = getattr(self.mongo_conn, col_name)
+        key_filter = {collection._key_name: key}
+        staged_field_name = make_staged_field_name(field_name)
+        pipe = conn.pipeline()
+        for i in xrange(WRITE_BACK_RETRY_NUM):
+            try:
+                # the pages are one snapshot if key_name isn't modified until the op log is read
+                pipe.watch(key_name)
+                is_first = True
+                for raw in field.iter_pages(conn, key_name, field.write_back_page_size):
+                    page = field.to_mongo(field.parse(raw))
+                    if is_first:
+                        update = {"$set": {staged_field_name: page}}
+                    else:
+                        update = {field._page_update_op: {staged_field_name: {"$each": page}}}
+                    self._update_staged(mongo_col, key_filter, update)
+                    is_first = False
+                if is_first:
+                    self._update_staged(mongo_col, key_filter, {"$set": {staged_field_name: []}})
+                pipe.multi()
+                pipe.llen(make_op_log_name(key_name))
+                op_num = pipe.execute()[0]
+                self._update_staged(mongo_col, key_filter, {"$rename": {staged_field_name: field_name}})
+                return op_num
+            except redis.exceptions.WatchError as e:
+                continue
+            finally:
+                pipe.reset()
+        return None
+
+    def _update_staged(self, mongo_col, key_filter, update):
+        start_time = time.time()
+        mongo_col.update_one(key_filter, update, upsert=True)
+        latency = time.time() - start_time
+        if self.write_back_pacer is not None:
+            self.write_back_pacer.record(latency)
+        if self.instrumentation is not None:
+            self.instrumentation.timing('mongo.update', latency)
+
+    def batch_write_back(self, conn, key_name_list):
+        """
+        write key_name_list back to mongo with one unordered bulk_write per collection,
+        then remove them from redis in one transaction, so they should have the same hash tag
+        return the key names which can't be written back now
+        """
+        identifier = str(uuid.uuid4())
+        pipe = conn.pipeline(False)
+        for key_name in key_name_list:
+            pipe.set(make_lockname(key_name), identifier, ex=LOCK_TIMEOUT, nx=True)
+        claimed_list = list()
+        left_key_list = list()
+        for key_name, is_claimed in zip(key_name_list, pipe.execute()):
+            (claimed_list if is_claimed else left_key_list).append(key_name)
+
+        pipe = conn.pipeline()
+        for i in xrange(WRITE_BACK_RETRY_NUM):
+            if not claimed_list:
+                break
+            lockname_list = [make_lockname(_) for _ in claimed_list]
+            try:
+                # keys touched by others since now are written back next time
+                pipe.watch(*(lockname_list + claimed_list))
+                read_pipe = conn.pipeline(False)
+                for key_name, lockname in zip(claimed_list, lockname_list):
+                    read_pipe.get(lockname)
+                    read_pipe.sismember(make_tagged_name(KEYS_MODIFIED_SET, key_name), key_name)
+                    read_pipe.hget(make_tagged_name(KEY_SIZES, key_name), key_name)
+                values = read_pipe.execute()
+                modified_list = list()
+                size_dict = dict()
+                for key_name, pre_identifier, ismember, size in zip(list(claimed_list), values[::3], values[1::3], values[2::3]):
+                    if pre_identifier != identifier:
+                        claimed_list.remove(key_name)
+                        left_key_list.append(key_name)
+                        continue
+                    if ismember:
+                        modified_list.append(key_name)
+                    if size:
+                        size_dict[key_name] = size
+
+                self.write_back_to_mongo(conn, modified_list)
+
+                pipe.multi()
+                # the key names whose locks are taken by others are removed from claimed_list
+                for key_name in claimed_list:
+                    pipe.delete(key_name, make_dirty_fields_name(key_name), make_inc_fields_name(key_name), make_op_log_name(key_name))
+                    self.lru_queue.remove(pipe, key_name)
+                    pipe.delete(make_lockname(key_name))
+                if modified_list:
+                    pipe.srem(make_tagged_name(KEYS_MODIFIED_SET, modified_list[0]), *modified_list)
+                    pipe.zrem(make_tagged_name(DIRTY_SINCE, modified_list[0]), *modified_list)
+                for key_name, size in size_dict.items():
+                    self.forget_key_size(pipe, key_name, size)
+                pipe.execute()
+                return left_key_list
+            except redis.exceptions.WatchError as e:
+                continue
+            finally:
+                pipe.reset()
+        return left_key_list + claimed_list
+
+    def write_back_key_names(self, conn, key_name_list, batch_size=0):
+        """
+        batch_size: write back with batch_write_back in batches of batch_size, or one by one with try_write_back when 0
+        return the key names which can't be written back now
+        """
+        instrumentation = self.instrumentation
+        left_key_list = list()
+        if not batch_size:
+            for key_name in key_name_list:
+                self.pace_write_back(conn, 1)
+                start_time = time.time()
+                if not self.try_write_back(conn, key_name):
+                    left_key_list.append(key_name)
+                if instrumentation is not None:
+                    instrumentation.timing('write_back', time.time() - start_time)
+        else:
+            # the batches are by hash tag, one transaction can't cross the slots of redis cluster
+            tag_key_names_dict = OrderedDict()
+            for key_name in key_name_list:
+                tag_key_names_dict.setdefault(get_hash_tag(key_name), list()).append(key_name)
+            for tag_key_name_list in tag_key_names_dict.values():
+                for i in xrange(0, len(tag_key_name_list), batch_size):
+                    batch_key_name_list = tag_key_name_list[i: i + batch_size]
+                    self.pace_write_back(conn, len(batch_key_name_list))
+                    start_time = time.time()
+                    left_key_list.extend(self.batch_write_back(conn, batch_key_name_list))
+                    if instrumentation is not None:
+                        instrumentation.timing('write_back', time.time() - start_time)
+        if instrumentation is not None:
+            instrumentation.incr('write_back.evicted', len(key_name_list) - len(left_key_list))
+            instrumentation.incr('write_back.deferred', len(left_key_list))
+        return left_key_list
+
+    def pace_write_back(self, conn, num):
+        """
+        wait until num keys can be written back by write_back_pacer
+        """
+        pacer = self.write_back_pacer
+        if pacer is None:
+            return
+        if pacer.need_memory_check():
+            pacer.set_used_memory(self.get_used_memory(conn))
+        delay = pacer.reserve(num)
+        if delay > 0:
+            time.sleep(delay)
+
+    def checkpoint(self, conn, key_name_list):
+        """
+        write key_name_list back to mongo and clear their modified marks in one transaction, but keep them in redis
+        they should have the same hash tag
+        return True if the marks are cleared, otherwise some are modified meanwhile, and all are checkpointed again later,
+            that is safe, write_back_to_mongo has trimmed the operations and forgotten the increments it wrote before the transaction,
+            so only the ones since then are replayed, and the dirty fields are set to the same or newer values again
+        """
+        pipe = conn.pipeline()
+        try:
+            # op logs are trimmed by write_back_to_mongo, and always appended with their keys modified
+            pipe.watch(*(key_name_list + [make_dirty_fields_name(_) for _ in key_name_list]))
+            self.write_back_to_mongo(conn, key_name_list)
+            pipe.multi()
+            pipe.srem(make_tagged_name(KEYS_MODIFIED_SET, key_name_list[0]), *key_name_list)
+            pipe.zrem(make_tagged_name(DIRTY_SINCE, key_name_list[0]), *key_name_list)
+            pipe.delete(*([make_dirty_fields_name(_) for _ in key_name_list] + [make_inc_fields_name(_) for _ in key_name_list]))
+            pipe.execute()
+            return True
+        except redis.exceptions.WatchError as e:
+            # written back anyway, not old enough to be checkpointed again now, the marks are kept for the modifications since then
+            member_score_list = list()
+            for key_name in key_name_list:
+                member_score_list.extend([time.time(), key_name])
+            conn.execute_command('ZADD', make_tagged_name(DIRTY_SINCE, key_name_list[0]), 'XX', *member_score_list)
+            return False
+        finally:
+            pipe.reset()
+
+    def checkpoint_dirty_keys(self, conn, max_age, max_num, batch_size=0, is_mine=None):
+        """
+        checkpoint the key names modified more than max_age seconds ago, at most max_num of them, the oldest first
+        batch_size: checkpoint in batches of batch_size, one by one when 0, they are paced by write_back_pacer with the write backs
+        is_mine: only checkpoint the key names it returns True for
+        return the number of key names checkpointed
+        """
+        if max_num <= 0:
+            return 0
+        pipe = conn.pipeline(False)
+        for tag in self.hash_tags:
+            pipe.zrangebyscore(tag + DIRTY_SINCE, '-inf', time.time() - max_age, start=0, num=max_num, withscores=True)
+        key_name_list = [_ for _ in merge_queue_replies(pipe.execute(), 0, max_num) if is_mine is None or is_mine(_)]
+
+        tag_key_names_dict = OrderedDict()
+        for key_name in key_name_list:
+            tag_key_names_dict.setdefault(get_hash_tag(key_name), list()).append(key_name)
+        batch_size = batch_size or 1
+        num = 0
+        for tag_key_name_list in tag_key_names_dict.values():
+            for i in xrange(0, len(tag_key_name_list), batch_size):
+                batch_key_name_list = tag_key_name_list[i: i + batch_size]
+                self.pace_write_back(conn, len(batch_key_name_list))
+                if self.checkpoint(conn, batch_key_name_list):
+                    num += len(batch_key_name_list)
+        return num
+
+    def run_write_back_workers(self, worker_num, **kwargs):
+        """
+        run worker_num check_overload loops in threads, each one owns a disjoint partition of keys
+        kwargs: passed to check_overload
+        to run workers in processes, call check_overload(partition=(i, worker_num)) in each of them instead
+        return the list of started threads
+        """
+        thread_list = list()
+        for i in xrange(worker_num):
+            worker_kwargs = dict(kwargs, partition=(i, worker_num))
+            thread = threading.Thread(target=self.check_overload, kwargs=worker_kwargs, name='rmlru-write-back-%d' % i)
+            thread.daemon = True
+            thread.start()
+            thread_list.append(thread)
+        return thread_list
+
+    def check_memory_budget(self, conn, since, max_memory=None, col_max_memory_dict=None, batch_size=0, is_mine=None, share=1):
+        """
+        evict the least recently used keys when redis uses max_memory bytes or more,
+        and the ones of each collection in col_max_memory_dict when its keys measured are more than its bytes,
+        until they are below MEMORY_LOW_WATERMARK of the budget
+        since: the keys of the collections in col_max_memory_dict touched since it are measured first
+        share: the fraction of the bytes to free evicted by this worker
+        return True if redis still uses more than MEMORY_LOW_WATERMARK of max_memory
+        """
+        if col_max_memory_dict:
+            offset = 0
+            while True:
+                key_name_list = self.lru_queue.get_touched_since(conn, since, offset, EVERY_ZRANGE_NUM)
+                if not key_name_list:
+                    break
+                offset += len(key_name_list)
+                self.measure_key_sizes(conn, [_ for _ in key_name_list if get_col_name(_) in col_max_memory_dict and (is_mine is None or is_mine(_))])
+            col_size_dict = self.get_collection_sizes(conn)
+            for col_name, col_max_memory in col_max_memory_dict.items():
+                col_size = col_size_dict.get(col_name, 0)
+                if col_size > col_max_memory:
+                    self.evict_by_memory(conn, (col_size - col_max_memory * MEMORY_LOW_WATERMARK) * share, col_name, batch_size, is_mine)
+
+        if not max_memory:
+            return False
+        used_memory = self.get_used_memory(conn)
+        if used_memory >= max_memory:
+            self.evict_by_memory(conn, (used_memory - max_memory * MEMORY_LOW_WATERMARK) * share, None, batch_size, is_mine)
+            used_memory = self.get_used_memory(conn)
+        return used_memory > max_memory * MEMORY_LOW_WATERMARK
+
+    def check_overload(self, interval=5, lru_queue_num_min=10000, lru_queue_num_max=15000, scheduler_dict=None, batch_size=0, partition=None,
+                       max_memory=None, col_max_memory_dict=None, checkpoint_age=None, checkpoint_rate=100):
         """
         scheduler_dict: time we want to write back certain collection to mongo, for example {time: col_name_list}
             when empty, it means all!
             the format of time: [hour]:[minite], such as '3:10'
+        batch_size: write back keys in batches of batch_size with bulk_write, 0 means one by one
+        partition: (index, partition_num), only write back the keys in partition index, see key_partition
+        max_memory, col_max_memory_dict: evict by the bytes of redis and of each collection instead of lru_queue_num_min and lru_queue_num_max,
+            see check_memory_budget
+        checkpoint_age: checkpoint the keys modified more than checkpoint_age seconds ago, see checkpoint_dirty_keys, None means never
+        checkpoint_rate: max number of keys checkpointed per second by all workers, the ones of one round are spread by write_back_pacer,
+            without it they are checkpointed at once
         """
         from datetime import date, datetime, time as nomal_time
         for col_name in self.col_name_list:
@@ -716,26 +3093,38 @@ class RedisDelegate(object):
         scheduler_list_index = 0
 
         if scheduler_dict:
-            for k, v in scheduler_dict.iteritems():
-                sche_time = map(int, k.split(':'))
+            for k, v in scheduler_dict.items():
+                sche_time = [int(_) for _ in k.split(':')]
                 sche_time = nomal_time(*sche_time)
                 scheduler_list.append((sche_time, v))
             scheduler_list = sorted(scheduler_list, key=lambda x: x[0])
 
+        if partition:
+            partition_index, partition_num = partition
+            is_mine = lambda key_name: key_partition(key_name, partition_num) == partition_index
+        else:
+            partition_num = 1
+            is_mine = lambda key_name: True
+        measure_since = 0
+        checkpoint_time = time.time() - interval
+
         half_interval = interval / 2
         while True:
+            cycle_start_time = time.time()
             conn = self.conn
+            self.lru_queue.maintain(conn)
             now = datetime.now().time()
             if scheduler_list and last_write_all_back_day < date.today() and now >= scheduler_list[scheduler_list_index][0]:
                 col_name_list = scheduler_list[scheduler_list_index][1]
-                to_be_writeback_list = conn.zrange(LRU_QUEUE, len(left_key_list), EVERY_ZRANGE_NUM + len(left_key_list))
+                # the key names skipped or left stay at the head of the queue, so read from after them
+                offset = len(left_key_list)
+                to_be_writeback_list = self.lru_queue.get_oldest(conn, offset, EVERY_ZRANGE_NUM + 1)
                 while to_be_writeback_list:
-                    for key_name in to_be_writeback_list:
-                        if key_name.split(':', 1)[0] in col_name_list:
-                            isSuccess = self.try_write_back(conn, key_name)
-                            if not isSuccess:
-                                left_key_list.append(key_name)
-                    to_be_writeback_list = conn.zrange(LRU_QUEUE, len(left_key_list), EVERY_ZRANGE_NUM + len(left_key_list))
+                    mine_list = [_ for _ in to_be_writeback_list if get_col_name(_) in col_name_list and is_mine(_)]
+                    mine_left_list = self.write_back_key_names(conn, mine_list, batch_size)
+                    left_key_list.extend(mine_left_list)
+                    offset += len(to_be_writeback_list) - len(mine_list) + len(mine_left_list)
+                    to_be_writeback_list = self.lru_queue.get_oldest(conn, offset, EVERY_ZRANGE_NUM + 1)
                     scheduler_list_index += 1
                     if scheduler_list_index == len(scheduler_list):
                         scheduler_list_index = 0
@@ -743,18 +3132,35 @@ class RedisDelegate(object):
 
             # try left_key_list again
             if left_key_list:
-                for i, key_name in enumerate(left_key_list):
-                    isSuccess = self.try_write_back(conn, key_name)
-                    if isSuccess:
-                        del left_key_list[i]
-
-            num = conn.zcard(LRU_QUEUE)
+                if self.instrumentation is not None:
+                    self.instrumentation.incr('check_overload.retried', len(left_key_list))
+                left_key_list = self.write_back_key_names(conn, left_key_list, batch_size)
+
+            if checkpoint_age is not None:
+                now_time = time.time()
+                # every worker gets about its partition of them
+                self.checkpoint_dirty_keys(conn, checkpoint_age, int(checkpoint_rate * (now_time - checkpoint_time)), batch_size, is_mine)
+                checkpoint_time = now_time
+
+            if max_memory or col_max_memory_dict:
+                now_time = time.time()
+                is_busy = self.check_memory_budget(conn, measure_since, max_memory, col_max_memory_dict, batch_size, is_mine, 1.0 / partition_num)
+                measure_since = now_time
+                self._timing('check_overload.cycle', cycle_start_time)
+                time.sleep(half_interval if is_busy else interval)
+                continue
+
+            num = self.lru_queue.count(conn)
             if num >= lru_queue_num_max:
                 rm_num = num - lru_queue_num_min
-                to_be_writeback_list = conn.zrange(LRU_QUEUE, 0, rm_num)
-                for key_name in to_be_writeback_list:
-                    self.try_write_back(conn, key_name)
-            elif num >= lru_queue_num_min:
+                to_be_writeback_list = [_ for _ in self.lru_queue.get_oldest(conn, 0, rm_num + 1) if is_mine(_)]
+                self.write_back_key_names(conn, to_be_writeback_list, batch_size)
+            self._timing('check_overload.cycle', cycle_start_time)
+            if lru_queue_num_min <= num < lru_queue_num_max:
                 time.sleep(half_interval)
-            else:
+            elif num < lru_queue_num_min:
                 time.sleep(interval)
+
+    def _timing(self, name, start_time):
+        if self.instrumentation is not None:
+            self.instrumentation.timing(name, time.time() - start_time)
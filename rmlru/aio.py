@@ -0,0 +1,692 @@
+# -*- coding: utf-8 -*-
+
+"""
+asyncio API on redis.asyncio and motor, python 3 only
+
+it shares the collection classes and the data structures in redis with the blocking API, so both work on the same data
+the redis client should be created with decode_responses=True, DictField only works with its default json codec here
+unlike the collections of the blocking API, nothing of one document is kept between calls, so calls can run concurrently
+
+    delegate = AsyncRedisDelegate(redis.asyncio.Redis(decode_responses=True), motor_client.test)
+    delegate.add_collection(Tags())
+    doc = await delegate.tags.find(1)
+    await delegate.tags(1).file_ids.sadd('1')
+    asyncio.ensure_future(delegate.check_overload())
+"""
+
+import time
+import uuid
+import asyncio
+from collections import OrderedDict
+
+import redis
+from pymongo import UpdateOne
+
+from rmlru import (KEYS_MODIFIED_SET, DIRTY_SINCE, KEY_SIZES, KEY_SIZES_TOTAL, LOCK_TIMEOUT, WRITE_BACK_RETRY_NUM, FILL_LEASE_TIMEOUT, FILL_POLL_INTERVAL,
+                   make_lockname, make_dirty_fields_name, make_inc_fields_name, make_op_log_name, make_missing_name, make_fill_lease_name,
+                   make_key_name, make_sub_key_name, make_hash_tag, get_hash_tag, make_tagged_name, get_col_name, record_dirty_since,
+                   incr_fill_counters, zadd_scores, QueueMerger, _split_replies, SetField, ListField, ZsetField, LruQueue)
+
+async def release_fill_leases(conn, lease_names, identifier):
+    """
+    see rmlru.release_fill_leases
+    """
+    async with conn.pipeline() as pipe:
+        try:
+            await pipe.watch(*lease_names)
+            held_list = [name for name, value in zip(lease_names, await pipe.mget(lease_names)) if value == identifier]
+            if held_list:
+                pipe.multi()
+                pipe.delete(*held_list)
+                await pipe.execute()
+        except redis.exceptions.WatchError:
+            pass
+
+class LegacyPipeline(object):
+    """
+    queue the commands of the blocking API into a redis.asyncio pipeline,
+    the blocking API sends zadd and zincrby as raw commands, only hmset, deprecated since redis-py 3.5, is left to adapt
+    """
+    def __init__(self, pipe):
+        self._pipe = pipe
+
+    def __getattr__(self, attr):
+        return getattr(self._pipe, attr)
+
+    def hmset(self, name, mapping):
+        return self._pipe.hset(name, mapping=mapping)
+
+class AsyncComplexField(object):
+    """
+    complex field of one document, see ComplexField
+    """
+    def __init__(self, doc, field):
+        self.doc = doc
+        self.field = field
+        self.key_name = make_sub_key_name(doc.key_name, field.field_name)
+
+    async def _read(self, command, *args, **kwargs):
+        await self.doc.make_data_in_redis([self.field.field_name])
+        start_time = time.time()
+        res = await getattr(self.doc.delegate.conn, command)(self.key_name, *args, **kwargs)
+        self.doc.delegate._timing('field.' + command, start_time)
+        return res
+
+    async def _modify(self, op_name, op_args, command, *args):
+        """
+        record the operation and apply command on the field in one transaction
+        """
+        await self.doc.make_data_in_redis([self.field.field_name])
+        start_time = time.time()
+        pipe = LegacyPipeline(self.doc.delegate.conn.pipeline())
+        self.doc.record_modify(pipe, self.key_name)
+        if self.field.log_ops:
+            self.field.record_op(pipe, self.key_name, op_name, *op_args)
+        pipe.execute_command(command.upper(), self.key_name, *args)
+        res = (await pipe.execute())[-1]
+        self.doc.delegate._timing('field.' + command, start_time)
+        return res
+
+    async def get(self):
+        await self.doc.make_data_in_redis([self.field.field_name])
+        pipe = self.doc.delegate.conn.pipeline(False)
+        self.field.read(pipe, self.key_name)
+        return self.field.parse((await pipe.execute())[0])
+
+    async def set(self, val):
+        await self.doc.update({self.field.field_name: val})
+
+class AsyncSetField(AsyncComplexField):
+    async def scard(self):
+        return await self._read('scard')
+
+    async def sadd(self, *values):
+        return await self._modify('sadd', (values, ), 'sadd', *self.field._handle_members_list(values))
+
+    async def sismember(self, val):
+        return await self._read('sismember', self.field._handle_one_member(val))
+
+    async def smembers(self):
+        return set(await self._read('smembers'))
+
+    async def srem(self, *values):
+        return await self._modify('srem', (values, ), 'srem', *self.field._handle_members_list(values))
+
+class AsyncListField(AsyncComplexField):
+    async def lrem(self, count, val):
+        return await self._modify('set', (), 'lrem', count, self.field._handle_one_member(val))
+
+    async def ltrim(self, start, end):
+        return await self._modify('ltrim', (start, end), 'ltrim', start, end)
+
+    async def llen(self):
+        return await self._read('llen')
+
+    async def lindex(self, index):
+        return self.field._handle_one_member(await self._read('lindex', index), False)
+
+    async def lpop(self):
+        return await self._modify('lpop', (), 'lpop')
+
+    async def rpush(self, *values):
+        if values:
+            return await self._modify('rpush', (values, ), 'rpush', *self.field._handle_members_list(values))
+
+    async def lrange(self, start, end):
+        return self.field.parse(await self._read('lrange', start, end))
+
+class AsyncZsetField(AsyncComplexField):
+    async def zcard(self):
+        return await self._read('zcard')
+
+    async def zadd(self, *values, **kwargs):
+        """
+        values: score1, member1, score2, member2..., kwargs: member=score, the same as ZsetField.zadd
+        """
+        await self.doc.make_data_in_redis([self.field.field_name])
+        pipe = LegacyPipeline(self.doc.delegate.conn.pipeline())
+        self.doc.record_modify(pipe, self.key_name)
+        if self.field.log_ops:
+            self.field.record_op(pipe, self.key_name, 'zadd', values, kwargs)
+        score_members = list(self.field._handle_members_list(values))
+        for member, score in kwargs.items():
+            score_members.extend([score, member])
+        zadd_scores(pipe, self.key_name, *score_members)
+        return (await pipe.execute())[-1]
+
+    async def zscore(self, member):
+        score = await self._read('zscore', member)
+        if score and self.field.score_type is not float:
+            score = self.field.score_type(score)
+        return score
+
+    async def zrem(self, *values):
+        return await self._modify('zrem', (values, ), 'zrem', *self.field._handle_members_list(values))
+
+    async def zrange(self, start, end):
+        values = await self._read('zrange', start, end, withscores=True, score_cast_func=self.field.score_type)
+        return self.field.parse(values)
+
+ASYNC_FIELD_CLASS_LIST = [(SetField, AsyncSetField), (ListField, AsyncListField), (ZsetField, AsyncZsetField)]
+
+class AsyncDocument(object):
+    """
+    one document of AsyncCollection, complex fields are got as attributes, common fields with get and set
+    """
+    def __init__(self, col, key):
+        self.col = col
+        self.delegate = col.delegate
+        self.schema = col.schema
+        self.key = key
+        self.key_name = self.delegate.make_doc_key_name(self.schema._col_name, key)
+
+    def __getattr__(self, attr):
+        if attr in self.schema.get_all_class_var_names():
+            field = self.schema._get_field(attr)
+            for field_class, async_field_class in ASYNC_FIELD_CLASS_LIST:
+                if isinstance(field, field_class):
+                    return async_field_class(self, field)
+        raise AttributeError(attr)
+
+    def record_modify(self, pipe, key_name, field_names=(), deleted_field_names=()):
+        """
+        queue the commands recording key_name is modified into pipe
+        field_names, deleted_field_names: common field names set and deleted, see CollectionBase.record_modify
+        """
+        now = time.time()
+        pipe.sadd(make_tagged_name(KEYS_MODIFIED_SET, key_name), key_name)
+        record_dirty_since(pipe, key_name, now)
+        self.delegate.lru_queue.touch(pipe, key_name, now, True)
+        dirty_fields = dict.fromkeys(field_names, 1)
+        dirty_fields.update(dict.fromkeys(deleted_field_names, 0))
+        if dirty_fields:
+            pipe.hmset(make_dirty_fields_name(key_name), dirty_fields)
+        if self.schema._negative_cache_ttl:
+            pipe.delete(make_missing_name(self.key_name))
+        if self.delegate.invalidation_channel:
+            pipe.publish(self.delegate.invalidation_channel, key_name)
+
+    async def make_data_in_redis(self, field_names=(), need_hash=False):
+        """
+        load complex fields in field_names and common fields if need_hash from mongo when they are not in redis
+        see CollectionBase.make_data_in_redis
+        """
+        schema = self.schema
+        conn = self.delegate.conn
+        check_key_names = [make_sub_key_name(self.key_name, _) for _ in field_names]
+        if need_hash:
+            check_key_names.append(self.key_name)
+        if not check_key_names:
+            return
+
+        pipe = LegacyPipeline(conn.pipeline(False))
+        identifier = str(uuid.uuid4())
+        now = time.time()
+        for key_name in check_key_names:
+            pipe.set(make_lockname(key_name), identifier, ex=LOCK_TIMEOUT)
+            pipe.exists(key_name)
+        if schema._negative_cache_ttl:
+            pipe.exists(make_missing_name(self.key_name))
+        for key_name in check_key_names:
+            self.delegate.lru_queue.touch(pipe, key_name, now)
+        res = await pipe.execute()
+        exists_list = res[1:2 * len(check_key_names):2]
+        if self.delegate.instrumentation is not None:
+            incr_fill_counters(self.delegate.instrumentation, schema._col_name, list(field_names) + ['_hashes'], exists_list)
+        if all(exists_list):
+            return
+        if schema._negative_cache_ttl and res[2 * len(check_key_names)]:
+            schema._negative_cache_hits += 1
+            return
+
+        field_name_not_in_redis_list = [f for f, e in zip(field_names, exists_list) if not e]
+        need_hash = need_hash and not exists_list[-1]
+        waiting_key_names = [k for k, e in zip(check_key_names, exists_list) if not e]
+
+        # only one client loads the document, the others wait for it
+        lease_name = make_fill_lease_name(self.key_name)
+        identifier = str(uuid.uuid4())
+        is_leased = await conn.set(lease_name, identifier, px=FILL_LEASE_TIMEOUT, nx=True)
+        if not is_leased:
+            if await self._wait_for_fill(lease_name, waiting_key_names):
+                return
+
+        try:
+            mongo_col = getattr(self.delegate.mongo_conn, schema._col_name)
+            projection = schema._make_projection(field_name_not_in_redis_list, need_hash)
+            start_time = time.time()
+            doc = await mongo_col.find_one({schema._key_name: self.key}, projection)
+            self.delegate._timing('mongo.find_one', start_time)
+            pipe = LegacyPipeline(conn.pipeline())
+            if doc:
+                schema._fill_from_document(pipe, self.key_name, doc, field_name_not_in_redis_list, need_hash, self.delegate.lru_queue)
+            elif doc is None and schema._negative_cache_ttl:
+                pipe.setex(make_missing_name(self.key_name), schema._negative_cache_ttl, 1)
+            await pipe.execute()
+            self.delegate._timing('fill', start_time)
+        finally:
+            # a waiter timed out doesn't hold the lease
+            if is_leased:
+                await release_fill_leases(conn, [lease_name], identifier)
+
+    async def _wait_for_fill(self, lease_name, key_names):
+        """
+        see CollectionBase._wait_for_fill
+        """
+        deadline = time.time() + FILL_LEASE_TIMEOUT / 1000.0
+        while True:
+            pipe = self.delegate.conn.pipeline(False)
+            pipe.exists(lease_name)
+            for key_name in key_names:
+                pipe.exists(key_name)
+            res = await pipe.execute()
+            if all(res[1:]):
+                return True
+            if not res[0] or time.time() > deadline:
+                return False
+            await asyncio.sleep(FILL_POLL_INTERVAL)
+
+    async def find(self, field_name_list=None):
+        """
+        see CollectionBase.find
+        """
+        schema = self.schema
+        all_complex_field_name = schema.get_all_class_var_names()
+        if field_name_list is None:
+            complex_field_name_list = all_complex_field_name
+            common_field_name_list = None
+            need_hash = True
+        else:
+            complex_field_name_list = [_ for _ in field_name_list if _ in all_complex_field_name]
+            common_field_name_list = [_ for _ in field_name_list if _ not in all_complex_field_name]
+            need_hash = bool(common_field_name_list)
+        await self.make_data_in_redis(complex_field_name_list, need_hash)
+
+        pipe = self.delegate.conn.pipeline(False)
+        if common_field_name_list is None:
+            pipe.hgetall(self.key_name)
+        elif common_field_name_list:
+            pipe.hmget(self.key_name, *common_field_name_list)
+        for field_name in complex_field_name_list:
+            schema._get_field(field_name).read(pipe, make_sub_key_name(self.key_name, field_name))
+        values = await pipe.execute()
+
+        if common_field_name_list is None:
+            res = schema.get_hashes_by_dict(values.pop(0))
+        elif common_field_name_list:
+            res = schema._get_hashes_by_list(common_field_name_list, values.pop(0))
+        else:
+            res = dict()
+        for field_name, raw in zip(complex_field_name_list, values):
+            res[field_name] = schema._get_field(field_name).parse(raw)
+        return res
+
+    async def get(self, field_name):
+        """
+        get one common field
+        """
+        return (await self.find([field_name]))[field_name]
+
+    async def set(self, field_name, value):
+        """
+        set one common field, None means deleting it, see CollectionBase.__setattr__
+        """
+        if value is not None:
+            await self.update({field_name: value})
+            return
+        pipe = LegacyPipeline(self.delegate.conn.pipeline())
+        pipe.hdel(self.key_name, field_name)
+        pipe.hdel(make_dirty_fields_name(self.key_name), field_name)
+        if self.schema._negative_cache_ttl:
+            pipe.delete(make_missing_name(self.key_name))
+        if self.delegate.invalidation_channel:
+            pipe.publish(self.delegate.invalidation_channel, self.key_name)
+        await pipe.execute()
+        mongo_col = getattr(self.delegate.mongo_conn, self.schema._col_name)
+        await mongo_col.update_one({self.schema._key_name: self.key}, {"$set": {field_name: None}}, upsert=True)
+
+    async def update(self, doc_dict):
+        """
+        see CollectionBase.update, all fields are set in one transaction
+        """
+        schema = self.schema
+        all_complex_field_name = schema.get_all_class_var_names()
+        complex_field_name_list = [_ for _ in doc_dict if _ in all_complex_field_name]
+        common_dict = dict((k, v) for k, v in doc_dict.items() if k not in all_complex_field_name)
+        await self.make_data_in_redis(complex_field_name_list, bool(common_dict))
+
+        pipe = LegacyPipeline(self.delegate.conn.pipeline())
+        for field_name in complex_field_name_list:
+            field = schema._get_field(field_name)
+            sub_key_name = make_sub_key_name(self.key_name, field_name)
+            self.record_modify(pipe, sub_key_name)
+            if field.log_ops:
+                field.record_op(pipe, sub_key_name, 'set')
+            field.fill(pipe, sub_key_name, doc_dict[field_name])
+        if common_dict:
+            deleted_field_names = [k for k, v in common_dict.items() if v is None]
+            set_dict = dict((k, v) for k, v in common_dict.items() if v is not None)
+            if deleted_field_names:
+                pipe.hdel(self.key_name, *deleted_field_names)
+            if set_dict:
+                pipe.hmset(self.key_name, set_dict)
+            self.record_modify(pipe, self.key_name, set_dict, deleted_field_names)
+        await pipe.execute()
+
+    async def incr(self, field_name, amount=1):
+        """
+        see CollectionBase.incr
+        """
+        return await self._incr('hincrby', field_name, amount)
+
+    async def incrbyfloat(self, field_name, amount=1.0):
+        """
+        see CollectionBase.incr
+        """
+        return await self._incr('hincrbyfloat', field_name, amount)
+
+    async def _incr(self, command, field_name, amount):
+        await self.make_data_in_redis(need_hash=True)
+        pipe = LegacyPipeline(self.delegate.conn.pipeline())
+        getattr(pipe, command)(self.key_name, field_name, amount)
+        getattr(pipe, command)(make_inc_fields_name(self.key_name), field_name, amount)
+        self.record_modify(pipe, self.key_name)
+        return (await pipe.execute())[0]
+
+class AsyncCollection(object):
+    """
+    collection of AsyncRedisDelegate, schema: the CollectionBase instance defining it
+    """
+    def __init__(self, delegate, schema):
+        self.delegate = delegate
+        self.schema = schema
+
+    def __call__(self, key):
+        return AsyncDocument(self, key)
+
+    async def find(self, key, field_name_list=None):
+        return await self(key).find(field_name_list)
+
+    async def find_many(self, keys, field_name_list=None):
+        """
+        find keys concurrently, return a list of documents in the same order as keys
+        """
+        return list(await asyncio.gather(*[self.find(_, field_name_list) for _ in keys]))
+
+    async def update(self, key, doc_dict):
+        await self(key).update(doc_dict)
+
+    async def write_back(self, key, field_name=None):
+        key_name = self.delegate.make_doc_key_name(self.schema._col_name, key)
+        if field_name:
+            key_name = make_sub_key_name(key_name, field_name)
+        await self.delegate.write_back_to_mongo([key_name])
+
+class AsyncRedisDelegate(object):
+    """
+    redis_conn: redis.asyncio.Redis created with decode_responses=True
+    sync_db: motor database
+    invalidation_channel: see RedisDelegate, the local caches of the blocking API are invalidated by the messages
+    lru_queue: LruQueue, the same as the one of RedisDelegate on the same data, only the policies ordering by LRU_QUEUE alone are supported,
+        LruQueue and ApproxLruQueue, LfuQueue and SegmentedLruQueue need maintain, which is blocking
+    hash_tag_num: the same as the one of RedisDelegate on the same data
+    write_back_pacer: WriteBackPacer, see RedisDelegate
+    instrumentation: Instrumentation, see RedisDelegate, the spans of complex fields are named by the redis commands
+    """
+    def __init__(self, redis_conn, sync_db, invalidation_channel=None, lru_queue=None, hash_tag_num=0, write_back_pacer=None,
+                 instrumentation=None):
+        self.conn = redis_conn
+        self.mongo_conn = sync_db
+        self.col_name_list = list()
+        self.invalidation_channel = invalidation_channel
+        self.lru_queue = lru_queue or LruQueue()
+        queue_class = type(self.lru_queue)
+        if queue_class.maintain is not LruQueue.maintain or queue_class.get_oldest is not LruQueue.get_oldest:
+            raise ValueError(queue_class.__name__ + ' not supported, its maintain or get_oldest is blocking')
+        self.hash_tag_num = hash_tag_num
+        self.hash_tags = ['{%d}' % _ for _ in range(hash_tag_num)] if hash_tag_num else ['']
+        self.lru_queue.hash_tags = self.hash_tags
+        self.write_back_pacer = write_back_pacer
+        self.instrumentation = instrumentation
+
+    def make_doc_key_name(self, col_name, key):
+        key_name = make_key_name(col_name, key)
+        if self.hash_tag_num:
+            return make_hash_tag(key_name, self.hash_tag_num) + key_name
+        return key_name
+
+    def add_collection(self, collection, col_name=None):
+        """
+        collection: instance of the same CollectionBase subclass added to RedisDelegate
+        """
+        col_name = col_name or collection._col_name or collection.__class__.__name__
+        if hasattr(self, col_name):
+            raise AttributeError(col_name + 'already exists')
+        self.__dict__[col_name] = AsyncCollection(self, collection)
+        self.col_name_list.append(col_name)
+
+    def parse_sub_key_name(self, sub_key_name):
+        """
+        see RedisDelegate.parse_sub_key_name
+        """
+        col_name, others = sub_key_name[len(get_hash_tag(sub_key_name)):].split(':', 1)
+        others = others.split('.', 1)
+        key = getattr(self, col_name).schema._key_type(others[0])
+        field_name = others[1] if 2 == len(others) else ""
+        return col_name, key, field_name
+
+    async def write_back_to_mongo(self, key_name_list):
+        """
+        write key_name_list back to mongo without removing them from redis, see RedisDelegate.write_back_to_mongo
+        """
+        if not key_name_list:
+            return
+        parsed_list = [self.parse_sub_key_name(_) for _ in key_name_list]
+        pipe = LegacyPipeline(self.conn.pipeline(False))
+        doc_key_name_list = [_.split('.', 1)[0] for _ in key_name_list]
+        reply_num_list = [getattr(self, col_name).schema.read_for_write_back(pipe, doc_key_name, field_name)
+                          for doc_key_name, (col_name, key, field_name) in zip(doc_key_name_list, parsed_list)]
+        raw_lists = _split_replies(await pipe.execute(), reply_num_list)
+
+        result_list = list()
+        whole_index_list = list()
+        for i, ((col_name, key, field_name), raw_list) in enumerate(zip(parsed_list, raw_lists)):
+            result = getattr(self, col_name).schema.make_write_back_updates(field_name, raw_list)
+            if result[0] is None:
+                whole_index_list.append(i)
+            result_list.append(result)
+
+        if whole_index_list:
+            pipe = LegacyPipeline(self.conn.pipeline())
+            reply_num_list = list()
+            for i in whole_index_list:
+                col_name, key, field_name = parsed_list[i]
+                reply_num_list.append(getattr(self, col_name).schema.read_whole_for_write_back(pipe, doc_key_name_list[i], field_name))
+            for i, raw_list in zip(whole_index_list, _split_replies(await pipe.execute(), reply_num_list)):
+                col_name, key, field_name = parsed_list[i]
+                result_list[i] = getattr(self, col_name).schema.make_write_back_updates(field_name, raw_list, True)
+
+        round_num = max(len(update_list) for update_list, op_num in result_list)
+        for i in range(round_num):
+            request_dict = dict()
+            for (col_name, key, field_name), (update_list, op_num) in zip(parsed_list, result_list):
+                if i < len(update_list):
+                    key_filter = {getattr(self, col_name).schema._key_name: key}
+                    request_dict.setdefault(col_name, list()).append(UpdateOne(key_filter, update_list[i], upsert=True))
+            start_time = time.time()
+            await asyncio.gather(*[getattr(self.mongo_conn, col_name).bulk_write(request_list, ordered=False)
+                                   for col_name, request_list in request_dict.items()])
+            if self.write_back_pacer is not None:
+                self.write_back_pacer.record(time.time() - start_time)
+            self._timing('mongo.bulk_write', start_time)
+
+        pipe = self.conn.pipeline(False)
+        forget_list = list()
+        for key_name, (col_name, key, field_name), raw_list, (update_list, op_num) in zip(key_name_list, parsed_list, raw_lists, result_list):
+            if op_num:
+                pipe.ltrim(make_op_log_name(key_name), op_num, -1)
+            if not field_name and raw_list[2]:
+                forget_list.append((col_name, key_name, raw_list[2]))
+        await pipe.execute()
+        if forget_list:
+            await self.forget_increments(forget_list)
+
+    async def forget_increments(self, forget_list):
+        """
+        see RedisDelegate.forget_increments
+        """
+        inc_fields_names = [make_inc_fields_name(key_name) for col_name, key_name, inc_fields in forget_list]
+        for i in range(WRITE_BACK_RETRY_NUM):
+            async with self.conn.pipeline() as pipe:
+                try:
+                    await pipe.watch(*inc_fields_names)
+                    read_pipe = self.conn.pipeline(False)
+                    for inc_fields_name in inc_fields_names:
+                        read_pipe.hgetall(inc_fields_name)
+                    current_list = await read_pipe.execute()
+                    pipe.multi()
+                    for (col_name, key_name, inc_fields), current_inc_fields in zip(forget_list, current_list):
+                        getattr(self, col_name).schema.forget_increments(pipe, key_name, inc_fields, current_inc_fields)
+                    await pipe.execute()
+                    return
+                except redis.exceptions.WatchError:
+                    continue
+        pipe = self.conn.pipeline(False)
+        for col_name, key_name, inc_fields in forget_list:
+            getattr(self, col_name).schema.forget_increments(pipe, key_name, inc_fields)
+        await pipe.execute()
+
+    async def batch_write_back(self, key_name_list):
+        """
+        write key_name_list back to mongo and remove them from redis, see RedisDelegate.batch_write_back
+        return the key names which can't be written back now
+        """
+        identifier = str(uuid.uuid4())
+        pipe = self.conn.pipeline(False)
+        for key_name in key_name_list:
+            pipe.set(make_lockname(key_name), identifier, ex=LOCK_TIMEOUT, nx=True)
+        claimed_list = list()
+        left_key_list = list()
+        for key_name, is_claimed in zip(key_name_list, await pipe.execute()):
+            (claimed_list if is_claimed else left_key_list).append(key_name)
+
+        for i in range(WRITE_BACK_RETRY_NUM):
+            if not claimed_list:
+                break
+            lockname_list = [make_lockname(_) for _ in claimed_list]
+            async with self.conn.pipeline() as pipe:
+                try:
+                    await pipe.watch(*(lockname_list + claimed_list))
+                    read_pipe = self.conn.pipeline(False)
+                    for key_name, lockname in zip(claimed_list, lockname_list):
+                        read_pipe.get(lockname)
+                        read_pipe.sismember(make_tagged_name(KEYS_MODIFIED_SET, key_name), key_name)
+                        read_pipe.hget(make_tagged_name(KEY_SIZES, key_name), key_name)
+                    values = await read_pipe.execute()
+                    modified_list = list()
+                    size_dict = dict()
+                    for key_name, pre_identifier, ismember, size in zip(list(claimed_list), values[::3], values[1::3], values[2::3]):
+                        if pre_identifier != identifier:
+                            claimed_list.remove(key_name)
+                            left_key_list.append(key_name)
+                            continue
+                        if ismember:
+                            modified_list.append(key_name)
+                        if size:
+                            size_dict[key_name] = size
+
+                    await self.write_back_to_mongo(modified_list)
+
+                    pipe.multi()
+                    for key_name in claimed_list:
+                        pipe.delete(key_name, make_dirty_fields_name(key_name), make_inc_fields_name(key_name), make_op_log_name(key_name))
+                        self.lru_queue.remove(pipe, key_name)
+                        pipe.delete(make_lockname(key_name))
+                    if modified_list:
+                        pipe.srem(make_tagged_name(KEYS_MODIFIED_SET, modified_list[0]), *modified_list)
+                        pipe.zrem(make_tagged_name(DIRTY_SINCE, modified_list[0]), *modified_list)
+                    for key_name, size in size_dict.items():
+                        pipe.hdel(make_tagged_name(KEY_SIZES, key_name), key_name)
+                        pipe.hincrby(make_tagged_name(KEY_SIZES_TOTAL, key_name), get_col_name(key_name), -int(size))
+                    await pipe.execute()
+                    return left_key_list
+                except redis.exceptions.WatchError:
+                    continue
+        return left_key_list + claimed_list
+
+    async def write_back_key_names(self, key_name_list, batch_size=100):
+        """
+        return the key names which can't be written back now
+        """
+        # the batches are by hash tag, see RedisDelegate.write_back_key_names
+        tag_key_names_dict = OrderedDict()
+        for key_name in key_name_list:
+            tag_key_names_dict.setdefault(get_hash_tag(key_name), list()).append(key_name)
+        left_key_list = list()
+        for tag_key_name_list in tag_key_names_dict.values():
+            for i in range(0, len(tag_key_name_list), batch_size):
+                batch_key_name_list = tag_key_name_list[i: i + batch_size]
+                await self.pace_write_back(len(batch_key_name_list))
+                start_time = time.time()
+                left_key_list.extend(await self.batch_write_back(batch_key_name_list))
+                self._timing('write_back', start_time)
+        if self.instrumentation is not None:
+            self.instrumentation.incr('write_back.evicted', len(key_name_list) - len(left_key_list))
+            self.instrumentation.incr('write_back.deferred', len(left_key_list))
+        return left_key_list
+
+    def _timing(self, name, start_time):
+        if self.instrumentation is not None:
+            self.instrumentation.timing(name, time.time() - start_time)
+
+    async def pace_write_back(self, num):
+        """
+        see RedisDelegate.pace_write_back
+        """
+        pacer = self.write_back_pacer
+        if pacer is None:
+            return
+        if pacer.need_memory_check():
+            pacer.set_used_memory(int((await self.conn.info('memory'))['used_memory']))
+        delay = pacer.reserve(num)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def count_lru_queue(self):
+        pipe = self.conn.pipeline(False)
+        for queue_name in self.lru_queue.get_queue_names():
+            pipe.zcard(queue_name)
+        return sum(await pipe.execute())
+
+    async def get_oldest(self, start, num):
+        """
+        see LruQueue.get_oldest, the policies needing more are rejected by __init__
+        """
+        merger = QueueMerger(self.lru_queue.get_queue_names(), start, num)
+        reads = merger.get_reads()
+        while reads:
+            pipe = self.conn.pipeline(False)
+            for i, queue_name, read_start, read_end in reads:
+                pipe.zrange(queue_name, read_start, read_end, withscores=True)
+            merger.feed(reads, await pipe.execute())
+            reads = merger.get_reads()
+        return merger.get_result()
+
+    async def check_overload(self, interval=5, lru_queue_num_min=10000, lru_queue_num_max=15000, batch_size=100):
+        """
+        write the least recently used keys back when there are too many, see RedisDelegate.check_overload
+        scheduler_dict and partition of the blocking one are not supported, run it in one task per process
+        """
+        left_key_list = list()
+        while True:
+            if left_key_list:
+                left_key_list = await self.write_back_key_names(left_key_list, batch_size)
+
+            num = await self.count_lru_queue()
+            if num >= lru_queue_num_max:
+                to_be_writeback_list = await self.get_oldest(0, num - lru_queue_num_min + 1)
+                await self.write_back_key_names(to_be_writeback_list, batch_size)
+            elif num >= lru_queue_num_min:
+                await asyncio.sleep(interval / 2.0)
+            else:
+                await asyncio.sleep(interval)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+"""
+load a collection from mongo into redis before taking traffic, see CollectionBase.warm_up
+
+    python -m rmlru.warmup myapp.models:Resources --db test --sort=-views --limit 100000 --max-memory 4000000000
+"""
+
+from __future__ import print_function
+
+import time
+import argparse
+from importlib import import_module
+
+import redis
+from bson import json_util
+from pymongo import MongoClient
+
+from rmlru import RedisDelegate
+
+def load_collection_class(path):
+    """
+    path: module:class of the collection, e.g. myapp.models:Resources
+    """
+    module_name, class_name = path.split(':', 1)
+    return getattr(import_module(module_name), class_name)
+
+def parse_sort(sort):
+    """
+    sort: comma separated field names, descending with the prefix -, e.g. -views,name
+    """
+    res = list()
+    for field_name in sort.split(','):
+        if field_name.startswith('-'):
+            res.append((field_name[1:], -1))
+        else:
+            res.append((field_name, 1))
+    return res
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='load a collection from mongo into redis')
+    parser.add_argument('collection', help='module:class of the collection, e.g. myapp.models:Resources')
+    parser.add_argument('--redis-url', default='redis://localhost:6379/0', help='redis to load into')
+    parser.add_argument('--mongo', default='mongodb://localhost:27017', help='mongodb uri')
+    parser.add_argument('--db', required=True, help='mongodb database of the collection')
+    parser.add_argument('--filter', help='documents to load in mongodb extended json, all by default')
+    parser.add_argument('--sort', help='comma separated field names to load in order of, descending with the prefix -, e.g. --sort=-views')
+    parser.add_argument('--limit', type=int, default=0, help='documents to load at most, no limit by default')
+    parser.add_argument('--batch-size', type=int, default=1000, help='documents read and filled at a time')
+    parser.add_argument('--max-memory', type=int, help='stop when redis uses so many bytes')
+    parser.add_argument('--hash-tag-num', type=int, default=0, help='see RedisDelegate, for redis cluster')
+    args = parser.parse_args(argv)
+
+    delegate = RedisDelegate(redis.StrictRedis.from_url(args.redis_url), MongoClient(args.mongo)[args.db], hash_tag_num=args.hash_tag_num)
+    collection = load_collection_class(args.collection)()
+    delegate.add_collection(collection)
+    start_time = time.time()
+    num = collection.warm_up(json_util.loads(args.filter) if args.filter else None, parse_sort(args.sort) if args.sort else None,
+                             args.limit, args.batch_size, args.max_memory)
+    print('%d documents of %s loaded in %.1f seconds' % (num, collection._col_name, time.time() - start_time))
+
+if __name__ == '__main__':
+    main()
@@ -3,10 +3,13 @@
 import redis
 import mock
 import time
+import threading
 import unittest
+from datetime import datetime
+from bson import ObjectId
 from pymongo import MongoClient
 
-from rmlru import RedisDelegate, CollectionBase, SetField, ListField, ZsetField, DictField, KEYS_MODIFIED_SET, LRU_QUEUE, acquire_lock_with_timeout
+from rmlru import RedisDelegate, CollectionBase, SetField, ListField, ZsetField, DictField, KEYS_MODIFIED_SET, LRU_QUEUE, acquire_lock_with_timeout, make_sub_key_name, key_partition, BsonCodec, MsgpackCodec, msgpack, ApproxLruQueue, LfuQueue, SegmentedLruQueue, QueueMerger, LFU_QUEUE, LRU_PROTECTED, LRU_HITS, make_hash_tag, make_dirty_fields_name, WriteBackPacer, MetricsAggregator
 
 class Tags(CollectionBase):
     _key_name = 'uid'
@@ -29,6 +32,24 @@ class Users(CollectionBase):
     _none_string_key_name_dict = {_key_name: long, "haslog": int}
     friends = ZsetField('friends', 'uid', long, 'isStar', int)
 
+class Feeds(CollectionBase):
+    _key_name = 'uid'
+    _key_type = long
+    _col_name = 'feeds'
+    _none_string_key_name_dict = {_key_name: long}
+    tags = SetField('tags', log_ops=True)
+    log = ListField('log', DictField(), log_ops=True, op_log_max_len=5)
+    scores = ZsetField('scores', 'fid', long, 'score', int, log_ops=True)
+
+class Albums(CollectionBase):
+    _key_name = 'uid'
+    _key_type = long
+    _col_name = 'albums'
+    _none_string_key_name_dict = {_key_name: long}
+    photos = ListField('photos', write_back_page_size=3)
+    likes = ZsetField('likes', 'uid', long, 'time', int, log_ops=True, op_log_max_len=2, write_back_page_size=3)
+    members = SetField('members', write_back_page_size=3)
+
 class RMLRUTest(unittest.TestCase):
     def setUp(self):
         self.mongo_conn = MongoClient('localhost', 27017)
@@ -42,11 +63,22 @@ class RMLRUTest(unittest.TestCase):
         self.redis_delegator.add_collection(tag)
         self.redis_delegator.add_collection(users)
         self.redis_delegator.add_collection(fblog)
+        self.redis_delegator.add_collection(Feeds())
 
     def tearDown(self):
         self.redis_conn.flushdb()
         self.mongo_conn.drop_database('test')
 
+    def patch_find_one(self, **kwargs):
+        """
+        patch find_one of the collection class, the mock gets the collection first,
+        pymongo makes a new Collection on every access of the database, so patching self.db.tags never takes effect
+        without side_effect, the mock calls the real find_one
+        """
+        collection_class = type(self.db.tags)
+        kwargs.setdefault('side_effect', collection_class.find_one)
+        return mock.patch.object(collection_class, 'find_one', autospec=True, **kwargs)
+
     def test_SetField_get_and_set(self):
         tag = self.redis_delegator.tags(1)
         sr = self.redis_conn
@@ -318,4 +350,709 @@ class RMLRUTest(unittest.TestCase):
             # strange !!
             # self.assertTrue(sr.zrank(LRU_QUEUE, users.friends.key_name) is None)
             doc1 = self.db.users.find_one({'uid': 1}, {'uid': 0, '_id': 0})
-            self.assertEqual(doc, doc1)
\ No newline at end of file
+            self.assertEqual(doc, doc1)
+
+    def test_touch_key_names(self):
+        users = self.redis_delegator.users(1)
+        sr = self.redis_conn
+        users.update({'test': 'xyz'})
+        friends_key_name = make_sub_key_name(users._key, 'friends')
+        with mock.patch.object(sr, 'exists') as exists, mock.patch.object(sr, 'zadd') as zadd:
+            res = users.touch_key_names([users._key, friends_key_name])
+            self.assertFalse(exists.called)
+            self.assertFalse(zadd.called)
+        self.assertEqual(res, [True, False])
+        self.assertTrue(sr.zrank(LRU_QUEUE, friends_key_name) is not None)
+        self.assertTrue(sr.exists('lock:' + friends_key_name))
+
+    def test_find_many(self):
+        users = self.redis_delegator.users
+        friends_list = [{'uid': 2, 'isStar': 0}, {'uid': 1, 'isStar': 5}]
+        self.db.users.insert({'uid': 1, 'haslog': 1, 'test': 'xyz', 'friends': friends_list})
+        self.db.users.insert({'uid': 2, 'haslog': 0, 'test': 'abc'})
+        users(2).update({'test': 'def'})
+        doc1 = {'haslog': 1, 'test': 'xyz', 'friends': friends_list}
+        doc2 = {'test': 'def', 'friends': []}
+        doc3 = {'friends': []}
+
+        res = users.find_many([1, 2, 3])
+        self.assertEqual(res, [doc1, doc2, doc3])
+        self.assertEqual(users.find_many([1, 2, 3]), [doc1, doc2, doc3])
+        self.assertTrue(self.redis_conn.exists(make_sub_key_name(users(1)._key, 'friends')))
+
+        res = users.find_many([2, 1], ['haslog', 'friends'])
+        self.assertEqual(res, [{'haslog': None, 'friends': []}, {'haslog': 1, 'friends': doc1['friends']}])
+
+    def test_batch_write_back(self):
+        users = self.redis_delegator.users(1)
+        tag = self.redis_delegator.tags(1)
+        sr = self.redis_conn
+        friends_list = [{'uid': 1, 'isStar': 5}, {'uid': 2, 'isStar': 0}]
+        self.db.users.insert({'uid': 1, 'haslog': 1, 'test': 'xyz', 'friends': friends_list})
+        users(1).update({'test': '123', 'friends': [{'uid': 2, 'isStar': 11}]})
+        users(2).update({'test': 'abc'})
+        tag.file_ids.sadd('1', '2')
+        key_name_list = sr.zrange(LRU_QUEUE, 0, -1)
+        sr.delete(*sr.keys('lock:*'))
+        sr.set('lock:users:2', 'others')
+
+        res = self.redis_delegator.batch_write_back(sr, key_name_list)
+        self.assertEqual(res, ['users:2'])
+        self.assertEqual(sr.zrange(LRU_QUEUE, 0, -1), ['users:2'])
+        self.assertEqual(sr.smembers(KEYS_MODIFIED_SET), set(['users:2']))
+        doc = self.db.users.find_one({'uid': 1}, {'_id': 0})
+        self.assertEqual(doc, {'uid': 1, 'haslog': 1, 'test': '123', 'friends': [{'uid': 2, 'isStar': 11}]})
+        self.assertEqual(self.db.users.find_one({'uid': 2}), None)
+        self.assertEqual(set(self.db.tags.find_one({'uid': 1})['file_ids']), set(['1', '2']))
+
+        sr.delete('lock:users:2')
+        res = self.redis_delegator.write_back_key_names(sr, ['users:2'], batch_size=10)
+        self.assertEqual(res, [])
+        self.assertEqual(self.db.users.find_one({'uid': 2}, {'_id': 0}), {'uid': 2, 'test': 'abc'})
+
+    def test_batch_write_back_lock_taken(self):
+        sr = self.redis_conn
+        for i in range(1, 4):
+            self.redis_delegator.tags(i).file_ids.sadd('a')
+        sr.delete(*sr.keys('lock:*'))
+        key_name_list = ['tags:%d.file_ids' % i for i in range(1, 4)]
+        claim_pipe = sr.pipeline(False)
+        claim = claim_pipe.execute
+
+        def claim_then_take():
+            res = claim()
+            # a reader takes the lock of tags:2.file_ids once all are claimed
+            sr.set('lock:tags:2.file_ids', 'reader')
+            return res
+        claim_pipe.execute = claim_then_take
+        with mock.patch.object(sr, 'pipeline', side_effect=[claim_pipe] + [sr.pipeline() for i in range(10)]):
+            res = self.redis_delegator.batch_write_back(sr, key_name_list)
+        self.assertEqual(res, ['tags:2.file_ids'])
+        self.assertEqual(sr.get('lock:tags:2.file_ids'), 'reader')
+        self.assertFalse(sr.exists('lock:tags:1.file_ids'))
+        self.assertFalse(sr.exists('lock:tags:3.file_ids'))
+        self.assertTrue(sr.exists('tags:2.file_ids'))
+        self.assertFalse(sr.exists('tags:3.file_ids'))
+
+    def test_key_partition(self):
+        for key in xrange(100):
+            key_name = 'users:%d' % key
+            partition = key_partition(key_name, 4)
+            self.assertTrue(0 <= partition < 4)
+            self.assertEqual(partition, key_partition(make_sub_key_name(key_name, 'friends'), 4))
+        self.assertEqual(len(set(key_partition('users:%d' % key, 4) for key in xrange(100))), 4)
+
+    def test_write_back_dirty_fields(self):
+        users = self.redis_delegator.users(1)
+        sr = self.redis_conn
+        self.db.users.insert({'uid': 1, 'haslog': 1, 'test': 'xyz', 'abc': 'aaa'})
+        self.assertEqual(users.haslog, 1)
+        users.test = '123'
+        users.update({'abc': None})
+        self.assertEqual(sr.hgetall('dirty_fields:users:1'), {'test': '1', 'abc': '0'})
+
+        # changed by others, never overwritten by the fields not modified in redis
+        self.db.users.update({'uid': 1}, {'$set': {'haslog': 2}})
+        users.write_back(1)
+        doc = self.db.users.find_one({'uid': 1}, {'_id': 0})
+        self.assertEqual(doc, {'uid': 1, 'haslog': 2, 'test': '123'})
+
+        sr.delete('lock:users:1')
+        self.assertTrue(self.redis_delegator.try_write_back(sr, 'users:1'))
+        self.assertFalse(sr.exists('dirty_fields:users:1'))
+
+    def test_write_back_op_log(self):
+        feeds = self.redis_delegator.feeds(1)
+        sr = self.redis_conn
+        self.db.feeds.insert({'uid': 1, 'tags': ['a', 'b'], 'log': [{'x': 1}], 'scores': [{'fid': 1, 'score': 1}, {'fid': 2, 'score': 3}]})
+        feeds.tags.sadd('c', 'd')
+        feeds.tags.srem('a')
+        feeds.log.rpush({'y': 2}, {'z': 3})
+        feeds.log.lpop()
+        feeds.scores.zadd(2, 3, 5, 1)
+        feeds.scores.zrem(2)
+        self.assertEqual(sr.llen('op_log:feeds:1.tags'), 2)
+        # changed by others, kept by the operations replayed
+        self.db.feeds.update({'uid': 1}, {'$push': {'tags': 'e'}})
+
+        for field_name in ('tags', 'log', 'scores'):
+            feeds.write_back(1, field_name)
+            self.assertFalse(sr.exists('op_log:feeds:1.' + field_name))
+        doc = self.db.feeds.find_one({'uid': 1})
+        self.assertEqual(set(doc['tags']), set(['b', 'c', 'd', 'e']))
+        self.assertEqual(doc['log'], [{'y': 2}, {'z': 3}])
+        self.assertEqual(doc['scores'], [{'fid': 3, 'score': 2}, {'fid': 1, 'score': 5}])
+
+        # too many operations, the whole field is written back
+        for i in xrange(6):
+            feeds.log.rpush({'i': i})
+        feeds.log.ltrim(1, 2)
+        feeds.write_back(1, 'log')
+        self.assertEqual(self.db.feeds.find_one({'uid': 1})['log'], [{'z': 3}, {'i': 0}])
+        self.assertFalse(sr.exists('op_log:feeds:1.log'))
+
+    def test_DictField_codecs(self):
+        val = {'1': [1, 2], '2': {'3': 'abc' * 100}}
+        json_data = DictField().set(val)
+        codec_list = [BsonCodec()]
+        if msgpack is not None:
+            codec_list.append(MsgpackCodec())
+        for codec in codec_list:
+            field = DictField(codec, compress_threshold=100)
+            self.assertEqual(field.get(field.set(val)), val)
+            self.assertTrue(len(field.set(val)) < len(json_data))
+            self.assertEqual(field.get(field.set({'1': 1})), {'1': 1})
+            # data encoded by other codecs can still be decoded
+            self.assertEqual(field.get(json_data), val)
+
+        # the values of mongo documents
+        val = {'t': datetime(2020, 1, 2, 3, 4, 5, 6000), 'id': ObjectId(), 'l': [ObjectId()]}
+        for codec in codec_list:
+            field = DictField(codec)
+            self.assertEqual(field.get(field.set(val)), val)
+
+    def test_local_cache(self):
+        users = self.redis_delegator.users
+        sr = self.redis_conn
+        users.enable_local_cache(max_entries=10)
+        try:
+            self.db.users.insert({'uid': 1, 'haslog': 1, 'test': 'xyz', 'friends': [{'uid': 2, 'isStar': 0}]})
+            doc = users(1).find(1)
+            self.assertEqual(users(1).find(1), doc)
+            self.assertEqual(users(1).test, 'xyz')
+            self.assertEqual(users(1).find(1, ['test', 'friends']), {'test': 'xyz', 'friends': [{'uid': 2, 'isStar': 0}]})
+            # served without redis
+            sr.hset('users:1', 'test', 'changed by others')
+            self.assertEqual(users(1).test, 'xyz')
+            self.assertEqual(users(1).find(1)['test'], 'xyz')
+            hits = users._local_cache.hits
+            self.assertTrue(hits >= 4)
+
+            users(1).test = 'abc'
+            self.assertEqual(users(1).test, 'abc')
+            users(1).friends.zadd(1, 3)
+            self.assertEqual(users(1).find(1, ['test', 'friends'])['friends'], [{'uid': 2, 'isStar': 0}, {'uid': 3, 'isStar': 1}])
+            self.assertEqual(users(1).find(1)['friends'], [{'uid': 2, 'isStar': 0}, {'uid': 3, 'isStar': 1}])
+
+            self.assertEqual(users.find_many([1, 2], ['test']), [{'test': 'abc'}, {'test': None}])
+            self.assertEqual(users._local_cache.get('users:2', 'test'), None)
+            for i in xrange(20):
+                users(i).test
+            self.assertEqual(len(users._local_cache), 10)
+
+            # modified on other nodes
+            self.redis_delegator.start_invalidation_listener()
+            time.sleep(0.1)
+            sr.publish('rmlru:invalidation', 'users:19')
+            time.sleep(0.1)
+            self.assertEqual(users._local_cache.get('users:19', 'test', 'missing'), 'missing')
+        finally:
+            users.disable_local_cache()
+
+    def test_local_cache_invalidated_while_reading(self):
+        users = self.redis_delegator.users
+        users.enable_local_cache()
+        try:
+            self.db.users.insert({'uid': 1, 'test': 'xyz'})
+            _find = users._find
+
+            def find_invalidated(*args, **kwargs):
+                res = _find(*args, **kwargs)
+                # published by another node after the redis read
+                self.redis_delegator.invalidate_local_cache('users:1')
+                return res
+            with mock.patch.object(users, '_find', side_effect=find_invalidated):
+                self.assertEqual(users(1).find(1, ['test']), {'test': 'xyz'})
+            self.assertEqual(users._local_cache.get('users:1', 'test', 'missing'), 'missing')
+            self.assertEqual(users(1).find(1, ['test']), {'test': 'xyz'})
+            self.assertEqual(users._local_cache.get('users:1', 'test', 'missing'), 'xyz')
+
+            local_cache = users._local_cache
+            generation = local_cache.get_generation()
+            local_cache.clear()
+            local_cache.set('users:2', 'test', 'abc', generation)
+            self.assertEqual(local_cache.get('users:2', 'test', 'missing'), 'missing')
+        finally:
+            users.disable_local_cache()
+
+    def test_negative_cache(self):
+        tag = self.redis_delegator.tags(1)
+        sr = self.redis_conn
+        tag._negative_cache_ttl = 60
+        with self.patch_find_one() as find_one:
+            self.assertEqual(tag.find(1), {'file_ids': set()})
+            self.assertTrue(sr.ttl('missing:tags:1') > 0)
+            self.assertEqual(tag.find(1), {'file_ids': set()})
+            self.assertEqual(tag.file_ids.get(), set())
+            self.assertEqual(find_one.call_count, 1)
+        # once per find, not again by every field
+        self.assertEqual(tag.get_negative_cache_hits(), 2)
+        self.assertEqual(tag.find_many([1, 2]), [{'file_ids': set()}, {'file_ids': set()}])
+        self.assertEqual(tag.get_negative_cache_hits(), 3)
+        self.assertTrue(sr.exists('missing:tags:2'))
+
+        tag.file_ids.sadd('1')
+        self.assertFalse(sr.exists('missing:tags:1'))
+        self.redis_delegator.tags(2).update({'name': 'abc'})
+        self.assertFalse(sr.exists('missing:tags:2'))
+
+    def test_fill_lease(self):
+        tag = self.redis_delegator.tags(1)
+        sr = self.redis_conn
+        self.db.tags.insert({'uid': 1, 'file_ids': ['1', '2']})
+        sr.set('fill:tags:1', 1)
+        def fill():
+            time.sleep(0.1)
+            sr.sadd('tags:1.file_ids', '1', '2')
+            sr.delete('fill:tags:1')
+        thread = threading.Thread(target=fill)
+        thread.start()
+        with self.patch_find_one() as find_one:
+            self.assertEqual(tag.file_ids.get(), set(['1', '2']))
+            self.assertFalse(find_one.called)
+        thread.join()
+
+        # the lease holder failed, load it by myself
+        sr.delete('tags:1.file_ids')
+        sr.set('fill:tags:1', 1, px=100)
+        self.assertEqual(tag.file_ids.get(), set(['1', '2']))
+        self.assertFalse(sr.exists('fill:tags:1'))
+
+    def test_fill_lease_release(self):
+        tag = self.redis_delegator.tags(1)
+        sr = self.redis_conn
+        self.db.tags.insert({'uid': 1, 'file_ids': ['1']})
+        find_one = type(self.db.tags).find_one
+
+        def find_one_slowly(*args, **kwargs):
+            # the lease expires, and is taken by the next client
+            sr.set('fill:tags:1', 'next')
+            return find_one(*args, **kwargs)
+        with self.patch_find_one(side_effect=find_one_slowly) as mock_find_one:
+            self.assertEqual(tag.file_ids.get(), set(['1']))
+            self.assertTrue(mock_find_one.called)
+        self.assertEqual(sr.get('fill:tags:1'), 'next')
+
+        sr.delete('fill:tags:1', 'tags:1.file_ids')
+        with self.patch_find_one(side_effect=ValueError):
+            self.assertRaises(ValueError, tag.make_data_in_redis, ['file_ids'])
+        self.assertFalse(sr.exists('fill:tags:1'))
+        self.assertTrue(tag.need_record_modify())
+
+    def test_projection(self):
+        feeds = self.redis_delegator.feeds
+        self.db.feeds.insert({'uid': 1, 'name': 'x', 'tags': ['a'], 'log': [{'a': 1}], 'scores': [{'fid': 1, 'score': 2}]})
+        with self.patch_find_one() as find_one:
+            self.assertEqual(feeds.find(1, ['tags']), {'tags': ['a']})
+            self.assertEqual(find_one.call_args[0][2], {'_id': 0, 'tags': 1})
+            self.assertEqual(feeds.find(1, ['name', 'log']), {'name': 'x', 'log': [{'a': 1}]})
+            self.assertEqual(find_one.call_args[0][2], {'_id': 0, 'uid': 0, 'tags': 0, 'scores': 0, '_staged_tags': 0, '_staged_log': 0, '_staged_scores': 0})
+        self.assertFalse(self.redis_conn.exists(make_sub_key_name(feeds(1)._key, 'scores')))
+
+    def test_mutate_script(self):
+        delegator = RedisDelegate(self.redis_conn, self.db, use_scripts=True)
+        delegator.add_collection(Feeds())
+        feeds = delegator.feeds(1)
+        sr = self.redis_conn
+        self.db.feeds.insert({'uid': 1, 'tags': ['a'], 'log': [{'a': 1}]})
+        self.assertEqual(feeds.tags.sadd('b', 'c'), 2)
+        self.assertEqual(feeds.tags.srem('c'), 1)
+        self.assertEqual(feeds.log.rpush({'b': 2}, {'c': 3}), 3)
+        self.assertEqual(feeds.log.lpop(), '{"a": 1}')
+        self.assertTrue(feeds.log.ltrim(0, 0))
+        self.assertEqual(feeds.scores.zadd(3, 1, 2, 2), 2)
+        self.assertEqual(feeds.scores.zrem(1), 1)
+        self.assertEqual(sr.smembers(KEYS_MODIFIED_SET), set(['feeds:1.tags', 'feeds:1.log', 'feeds:1.scores']))
+        self.assertEqual(sr.zcard(LRU_QUEUE), 3)
+        self.assertEqual(sr.llen('op_log:feeds:1.log'), 3)
+
+        delegator.write_back_to_mongo(sr, ['feeds:1.tags', 'feeds:1.log', 'feeds:1.scores'])
+        doc = self.db.feeds.find_one({'uid': 1}, {'_id': 0})
+        self.assertEqual(set(doc.pop('tags')), set(['a', 'b']))
+        self.assertEqual(doc, {'uid': 1, 'log': [{'b': 2}], 'scores': [{'fid': 2, 'score': 2}]})
+
+    def test_memory_budget(self):
+        sr = self.redis_conn
+        for i in range(1, 6):
+            self.redis_delegator.tags(i).file_ids.sadd('1')
+        sr.delete(*sr.keys('lock:*'))
+        # one byte for every key
+        with mock.patch.object(RedisDelegate, 'memory_usage', lambda self, pipe, key_name: pipe.exists(key_name)):
+            self.assertFalse(self.redis_delegator.check_memory_budget(sr, 0, col_max_memory_dict={'tags': 3}))
+            self.assertEqual(sr.zrange(LRU_QUEUE, 0, -1), ['tags:4.file_ids', 'tags:5.file_ids'])
+            self.assertEqual(self.redis_delegator.get_collection_sizes(sr), {'tags': 2})
+            self.assertEqual(self.db.tags.count(), 3)
+
+            with mock.patch.object(RedisDelegate, 'get_used_memory', side_effect=[100, 80]):
+                self.assertFalse(self.redis_delegator.check_memory_budget(sr, time.time(), max_memory=100))
+            self.assertEqual(sr.zcard(LRU_QUEUE), 0)
+            self.assertEqual(self.redis_delegator.get_collection_sizes(sr), {'tags': 0})
+
+    def test_approx_lru_queue(self):
+        lru_queue = ApproxLruQueue(shard_num=4, touch_interval=3600)
+        delegator = RedisDelegate(self.redis_conn, self.db, lru_queue=lru_queue)
+        delegator.add_collection(Tags())
+        sr = self.redis_conn
+        self.db.tags.insert({'uid': 1, 'file_ids': ['1']})
+        for i in range(1, 4):
+            delegator.tags(i).file_ids.get()
+        self.assertEqual(sr.zcard(LRU_QUEUE), 0)
+        self.assertEqual(lru_queue.count(sr), 3)
+
+        # read once an interval
+        queue_name = lru_queue.get_queue_name('tags:1.file_ids')
+        sr.zrem(queue_name, 'tags:1.file_ids')
+        delegator.tags(1).file_ids.get()
+        self.assertEqual(sr.zscore(queue_name, 'tags:1.file_ids'), None)
+        delegator.tags(1).file_ids.sadd('2')
+        self.assertTrue(sr.zscore(queue_name, 'tags:1.file_ids') is not None)
+
+        key_name_list = lru_queue.get_oldest(sr, 0, 10)
+        self.assertEqual(sorted(key_name_list), ['tags:1.file_ids', 'tags:2.file_ids', 'tags:3.file_ids'])
+        sr.delete(*sr.keys('lock:*'))
+        self.assertEqual(delegator.write_back_key_names(sr, key_name_list), [])
+        self.assertEqual(lru_queue.count(sr), 0)
+        self.assertEqual(set(self.db.tags.find_one({'uid': 1})['file_ids']), set(['1', '2']))
+
+    def test_queue_merger(self):
+        sr = self.redis_conn
+        queue_names = ['lru_queue:%d' % _ for _ in range(4)]
+        # all the oldest in one queue
+        for i in range(40):
+            sr.zadd(queue_names[0], i, 'a%d' % i)
+            sr.zadd(queue_names[i % 3 + 1], 100 + i, 'b%d' % i)
+        all_list = ['a%d' % _ for _ in range(40)] + ['b%d' % _ for _ in range(40)]
+        for start, num in ((0, 5), (30, 20), (75, 10)):
+            merger = QueueMerger(queue_names, start, num)
+            read_num = 0
+            reads = merger.get_reads()
+            while reads:
+                replies = [sr.zrange(queue_name, read_start, read_end, withscores=True) for i, queue_name, read_start, read_end in reads]
+                read_num += sum(len(_) for _ in replies)
+                merger.feed(reads, replies)
+                reads = merger.get_reads()
+            self.assertEqual(merger.get_result(), all_list[start: start + num])
+            # not start + num from every queue
+            self.assertTrue(read_num <= 2 * (start + num + len(queue_names)))
+        lru_queue = ApproxLruQueue(shard_num=4)
+        self.assertEqual(lru_queue.get_oldest(sr, 30, 20), all_list[30: 50])
+
+    def test_lfu_queue(self):
+        lru_queue = LfuQueue(init_count=2)
+        delegator = RedisDelegate(self.redis_conn, self.db, lru_queue=lru_queue)
+        delegator.add_collection(Tags())
+        sr = self.redis_conn
+        self.db.tags.insert({'uid': 1, 'file_ids': ['1']})
+        self.db.tags.insert({'uid': 2, 'file_ids': ['2']})
+        for i in range(3):
+            delegator.tags(1).file_ids.get()
+        delegator.tags(2).file_ids.get()
+        self.assertEqual(sr.zrange(LFU_QUEUE, 0, -1, withscores=True), [('tags:2.file_ids', 2.0), ('tags:1.file_ids', 4.0)])
+        lru_queue.maintain(sr)
+        self.assertEqual(sr.zscore(LFU_QUEUE, 'tags:1.file_ids'), 4.0)
+        sr.set(LFU_QUEUE + ':decay_time', 0)
+        lru_queue.maintain(sr)
+        self.assertEqual(sr.zscore(LFU_QUEUE, 'tags:1.file_ids'), 2.0)
+        self.assertEqual(lru_queue.get_oldest(sr, 0, 1), ['tags:2.file_ids'])
+
+    def test_segmented_lru_queue(self):
+        lru_queue = SegmentedLruQueue(protected_ratio=0.5)
+        delegator = RedisDelegate(self.redis_conn, self.db, lru_queue=lru_queue)
+        delegator.add_collection(Tags())
+        sr = self.redis_conn
+        for i in range(1, 5):
+            self.db.tags.insert({'uid': i, 'file_ids': [str(i)]})
+        # one scan, then the hot ones are read again
+        for i in range(1, 5):
+            delegator.tags(i).file_ids.get()
+        delegator.tags(1).file_ids.get()
+        delegator.tags(2).file_ids.get()
+        lru_queue.maintain(sr)
+        self.assertEqual(sr.zrange(LRU_PROTECTED, 0, -1), ['tags:1.file_ids', 'tags:2.file_ids'])
+        self.assertEqual(sr.zrange(LRU_QUEUE, 0, -1), ['tags:3.file_ids', 'tags:4.file_ids'])
+        self.assertEqual(lru_queue.get_oldest(sr, 0, 3), ['tags:3.file_ids', 'tags:4.file_ids', 'tags:1.file_ids'])
+        # added to LRU_QUEUE by a read of it, and removed from it once it is met there
+        sr.zadd(LRU_QUEUE, 0, 'tags:1.file_ids')
+        self.assertEqual(lru_queue.get_oldest(sr, 0, 2), ['tags:3.file_ids', 'tags:4.file_ids'])
+        self.assertEqual(sr.zrange(LRU_QUEUE, 0, -1), ['tags:3.file_ids', 'tags:4.file_ids'])
+
+        # more protected than protected_ratio
+        delegator.tags(3).file_ids.get()
+        lru_queue.maintain(sr)
+        self.assertEqual(sr.zrange(LRU_PROTECTED, 0, -1), ['tags:2.file_ids', 'tags:3.file_ids'])
+        sr.delete(*sr.keys('lock:*'))
+        self.assertEqual(delegator.write_back_key_names(sr, ['tags:1.file_ids']), [])
+        self.assertEqual(lru_queue.get_oldest(sr, 0, 5), ['tags:4.file_ids', 'tags:2.file_ids', 'tags:3.file_ids'])
+
+    def test_segmented_lru_queue_find(self):
+        lru_queue = SegmentedLruQueue(protected_hits=3)
+        delegator = RedisDelegate(self.redis_conn, self.db, lru_queue=lru_queue)
+        delegator.add_collection(Tags())
+        self.db.tags.insert({'uid': 1, 'file_ids': ['1']})
+        delegator.tags(1).find(1)
+        # one more read of the cached document by a scan
+        self.assertEqual(delegator.tags(1).find(1), {'file_ids': set(['1'])})
+        self.assertEqual(self.redis_conn.zscore(LRU_HITS, 'tags:1.file_ids'), 2)
+        lru_queue.maintain(self.redis_conn)
+        self.assertEqual(self.redis_conn.zcard(LRU_PROTECTED), 0)
+
+    def test_hash_tags(self):
+        delegator = RedisDelegate(self.redis_conn, self.db, use_scripts=True, hash_tag_num=4)
+        delegator.add_collection(Tags())
+        delegator.add_collection(Users())
+        sr = self.redis_conn
+        for i in range(1, 9):
+            delegator.tags(i).file_ids.sadd(str(i))
+        delegator.users(1).update({'name': 'x'})
+        tag = make_hash_tag('users:1', 4)
+        self.assertEqual(delegator.users(1)._key, tag + 'users:1')
+        self.assertEqual(sr.hgetall(make_dirty_fields_name(tag + 'users:1')), {'name': '1'})
+        self.assertEqual(delegator.parse_sub_key_name(tag + 'users:1'), ('users', 1, ''))
+
+        # the key names in the structures of one hash tag all have it
+        key_name_list = list()
+        for tag in delegator.hash_tags:
+            tag_key_name_list = sr.zrange(tag + LRU_QUEUE, 0, -1)
+            self.assertEqual(set(tag_key_name_list), sr.smembers(tag + KEYS_MODIFIED_SET))
+            self.assertTrue(all(_.startswith(tag) for _ in tag_key_name_list))
+            key_name_list.extend(tag_key_name_list)
+        self.assertEqual(len(key_name_list), 9)
+        self.assertEqual(sr.zcard(LRU_QUEUE), 0)
+
+        sr.delete(*sr.keys('lock:*'))
+        self.assertEqual(delegator.write_back_key_names(sr, key_name_list, batch_size=100), [])
+        self.assertEqual(delegator.lru_queue.count(sr), 0)
+        self.assertEqual(self.db.tags.find_one({'uid': 5})['file_ids'], ['5'])
+        self.assertEqual(self.db.users.find_one({'uid': 1})['name'], 'x')
+
+    def test_batch(self):
+        feeds = self.redis_delegator.feeds
+        sr = self.redis_conn
+        self.db.feeds.insert({'uid': 1, 'name': 'x', 'tags': ['a']})
+        with self.redis_delegator.batch():
+            self.assertEqual(feeds(1).find(1)['tags'], ['a'])
+            self.assertTrue(feeds(1).tags.sadd('b') is None)
+            feeds(1).scores.zadd(1, 2)
+            feeds(1).name = 'y'
+            feeds(1).update({'age': 1})
+            # nothing is sent before reading
+            self.assertEqual(sr.smembers('feeds:1.tags'), set(['a']))
+            self.assertEqual(sr.scard(KEYS_MODIFIED_SET), 0)
+            self.assertEqual(feeds(1).tags.get(), set(['a', 'b']))
+            self.assertEqual(sr.smembers(KEYS_MODIFIED_SET), set(['feeds:1', 'feeds:1.tags', 'feeds:1.scores']))
+            feeds(1).tags.srem('a')
+            with self.redis_delegator.batch():
+                feeds(1).log.rpush({'a': 1})
+                self.assertTrue(feeds(1).log.ltrim(0, 0) is None)
+            self.assertEqual(sr.llen('feeds:1.log'), 0)
+        self.assertEqual(feeds.find(1, ['name', 'age', 'tags', 'log']), {'name': 'y', 'age': '1', 'tags': set(['b']), 'log': [{'a': 1}]})
+        self.assertEqual(sr.hgetall('dirty_fields:feeds:1'), {'name': '1', 'age': '1'})
+        self.assertEqual(sr.lrange('op_log:feeds:1.tags', 0, -1), ['["sadd", ["b"]]', '["srem", ["a"]]'])
+
+        # nothing is written if the block raises
+        with self.assertRaises(ValueError):
+            with self.redis_delegator.batch():
+                feeds(1).tags.sadd('c')
+                raise ValueError()
+        self.assertEqual(feeds(1).tags.get(), set(['b']))
+
+        # only the modifications since the last read are discarded
+        with self.assertRaises(ValueError):
+            with self.redis_delegator.batch():
+                feeds(1).tags.sadd('d')
+                self.assertEqual(feeds(1).tags.get(), set(['b', 'd']))
+                feeds(1).tags.sadd('e')
+                feeds(1).name = None
+                raise ValueError()
+        self.assertEqual(feeds(1).tags.get(), set(['b', 'd']))
+        # neither in redis nor in mongo
+        self.assertEqual(feeds(1).name, 'y')
+        self.assertEqual(self.db.feeds.find_one({'uid': 1})['name'], 'x')
+
+        with self.redis_delegator.batch():
+            feeds(1).name = None
+            self.assertEqual(self.db.feeds.find_one({'uid': 1})['name'], 'x')
+        self.assertEqual(self.db.feeds.find_one({'uid': 1})['name'], None)
+
+    def test_checkpoint(self):
+        feeds = self.redis_delegator.feeds
+        sr = self.redis_conn
+        feeds(1).tags.sadd('a', 'b')
+        feeds(1).update({'name': 'x'})
+        feeds(2).tags.sadd('c')
+        self.assertEqual(sr.zcard('dirty_since'), 3)
+        self.assertEqual(self.redis_delegator.checkpoint_dirty_keys(sr, 60, 10), 0)
+
+        sr.zadd('dirty_since', 1, 'feeds:1.tags', 1, 'feeds:1', 2, 'feeds:2.tags')
+        self.assertEqual(self.redis_delegator.checkpoint_dirty_keys(sr, 60, 2, batch_size=10), 2)
+        doc = self.db.feeds.find_one({'uid': 1}, {'_id': 0})
+        self.assertEqual(set(doc.pop('tags')), set(['a', 'b']))
+        self.assertEqual(doc, {'uid': 1, 'name': 'x'})
+        # still cached, but not dirty any more
+        self.assertEqual(feeds(1).tags.get(), set(['a', 'b']))
+        self.assertEqual(sr.smembers(KEYS_MODIFIED_SET), set(['feeds:2.tags']))
+        self.assertEqual(sr.zrange('dirty_since', 0, -1), ['feeds:2.tags'])
+        self.assertFalse(sr.exists('dirty_fields:feeds:1'))
+        self.assertEqual(sr.llen('op_log:feeds:1.tags'), 0)
+
+        feeds(1).tags.srem('a')
+        with mock.patch.object(RedisDelegate, 'pace_write_back') as pace_write_back:
+            self.assertEqual(self.redis_delegator.checkpoint_dirty_keys(sr, 0, 10), 2)
+        # paced batch by batch, not at once
+        self.assertEqual(pace_write_back.call_args_list, [mock.call(sr, 1), mock.call(sr, 1)])
+        self.assertEqual(self.db.feeds.find_one({'uid': 1})['tags'], ['b'])
+        self.assertEqual(self.db.feeds.find_one({'uid': 2})['tags'], ['c'])
+
+    def test_checkpoint_retry(self):
+        users = self.redis_delegator.users
+        feeds = self.redis_delegator.feeds
+        sr = self.redis_conn
+        self.db.users.insert({'uid': 1, 'haslog': 5})
+        users(1).incr('haslog', 2)
+        feeds(1).tags.sadd('a')
+        write_back_to_mongo = self.redis_delegator.write_back_to_mongo
+
+        def modify_meanwhile(conn, key_name_list):
+            write_back_to_mongo(conn, key_name_list)
+            users(1).incr('haslog', 3)
+            feeds(1).tags.sadd('b')
+        with mock.patch.object(self.redis_delegator, 'write_back_to_mongo', side_effect=modify_meanwhile):
+            self.assertEqual(self.redis_delegator.checkpoint_dirty_keys(sr, 0, 10, batch_size=10), 0)
+        # the written ones are trimmed and forgotten, only the ones since then are written again
+        self.assertEqual(sr.lrange('op_log:feeds:1.tags', 0, -1), ['["sadd", ["b"]]'])
+        self.assertEqual(sr.hget('inc_fields:users:1', 'haslog'), '3')
+        self.assertEqual(self.redis_delegator.checkpoint_dirty_keys(sr, 0, 10), 2)
+        self.assertEqual(self.db.users.find_one({'uid': 1})['haslog'], 10)
+        self.assertEqual(set(self.db.feeds.find_one({'uid': 1})['tags']), set(['a', 'b']))
+
+    def test_write_back_pacer(self):
+        pacer = WriteBackPacer(max_rate=100, min_rate=10, latency_budget=0.05, rate_step=10, backoff=0.5, critical_memory=1000)
+        pacer.record(0.1)
+        pacer.record(0.1)
+        self.assertEqual(pacer.rate, 50)
+        pacer.record(0.01)
+        self.assertEqual(pacer.rate, 60)
+        self.assertEqual(pacer.reserve(6), 0)
+        self.assertTrue(0.09 < pacer.reserve(6) <= 0.1)
+
+        delegator = RedisDelegate(self.redis_conn, self.db, write_back_pacer=pacer)
+        delegator.add_collection(Tags())
+        delegator.tags(1).file_ids.sadd('1')
+        with mock.patch.object(RedisDelegate, 'get_used_memory', return_value=1000):
+            self.redis_conn.delete('lock:tags:1.file_ids')
+            start_time = time.time()
+            self.assertEqual(delegator.write_back_key_names(self.redis_conn, ['tags:1.file_ids'], batch_size=10), [])
+            # no waiting when memory is critical
+            self.assertTrue(time.time() - start_time < 0.05)
+        self.assertEqual(pacer.rate, 70)
+        self.assertEqual(self.db.tags.find_one({'uid': 1})['file_ids'], ['1'])
+
+    def test_instrumentation(self):
+        metrics = MetricsAggregator()
+        delegator = RedisDelegate(self.redis_conn, self.db, instrumentation=metrics)
+        delegator.add_collection(Tags())
+        self.db.tags.insert({'uid': 1, 'file_ids': ['1']})
+        self.assertEqual(delegator.tags(1).file_ids.smembers(), set(['1']))
+        self.assertEqual(delegator.tags(1).file_ids.sadd('2'), 1)
+        self.redis_conn.delete('lock:tags:1.file_ids')
+        self.assertEqual(delegator.write_back_key_names(self.redis_conn, ['tags:1.file_ids']), [])
+
+        report = metrics.report()
+        self.assertEqual(report['counters']['fill.miss.tags.file_ids'], 1)
+        self.assertEqual(report['counters']['fill.hit.tags.file_ids'], 1)
+        self.assertEqual(report['counters']['write_back.evicted'], 1)
+        for name in ('fill', 'mongo.find_one', 'mongo.bulk_write', 'field.smembers', 'field.sadd', 'write_back'):
+            self.assertEqual(report['spans'][name]['count'], 1)
+            self.assertTrue(report['spans'][name]['p50'] <= report['spans'][name]['p99'] <= report['spans'][name]['max'])
+        metrics.reset()
+        self.assertEqual(metrics.report(), {'counters': {}, 'spans': {}})
+
+    def test_incr(self):
+        users = self.redis_delegator.users
+        fblog = self.redis_delegator.fblog
+        sr = self.redis_conn
+        self.db.users.insert({'uid': 1, 'haslog': 5, 'name': 'x'})
+        self.assertEqual(users(1).incr('haslog', 2), 7)
+        self.assertEqual(fblog(1).incrbyfloat('online_time', 1.5), 1.5)
+        # written to mongo by another node meanwhile
+        self.db.users.update({'uid': 1}, {'$inc': {'haslog': 10}})
+        self.assertEqual(users(1).incr('haslog'), 8)
+        self.assertEqual(users(1).haslog, 8)
+
+        self.assertEqual(self.redis_delegator.checkpoint_dirty_keys(sr, 0, 10), 2)
+        self.assertEqual(self.db.users.find_one({'uid': 1}, {'_id': 0}), {'uid': 1, 'haslog': 18, 'name': 'x'})
+        self.assertEqual(self.db.fblog.find_one({'uid': 1})['online_time'], 1.5)
+        self.assertFalse(sr.exists('inc_fields:users:1'))
+
+        users(1).incr('haslog', 3)
+        users(1).name = 'y'
+        sr.delete('lock:users:1')
+        self.assertEqual(self.redis_delegator.write_back_key_names(sr, ['users:1']), [])
+        self.assertEqual(self.db.users.find_one({'uid': 1}, {'_id': 0}), {'uid': 1, 'haslog': 21, 'name': 'y'})
+        self.assertFalse(sr.exists('inc_fields:users:1'))
+
+    def test_forget_float_increments(self):
+        fblog = self.redis_delegator.fblog
+        sr = self.redis_conn
+        fblog(1).incrbyfloat('online_time', 0.1)
+        fblog(1).incrbyfloat('online_time', 0.2)
+        fblog.write_back(1)
+        # deleted, not left with a residue
+        self.assertFalse(sr.hexists('inc_fields:fblog:1', 'online_time'))
+        fblog(1).incrbyfloat('online_time', 0.5)
+        fblog.write_back(1)
+        self.assertFalse(sr.exists('inc_fields:fblog:1'))
+        self.assertAlmostEqual(self.db.fblog.find_one({'uid': 1})['online_time'], 0.8)
+
+    def test_warm_up(self):
+        feeds = self.redis_delegator.feeds
+        sr = self.redis_conn
+        self.db.feeds.insert([{'uid': i, 'views': i, 'tags': ['a%d' % i], 'log': [{'i': i}]} for i in range(10)])
+        feeds(9).tags.sadd('b')
+        sr.delete(KEYS_MODIFIED_SET)
+
+        self.assertEqual(feeds.warm_up({'views': {'$gte': 2}}, [('views', -1)], limit=5, batch_size=2), 5)
+        # modified in redis, kept
+        self.assertEqual(sr.smembers('feeds:9.tags'), set(['a9', 'b']))
+        for i in range(5, 9):
+            self.assertEqual(sr.smembers('feeds:%d.tags' % i), set(['a%d' % i]))
+            self.assertEqual(sr.hget('feeds:%d' % i, 'views'), str(i))
+            self.assertTrue(sr.zscore(LRU_QUEUE, 'feeds:%d.log' % i) is not None)
+        self.assertFalse(sr.exists('feeds:4.tags'))
+        self.assertEqual(sr.scard(KEYS_MODIFIED_SET), 0)
+        self.assertEqual(feeds(8).find(8)['log'], [{'i': 8}])
+
+        with mock.patch.object(RedisDelegate, 'get_used_memory', return_value=1000):
+            self.assertEqual(feeds.warm_up(batch_size=3, max_memory=1000), 3)
+
+    def test_iter_and_stream_write_back(self):
+        self.redis_delegator.add_collection(Albums())
+        albums = self.redis_delegator.albums
+        sr = self.redis_conn
+        photos = ['p%d' % i for i in range(10)]
+        albums(1).photos.rpush(*photos)
+        for i in range(7):
+            albums(1).likes.zadd(i, 10 + i)
+        albums(1).members.sadd(*range(8))
+        self.assertEqual(list(albums(1).photos.iter_lrange(3)), photos)
+        self.assertEqual(list(albums(1).likes.iter_zrange(2)), albums(1).likes.zrange(0, -1))
+        self.assertEqual(set(albums(1).members.iter_members(2)), set(str(_) for _ in range(8)))
+
+        # more operations than op_log_max_len, written back page by page
+        albums.write_back(1, 'likes')
+        self.assertEqual(sr.llen('op_log:albums:1.likes'), 0)
+        for key_name in ('albums:1.photos', 'albums:1.members'):
+            sr.delete('lock:' + key_name)
+        self.assertEqual(self.redis_delegator.write_back_key_names(sr, ['albums:1.photos', 'albums:1.members']), [])
+        doc = self.db.albums.find_one({'uid': 1}, {'_id': 0})
+        self.assertEqual(sorted(doc.pop('members')), sorted(str(_) for _ in range(8)))
+        self.assertEqual(doc, {'uid': 1, 'photos': photos, 'likes': [{'uid': 10 + i, 'time': i} for i in range(7)]})
+
+    def test_staged_field_not_loaded(self):
+        self.redis_delegator.add_collection(Albums())
+        albums = self.redis_delegator.albums
+        # left by a worker died while streaming photos back
+        self.db.albums.insert({'uid': 1, 'name': 'a', 'photos': ['x'], '_staged_photos': ['x', 'y']})
+        self.assertEqual(albums(1).find(1), {'name': 'a', 'photos': ['x']})
+        self.assertEqual(self.redis_conn.hgetall('albums:1'), {'name': 'a'})
+        self.assertEqual(albums.find_many([1], ['name']), [{'name': 'a'}])
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from pymongo import MongoClient
+
+from rmlru import (CollectionBase, SetField, ListField, ZsetField, DictField, ApproxLruQueue, LfuQueue, SegmentedLruQueue,
+                   KEYS_MODIFIED_SET, LRU_QUEUE)
+try:
+    import asyncio
+    import redis.asyncio
+    from motor.motor_asyncio import AsyncIOMotorClient
+    from rmlru.aio import AsyncRedisDelegate
+except (ImportError, SyntaxError):
+    AsyncRedisDelegate = None
+
+class Feeds(CollectionBase):
+    _key_name = 'uid'
+    _key_type = int
+    _col_name = 'feeds'
+    _none_string_key_name_dict = {_key_name: int}
+    tags = SetField('tags', log_ops=True)
+    log = ListField('log', DictField(), log_ops=True)
+    scores = ZsetField('scores', 'fid', int, 'score', int, log_ops=True)
+
+@unittest.skipIf(AsyncRedisDelegate is None, 'python 3, redis.asyncio and motor are needed')
+class AsyncRMLRUTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.mongo_conn = MongoClient('localhost', 27017)
+        self.db = self.mongo_conn.test
+        self.redis_conn = redis.StrictRedis(decode_responses=True)
+        self.async_redis_conn = redis.asyncio.Redis(decode_responses=True)
+        self.async_delegator = AsyncRedisDelegate(self.async_redis_conn, AsyncIOMotorClient('localhost', 27017).test)
+        self.async_delegator.add_collection(Feeds())
+
+    def tearDown(self):
+        self.redis_conn.flushdb()
+        self.mongo_conn.drop_database('test')
+        self.loop.run_until_complete(self.async_redis_conn.aclose())
+        self.loop.close()
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_find_and_modify(self):
+        feeds = self.async_delegator.feeds
+        self.db.feeds.insert_one({'uid': 1, 'name': 'x', 'tags': ['a'], 'log': [{'a': 1}], 'scores': [{'fid': 1, 'score': 2}]})
+        doc = self.run_async(feeds.find(1))
+        self.assertEqual(doc, {'name': 'x', 'tags': set(['a']), 'log': [{'a': 1}], 'scores': [{'fid': 1, 'score': 2}]})
+
+        self.assertEqual(self.run_async(feeds(1).tags.sadd('b')), 1)
+        self.run_async(feeds(1).log.rpush({'b': 2}))
+        self.run_async(feeds(1).scores.zadd(1, 2))
+        self.run_async(feeds(1).set('name', 'y'))
+        self.assertTrue(self.redis_conn.sismember(KEYS_MODIFIED_SET, 'feeds:1.tags'))
+        self.assertTrue(self.redis_conn.zscore(LRU_QUEUE, 'feeds:1') is not None)
+        self.assertEqual(self.run_async(feeds.find_many([1, 2], ['name', 'tags'])), [{'name': 'y', 'tags': set(['a', 'b'])}, {'name': None, 'tags': set()}])
+        self.assertEqual(self.redis_conn.hgetall('dirty_fields:feeds:1'), {'name': '1'})
+        self.assertEqual(self.redis_conn.lrange('op_log:feeds:1.tags', 0, -1), ['["sadd", ["b"]]'])
+
+    def test_write_back(self):
+        feeds = self.async_delegator.feeds
+        self.run_async(feeds(1).tags.sadd('a', 'b'))
+        self.run_async(feeds(1).scores.zadd(3, 1, 2, 2))
+        self.run_async(feeds.update(1, {'name': 'x'}))
+        key_name_list = self.redis_conn.zrange(LRU_QUEUE, 0, -1)
+        self.redis_conn.delete(*['lock:' + _ for _ in key_name_list])
+
+        self.assertEqual(self.run_async(self.async_delegator.write_back_key_names(key_name_list)), [])
+        doc = self.db.feeds.find_one({'uid': 1}, {'_id': 0})
+        self.assertEqual(set(doc.pop('tags')), set(['a', 'b']))
+        self.assertEqual(doc, {'uid': 1, 'name': 'x', 'scores': [{'fid': 2, 'score': 2}, {'fid': 1, 'score': 3}]})
+        self.assertEqual(self.redis_conn.zcard(LRU_QUEUE), 0)
+        self.assertEqual(self.redis_conn.scard(KEYS_MODIFIED_SET), 0)
+
+    def test_lru_queue_policy(self):
+        mongo_db = AsyncIOMotorClient('localhost', 27017).test
+        AsyncRedisDelegate(self.async_redis_conn, mongo_db, lru_queue=ApproxLruQueue())
+        self.assertRaises(ValueError, AsyncRedisDelegate, self.async_redis_conn, mongo_db, lru_queue=LfuQueue())
+        self.assertRaises(ValueError, AsyncRedisDelegate, self.async_redis_conn, mongo_db, lru_queue=SegmentedLruQueue())